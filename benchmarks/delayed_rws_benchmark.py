@@ -0,0 +1,192 @@
+import argparse
+import time
+from datetime import datetime
+from functools import partial
+
+import numpy as np
+
+from numba import guvectorize
+
+from foba_backtest_engine.analysis_utils.target_function.delayed_rws import (
+    adjust_for_lunch_inplace,
+    calculate_delayed_rws_midspot,
+    delayed_rws_midspot_books,
+)
+from foba_backtest_engine.components.order_book.builders.multi_book_builder import build_book
+from foba_backtest_engine.components.order_book.builders.OMDC import OmdcBookBuilder
+from foba_backtest_engine.components.order_book.utils.enums import Exchange
+from foba_backtest_engine.utils.base_utils import ImmutableRecord
+from foba_backtest_engine.utils.time_utils import start_end_time
+
+"""
+DELAYED RWS BENCHMARK
+
+The delayed midspot/rws kernels on a day of feed states ... three ways to run them over the books
+
+    scan        the previous guvectorize forward scan (calculate_delayed_rws_midspot_scan, a copy kept here as the
+                reference), one call per book
+    per book    calculate_delayed_rws_midspot one call per book ... as the workers of the parallel book build do
+    one call    delayed_rws_midspot_books over all books ... as annotate_slippages does when the books are built
+                sequentially
+
+i) the feed states of every book are built from the order book as the engine does (build_book) & prepared as
+   book_slippages does (stable sort by createdNanos_, lunch adjusted, midspot & rws of the top level)
+ii) --copies repeats the books (each copy is its own book) ... to time a universe of many books w/ one day of data
+   --end HH:MM cuts the day short (as the engine's end_hour/end_minute) ... the scan rescans a book's remaining rows
+   for every feed state w/o a row after its time + interval, so books spanning less than an interval are quadratic
+iii) every way is run once to compile, then timed --repeat times (the best time is reported) & all must agree
+
+What to expect ... the new kernel only wins clearly where the scan is quadratic (short windows vs the 3600s/7200s
+intervals). Otherwise the kernels are about as fast & one call over many books only saves the per call overhead
+(on one CPU the prange over (book, interval) tasks doesn't run in parallel)
+
+CLI
+
+    python -m benchmarks.delayed_rws_benchmark \
+        --order-book-path temp_data_2/book.parquet --date 2024-09-20 --books 5 [--end 17:15] [--copies 1] [--repeat 5]
+
+"""
+
+PNL_SLIPPAGE_TIMES = [5, 15, 30, 60, 120, 240, 300, 600, 900, 1800, 3600, 7200]
+
+
+def book_arrays(order_book_path, date, book_id, end_hour=17, end_minute=15):
+    """(times, midspots, rws) of the book's feed states ... as book_slippages passes them to the kernel"""
+    start_time, end_time = start_end_time(
+        time_zone="Asia/Hong_Kong",
+        days_ago=0,
+        start_hour=6,
+        start_minute=0,
+        end_hour=end_hour,
+        end_minute=end_minute,
+        end_date=date,
+    )
+    filter = ImmutableRecord(
+        start_time=start_time,
+        end_time=end_time,
+        book_ids=[book_id],
+        order_book_path=order_book_path,
+        feed_store_path=None,
+    )
+    _, result = build_book(
+        OmdcBookBuilder, Exchange.OMDC, filter, book_id, dict(snapshot_depth=5, snapshot_mode="every_message")
+    )
+    states = result.feed_states.to_frame().sort_values("createdNanos_", kind="stable")
+    times = states["createdNanos_"].to_numpy(dtype=np.float64)
+    adjust_for_lunch_inplace(timestamp=times, exclude_lunch=True)
+    midspots = ((states.asks_0_price_ + states.bids_0_price_) / 2.0).to_numpy()
+    rws = (
+        (states.bids_0_volume_ * states.asks_0_price_ + states.asks_0_volume_ * states.bids_0_price_)
+        / (states.bids_0_volume_ + states.asks_0_volume_)
+    ).to_numpy(dtype=np.float64)
+    return times, midspots, rws
+
+
+@guvectorize(
+    ["void(float64[:], float64[:], float64[:], float64[:], float64[:], float64[:,:])"],
+    "(n),(m),(m),(m),(S),(n,J)",
+    target="parallel",
+)
+def calculate_delayed_rws_midspot_scan(
+    trade_times, exchange_times, midspots, rws, intervals, result
+):
+    """the previous per book kernel of delayed_rws ... a forward scan per interval"""
+    n = trade_times.shape[0]
+    m = exchange_times.shape[0]
+    S = intervals.shape[0]
+    J = 2 * S
+
+    """
+    Iterate over each time interval (S) and for each timestamp
+    """
+
+    for p in range(S):
+        current_position = 0
+        interval_ns = intervals[p] * 1_000_000_000
+        for i in range(n):
+            cutoff_time = trade_times[i] + interval_ns
+
+            if i > 0 and trade_times[i] == trade_times[i - 1]:
+                result[i, p] = result[i - 1, p]
+                result[i, p + S] = result[i - 1, p + S]
+                continue
+
+            midspot_val = midspots[-1]
+            rws_val = rws[-1]
+
+            for j in range(current_position, m):
+                if exchange_times[j] > cutoff_time:
+                    midspot_val = midspots[j]
+                    rws_val = rws[j]
+                    current_position = j
+                    break
+
+            result[i, p] = midspot_val
+            result[i, p + S] = rws_val
+
+
+def benchmark(books, intervals=PNL_SLIPPAGE_TIMES, repeat=5):
+    """
+    :param books: [(times, midspots, rws)] per book
+    :return: {"scan": seconds, "per book": seconds, "one call": seconds} ... the best of repeat runs of each way
+    """
+    intervals = np.array(intervals, dtype=np.float64)
+    bounds = np.cumsum([0] + [len(times) for times, _, _ in books]).astype(np.int64)
+    times, midspots, rws = (np.concatenate(columns) for columns in zip(*books))
+    results = {name: np.empty((len(times), 2 * len(intervals))) for name in ("scan", "per book", "one call")}
+
+    def per_book(kernel, result):
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            rows = slice(start, end)
+            kernel(times[rows], times[rows], midspots[rows], rws[rows], intervals, result[rows])
+
+    ways = {
+        "scan": partial(per_book, calculate_delayed_rws_midspot_scan, results["scan"]),
+        "per book": partial(per_book, calculate_delayed_rws_midspot, results["per book"]),
+        "one call": partial(
+            delayed_rws_midspot_books, times, times, midspots, rws, intervals, bounds, bounds, results["one call"]
+        ),
+    }
+    timings = {name: _best_time(way, repeat) for name, way in ways.items()}
+    for name in ("per book", "one call"):
+        if not np.array_equal(results["scan"], results[name], equal_nan=True):
+            raise AssertionError(f"{name} should match the scan!")
+    return timings
+
+
+"""
+HELPERS
+"""
+
+
+def _best_time(function, repeat):
+    function()
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the delayed rws/midspot kernels on a day of feed states")
+    parser.add_argument("--order-book-path", required=True)
+    parser.add_argument("--date", required=True, help="YYYY-MM-DD")
+    parser.add_argument("--books", required=True, help="comma separated book ids")
+    parser.add_argument("--end", default="17:15", help="HH:MM end of the day's feed")
+    parser.add_argument("--copies", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    date = datetime.strptime(args.date, "%Y-%m-%d")
+    end_hour, end_minute = map(int, args.end.split(":"))
+    books = [
+        book_arrays(args.order_book_path, date, book_id, end_hour, end_minute) for book_id in args.books.split(",")
+    ]
+    books = books * args.copies
+    timings = benchmark(books, repeat=args.repeat)
+    rows = sum(len(times) for times, _, _ in books)
+    print(f"{len(books)} books, {rows} feed states, {len(PNL_SLIPPAGE_TIMES)} intervals")
+    for name, seconds in timings.items():
+        print(f"{name:<10} {seconds:.4f}s  ({timings['scan'] / seconds:.1f}x the scan)")
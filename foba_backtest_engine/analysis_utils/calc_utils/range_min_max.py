@@ -0,0 +1,197 @@
+from typing import Any
+
+import numpy as np
+from numba import njit
+from numpy import dtype, float64, int64, ndarray
+
+"""
+RANGE MIN MAX
+
+Min/max (& their positions) of series over time windows ... built once per book(s) & series, then any number of
+windows are answered in batched numba passes
+
+i) RangeMinMax(times, values, segment_bounds) ... values (n,) | (series, n) sorted by times within each segment (e.g.
+   one segment per book, rows segment_bounds[s]:segment_bounds[s+1])
+ii) windows(starts, ends, segments) ... [start, end] (or (start, end]) of each query as rows [low, high) of its segment,
+    by binary search in the segment's times. Times are compared in their own dtype (pass float64 for float semantics)
+    ... a NaN start gives an empty window & a NaN end runs to the end of the segment, as np.searchsorted
+iii) max | min | argmax | argmin(lows, highs) ... sparse tables of the position of the max | min of values[i:i + 2**level]
+     (built on first use & only as deep as the longest window asked for, int32 positions below 2**31 rows), so a window
+     is 2 lookups ... a table holds series * levels * n positions, so build one per book rather than over a whole
+     universe & leave out series that can't matter (e.g. all NaN)
+    - as np.argmax | np.argmin ... the first NaN wins (so max/min of a window w/ a NaN is NaN), then the first extreme
+    - an empty window gives NaN (max/min) | -1 (argmax/argmin)
+
+"""
+
+
+class RangeMinMax:
+    def __init__(
+        self,
+        times: ndarray[Any, dtype[int64] or dtype[float64]],
+        values: ndarray[Any, dtype[float64]],
+        segment_bounds: ndarray[Any, dtype[int64]] or None = None,
+    ):
+        self.times = np.ascontiguousarray(times)
+        self.values = np.ascontiguousarray(values, dtype=np.float64)
+        self._series = self.values.ndim > 1
+        if not self._series:
+            self.values = self.values.reshape(1, -1)
+        if segment_bounds is None:
+            segment_bounds = [0, len(self.times)]
+        self.segment_bounds = np.asarray(segment_bounds, dtype=np.int64)
+        self._tables = {}
+
+    def windows(self, starts, ends, segments=None, start_inclusive=True):
+        """
+        :param segments: segment of every query (-1 ... an empty window), all in segment 0 if None
+        :return: (lows, highs) ... rows [low, high) of every window
+        """
+        starts = np.asarray(starts, dtype=self.times.dtype)
+        ends = np.asarray(ends, dtype=self.times.dtype)
+        if segments is None:
+            segments = np.zeros(len(starts), dtype=np.int64)
+        return _window_bounds(
+            self.times,
+            self.segment_bounds,
+            np.asarray(segments, dtype=np.int64),
+            starts,
+            ends,
+            start_inclusive,
+        )
+
+    def argmax(self, lows, highs):
+        return self._positions(lows, highs, True)
+
+    def argmin(self, lows, highs):
+        return self._positions(lows, highs, False)
+
+    def max(self, lows, highs):
+        return self._extremes(lows, highs, True)
+
+    def min(self, lows, highs):
+        return self._extremes(lows, highs, False)
+
+    def _extremes(self, lows, highs, is_max):
+        positions = self._positions(lows, highs, is_max)
+        return _gathered(self.values, positions.reshape(len(self.values), -1)).reshape(positions.shape)
+
+    def _positions(self, lows, highs, is_max):
+        lows = np.asarray(lows, dtype=np.int64)
+        highs = np.asarray(highs, dtype=np.int64)
+        longest = int((highs - lows).max()) if len(lows) else 0
+        positions = _range_positions(self.values, self._table(longest, is_max), lows, highs, is_max)
+        return positions if self._series else positions[0]
+
+    def _table(self, longest, is_max):
+        num_levels = max(longest, 1).bit_length()
+        table = self._tables.get(is_max)
+        if table is None or table.shape[1] < num_levels:
+            num_series, n = self.values.shape
+            position_type = np.int32 if n < np.iinfo(np.int32).max else np.int64
+            table = np.empty((num_series, num_levels, n), dtype=position_type)
+            _fill_position_tables(self.values, table, is_max)
+            self._tables[is_max] = table
+        return table
+
+
+"""
+HELPERS
+"""
+
+
+@njit(cache=True)
+def _window_bounds(times, segment_bounds, segments, starts, ends, start_inclusive):
+    num_queries = segments.shape[0]
+    lows = np.zeros(num_queries, dtype=np.int64)
+    highs = np.zeros(num_queries, dtype=np.int64)
+    for query in range(num_queries):
+        segment = segments[query]
+        if segment < 0:
+            continue
+        segment_start, segment_end = segment_bounds[segment], segment_bounds[segment + 1]
+        lows[query] = _search(times, segment_start, segment_end, starts[query], not start_inclusive)
+        highs[query] = max(
+            lows[query], _search(times, segment_start, segment_end, ends[query], True)
+        )
+    return lows, highs
+
+
+@njit(cache=True)
+def _search(times, start, end, value, right):
+    """np.searchsorted(times[start:end], value, side) + start ... a NaN value goes past the end"""
+    if value != value:
+        return end
+    low, high = start, end
+    while low < high:
+        middle = (low + high) // 2
+        if times[middle] < value or (right and times[middle] == value):
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+
+@njit(cache=True)
+def _fill_position_tables(values, tables, is_max):
+    """tables[series, level, i] ... position of the max | min of values[series, i:i + 2**level]"""
+    num_series, num_levels, n = tables.shape
+    for series in range(num_series):
+        for i in range(n):
+            tables[series, 0, i] = i
+    for level in range(1, num_levels):
+        half = 1 << (level - 1)
+        for series in range(num_series):
+            for i in range(n - (1 << level) + 1):
+                tables[series, level, i] = _pick(
+                    values, series, tables[series, level - 1, i], tables[series, level - 1, i + half], is_max
+                )
+
+
+@njit(cache=True)
+def _range_positions(values, tables, lows, highs, is_max):
+    num_series = values.shape[0]
+    num_queries = lows.shape[0]
+    positions = np.empty((num_series, num_queries), dtype=np.int64)
+    for query in range(num_queries):
+        low, high = lows[query], highs[query]
+        if high <= low:
+            for series in range(num_series):
+                positions[series, query] = -1
+            continue
+        # the largest power of two in the window ... its two (overlapping) halves cover it
+        level = 0
+        while (1 << (level + 1)) <= high - low:
+            level += 1
+        other = high - (1 << level)
+        for series in range(num_series):
+            positions[series, query] = _pick(
+                values, series, tables[series, level, low], tables[series, level, other], is_max
+            )
+    return positions
+
+
+@njit(cache=True)
+def _pick(values, series, a, b, is_max):
+    """the position of the two whose value comes first as np.argmax | np.argmin (NaN, then extreme, then position)"""
+    value_a, value_b = values[series, a], values[series, b]
+    if value_a != value_a or value_b != value_b:
+        if value_a != value_a and value_b != value_b:
+            return min(a, b)
+        return a if value_a != value_a else b
+    if value_a == value_b:
+        return min(a, b)
+    if (value_a > value_b) == is_max:
+        return a
+    return b
+
+
+@njit(cache=True)
+def _gathered(values, positions):
+    num_series, num_queries = positions.shape
+    result = np.empty((num_series, num_queries))
+    for series in range(num_series):
+        for query in range(num_queries):
+            position = positions[series, query]
+            result[series, query] = np.nan if position < 0 else values[series, position]
+    return result
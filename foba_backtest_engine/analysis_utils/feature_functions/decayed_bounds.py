@@ -10,6 +10,8 @@ from foba_backtest_engine.analysis_utils.calc_utils.ufunc.backbone import (
 
 
 # Decayed Bounds (different to dhr/dlr)
+# a recursive decay of the previous bound towards rws (floored/capped by the touch), not a window min/max ... so
+# not a RangeMinMax query (see calc_utils/range_min_max.py)
 def decayed_bound_calculator(
     timestamp: ndarray[Any, dtype[int64]],
     trigger_direction: ndarray[Any, dtype[float64] or dtype[int64]],
@@ -4,6 +4,8 @@ import numpy as np
 import pandas as pd
 from numpy import dtype, float64, int64, ndarray
 
+from foba_backtest_engine.analysis_utils.calc_utils.range_min_max import RangeMinMax
+
 
 def order_book_imbalance1(
     bid_0_volume: ndarray[Any, dtype[float64]],
@@ -98,15 +100,26 @@ def order_book_imbalance_interval_argmax_diff(
     OBI_df.index = OBI_df["timeindex"]
     OBI_df.drop(columns="timeindex", inplace=True)
 
-    argmax_diff = OBI_df.rolling(window=pd.Timedelta(seconds=interval)).apply(
-        lambda arr: (arr.shape[0] - np.argmax(arr)) / float(arr.shape[0]),
-        raw=True,
-        engine="numba",
-        engine_kwargs={"nopython": True, "nogil": False, "parallel": False},
+    """
+    (window length - position of its first max) / window length over the rolling (t - interval, t] windows ... as a
+    time based rolling apply of np.argmax, but the argmax of every window comes from one RangeMinMax (sparse table)
+    """
+    times = OBI_df.index.asi8
+    values = OBI_df["OBI"].to_numpy(dtype=np.float64, copy=True)
+    # as rolling does ... +-inf (e.g. an empty ask) counts as NaN
+    values[np.isinf(values)] = np.nan
+    windows = RangeMinMax(times, values)
+    lows, highs = windows.windows(
+        times - pd.Timedelta(seconds=interval).value, times, start_inclusive=False
     )
+    lengths = (highs - lows).astype(np.float64)
+    argmax_diff = (lengths - (windows.argmax(lows, highs) - lows)) / lengths
+    # rolling's min_periods ... a window w/o any non NaN value is NaN
+    observed = np.concatenate(([0], np.cumsum(~np.isnan(values))))
+    argmax_diff[observed[highs] == observed[lows]] = np.nan
 
     rolling_df = pd.DataFrame(
-        {"timestamp": new_timestamps, "rolling_result": argmax_diff["OBI"].values}
+        {"timestamp": new_timestamps, "rolling_result": argmax_diff}
     )
 
     return rolling_df
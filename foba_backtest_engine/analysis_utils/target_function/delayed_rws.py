@@ -4,7 +4,7 @@ TZ_STR = "Asia/Hong_Kong"
 from datetime import time as Time
 
 import numpy as np
-from numba import float64, guvectorize, njit
+from numba import float64, njit, prange
 from numpy import array, dtype, float64, int64, maximum, ndarray, tile, where
 from pandas import DataFrame, DatetimeIndex, Series
 
@@ -76,43 +76,69 @@ def adjust_for_lunch_inplace(timestamp: np.ndarray, exclude_lunch: bool) -> None
             timestamp[i] = ts - HOUR_NS
 
 
-@guvectorize(
-    ["void(float64[:], float64[:], float64[:], float64[:], float64[:], float64[:,:])"],
-    "(n),(m),(m),(m),(S),(n,J)",
-    target="parallel",
-)
 def calculate_delayed_rws_midspot(
     trade_times, exchange_times, midspots, rws, intervals, result
 ):
-    n = trade_times.shape[0]
-    m = exchange_times.shape[0]
-    S = intervals.shape[0]
-    J = 2 * S
-
-    """
-    Iterate over each time interval (S) and for each timestamp
     """
+    midspot & rws of the first exchange row after trade_time + interval (the last row if there is none) for every
+    trade time & interval ... result[:, p] the midspots & result[:, p + S] the rws of intervals[p] (S intervals)
 
-    for p in range(S):
-        current_position = 0
-        interval_ns = intervals[p] * 1_000_000_000
-        for i in range(n):
-            cutoff_time = trade_times[i] + interval_ns
+    One book ... see delayed_rws_midspot_books, which this runs w/ a single book. Times are compared as float64
+    """
+    trade_times = np.asarray(trade_times, dtype=np.float64)
+    exchange_times = np.asarray(exchange_times, dtype=np.float64)
+    delayed_rws_midspot_books(
+        trade_times,
+        exchange_times,
+        np.asarray(midspots, dtype=np.float64),
+        np.asarray(rws, dtype=np.float64),
+        np.asarray(intervals, dtype=np.float64),
+        np.array([0, len(trade_times)]),
+        np.array([0, len(exchange_times)]),
+        result,
+    )
 
-            if i > 0 and trade_times[i] == trade_times[i - 1]:
-                result[i, p] = result[i - 1, p]
-                result[i, p + S] = result[i - 1, p + S]
-                continue
 
-            midspot_val = midspots[-1]
-            rws_val = rws[-1]
+@njit(
+    "void(float64[:], float64[:], float64[:], float64[:], float64[:], int64[:], int64[:], float64[:, :])",
+    parallel=True,
+    cache=True,
+)
+def delayed_rws_midspot_books(
+    trade_times, exchange_times, midspots, rws, intervals, trade_bounds, exchange_bounds, result
+):
+    """
+    calculate_delayed_rws_midspot of many books in one call ... book b is trade rows trade_bounds[b]:trade_bounds[b+1]
+    & exchange rows exchange_bounds[b]:exchange_bounds[b+1] (each sorted by time), result has a row per trade row
+
+    i) every (book, interval) pair is one task of the prange ... the books & intervals run in parallel
+    ii) the future row is np.searchsorted(book_exchange_times, trade_time + interval, side="right") (capped at the
+        last row) ... found by moving a pointer from the previous trade's row, so sorted trade times cost O(n + m)
+        per task instead of O(n log m) (unsorted ones are still right, just slower)
+    iii) a book w/o exchange rows gets NaN
+    """
+    S = intervals.shape[0]
+    num_books = trade_bounds.shape[0] - 1
 
-            for j in range(current_position, m):
-                if exchange_times[j] > cutoff_time:
-                    midspot_val = midspots[j]
-                    rws_val = rws[j]
-                    current_position = j
-                    break
+    for task in prange(num_books * S):
+        book = task // S
+        p = task % S
+        trade_start, trade_end = trade_bounds[book], trade_bounds[book + 1]
+        exchange_start, exchange_end = exchange_bounds[book], exchange_bounds[book + 1]
+        interval_ns = intervals[p] * 1_000_000_000
 
-            result[i, p] = midspot_val
-            result[i, p + S] = rws_val
+        position = exchange_start
+        for i in range(trade_start, trade_end):
+            cutoff_time = trade_times[i] + interval_ns
+            while position > exchange_start and exchange_times[position - 1] > cutoff_time:
+                position -= 1
+            while position < exchange_end and exchange_times[position] <= cutoff_time:
+                position += 1
+
+            if exchange_end == exchange_start:
+                result[i, p] = np.nan
+                result[i, p + S] = np.nan
+            else:
+                j = min(position, exchange_end - 1)
+                result[i, p] = midspots[j]
+                result[i, p + S] = rws[j]
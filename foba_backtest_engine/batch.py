@@ -0,0 +1,403 @@
+import argparse
+import datetime
+import hashlib
+import json
+import os
+import tempfile
+import time
+import traceback
+from collections import deque, namedtuple
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from enum import Enum
+from functools import partial
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from foba_backtest_engine.engine import Engine
+from foba_backtest_engine.utils import futures, profiling
+from foba_backtest_engine.utils.base_utils import get_logger
+
+logger = get_logger(__name__)
+
+"""
+-----------
+    BATCH
+-----------
+
+Runs the Engine over a date range x book universe ... one shard per (date, book group), each in a fresh worker process
+
+    <output>/run_date=YYYY-MM-DD/book_group=<group>/part-0.parquet    FOBA output of the shard (Engine.results)
+    <output>/run_date=YYYY-MM-DD/book_group=<group>/profile.json      its processor profile (see utils/profiling.py)
+    <output>/_manifest.json                                           status of every shard run so far
+
+    (not date=/group= ... the FOBA output already has a date column)
+
+a) Sharding
+    - dates ... business_dates(start, end) gives the weekdays in between (exchange holidays simply fail or come back
+      empty ... pass explicit dates to skip them)
+    - books ... book_groups ({name: [books]} | [[books], ...]) or book_ids cut into groups of group_size
+b) Admission ... at most max_workers shards run at once & every running shard reserves memory_per_shard bytes of
+   memory_budget (default: MemAvailable at the start). A shard is only submitted while its reservation fits & the
+   machine still has min_free_memory available. The estimate is raised to the largest peak RSS a finished shard
+   reached (+ 20%), so the first few shards calibrate the rest. One shard always runs
+c) Output ... written to a temp file & renamed, so a partition is either complete or absent. Enums are written by
+   name & columns mixing types as strings (parquet needs one type per column)
+d) Resuming ... the manifest is rewritten after every shard. A rerun skips shards that are done (same books & the
+   partition exists) & retries the failed | missing ones ... overwrite=True reruns everything
+e) Failures ... an exception fails only its shard (error & traceback go into the manifest). A worker that dies
+   (e.g. killed by the OOM killer) fails the shards running at that moment & the pool is restarted
+
+CLI
+
+    python -m foba_backtest_engine.batch --start 2024-09-16 --end 2024-09-20 --books 5,700,939 --group-size 2 \
+        --output /data/foba_batch [--config config.json] [--workers 2] [--memory-per-shard-gb 4]
+
+    config.json holds the Engine config (paths, end_hour, feed_store_path ...) as JSON
+
+"""
+
+MANIFEST_NAME = "_manifest.json"
+OUTPUT_NAME = "part-0.parquet"
+PROFILE_NAME = "profile.json"
+
+DONE = "done"
+FAILED = "failed"
+
+Shard = namedtuple("Shard", "date group book_ids")
+
+ShardResult = namedtuple("ShardResult", "key status rows path elapsed peak_rss error")
+
+
+def business_dates(start, end):
+    """weekdays from start to end (inclusive) as datetime.date"""
+    return [timestamp.date() for timestamp in pd.bdate_range(start, end)]
+
+
+def book_group_name(book_ids):
+    if len(book_ids) <= 4:
+        return "-".join(book_ids)
+    digest = hashlib.sha1(",".join(book_ids).encode()).hexdigest()[:8]
+    return f"{book_ids[0]}-{book_ids[-1]}-n{len(book_ids)}-{digest}"
+
+
+class BatchRunner:
+    def __init__(
+        self,
+        output,
+        dates,
+        book_ids=None,
+        book_groups=None,
+        group_size=None,
+        config=None,
+        mode="passive_analysis",
+        max_workers=2,
+        memory_per_shard=4 * 1024**3,
+        memory_budget=None,
+        min_free_memory=1024**3,
+        overwrite=False,
+    ):
+        """
+        :param dates: iterable of dates (datetime.date | YYYY-MM-DD) ... see business_dates
+        :param book_ids: book universe, cut into groups of group_size (default: one group) ... or give book_groups
+        :param config: Engine config shared by every shard
+        :param max_workers: shards running at once (<= 1 runs them one by one in this process)
+        """
+        if (book_ids is None) == (book_groups is None):
+            raise ValueError("Provide exactly one of book_ids | book_groups")
+        self.output = output
+        self.dates = [pd.Timestamp(date).date() for date in dates]
+        self.book_groups = _book_groups(book_ids, book_groups, group_size)
+        self.config = dict(config or {})
+        self.mode = mode
+        self.max_workers = max_workers
+        self.memory_per_shard = memory_per_shard
+        self.memory_budget = memory_budget
+        self.min_free_memory = min_free_memory
+        self.overwrite = overwrite
+        self.manifest = self._load_manifest()
+
+    def shards(self):
+        return [
+            Shard(date, group, book_ids)
+            for date in self.dates
+            for group, book_ids in self.book_groups.items()
+        ]
+
+    def pending_shards(self):
+        """shards still to run ... see (d)"""
+        return [shard for shard in self.shards() if self.overwrite or not self._is_done(shard)]
+
+    def run(self):
+        """:return: the manifest of this batch's shards as a DataFrame (one row per shard)"""
+        pending = deque(self.pending_shards())
+        skipped = len(self.shards()) - len(pending)
+        logger.info(f"Batch: {len(pending)} shards to run, {skipped} already done")
+
+        budget = self.memory_budget or _available_memory() or float("inf")
+        estimate = self.memory_per_shard
+        executor = self._executor()
+        running = {}
+        try:
+            while pending or running:
+                while pending and len(running) < max(self.max_workers, 1):
+                    if running and not self._admit(budget, estimate * (len(running) + 1)):
+                        break
+                    shard = pending.popleft()
+                    self._mark_running(shard)
+                    running[executor.submit(_run_shard, shard, self.config, self.mode, self.output)] = shard
+
+                finished = wait(running, return_when=FIRST_COMPLETED)[0]
+                broken = False
+                for future in finished:
+                    shard = running.pop(future)
+                    try:
+                        result = future.result()
+                    except BrokenProcessPool as error:
+                        broken = True
+                        result = _failed(shard, f"worker process died ({error})")
+                    self._record(shard, result)
+                    if result.status == DONE and result.peak_rss:
+                        estimate = max(estimate, int(result.peak_rss * 1.2))
+                if broken:
+                    # the other shards of a broken pool fail with it ... a rerun of the batch retries them
+                    for shard in running.values():
+                        self._record(shard, _failed(shard, "worker pool restarted after a worker died"))
+                    running = {}
+                    executor.shutdown(wait=False)
+                    executor = self._executor()
+        finally:
+            executor.shutdown()
+
+        summary = self.summary()
+        logger.info(
+            f"Batch: {(summary.status == DONE).sum()} shards done, {(summary.status != DONE).sum()} not done"
+        )
+        return summary
+
+    def summary(self):
+        keys = [_shard_key(shard) for shard in self.shards()]
+        return pd.DataFrame(
+            [dict(key=key, **self.manifest["shards"].get(key, dict(status="pending"))) for key in keys]
+        )
+
+    def read(self, columns=None):
+        """the FOBA output of every shard of this batch that is done as one DataFrame (run_date & book_group added)"""
+        frames = []
+        for shard in self.shards():
+            if self._is_done(shard):
+                entry = self.manifest["shards"][_shard_key(shard)]
+                frame = pq.read_table(os.path.join(self.output, entry["path"]), columns=columns).to_pandas()
+                frames.append(frame.assign(run_date=shard.date.isoformat(), book_group=shard.group))
+        return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+
+    def _executor(self):
+        # a fresh process per shard ... its memory goes back to the OS & its peak RSS is its own
+        return futures.make_executor(
+            self.max_workers > 1,
+            safer=False,
+            max_workers=self.max_workers,
+            executor_cls=partial(ProcessPoolExecutor, max_tasks_per_child=1),
+        )
+
+    def _admit(self, budget, reserved):
+        available = _available_memory()
+        if available is not None and available < self.min_free_memory:
+            return False
+        return reserved <= budget
+
+    def _is_done(self, shard):
+        entry = self.manifest["shards"].get(_shard_key(shard))
+        return (
+            entry is not None
+            and entry["status"] == DONE
+            and entry["book_ids"] == list(shard.book_ids)
+            and os.path.exists(os.path.join(self.output, entry["path"]))
+        )
+
+    def _mark_running(self, shard):
+        logger.debug(f"Batch: running {_shard_key(shard)}")
+        self.manifest["shards"][_shard_key(shard)] = dict(
+            status="running", book_ids=list(shard.book_ids), started=datetime.datetime.now().isoformat()
+        )
+        self._write_manifest()
+
+    def _record(self, shard, result):
+        entry = self.manifest["shards"][_shard_key(shard)]
+        entry.update(result._asdict())
+        del entry["key"]
+        if result.status == DONE:
+            logger.info(f"Batch: {result.key} done ({result.rows} rows, {result.elapsed:.0f}s)")
+        else:
+            logger.error(f"Batch: {result.key} failed ... {result.error}")
+        self._write_manifest()
+
+    def _load_manifest(self):
+        path = os.path.join(self.output, MANIFEST_NAME)
+        if os.path.exists(path):
+            with open(path) as manifest_file:
+                return json.load(manifest_file)
+        return dict(shards={})
+
+    def _write_manifest(self):
+        _write_atomic(
+            os.path.join(self.output, MANIFEST_NAME),
+            lambda path: _dump_json(self.manifest, path),
+        )
+
+
+"""
+HELPERS
+"""
+
+
+def _run_shard(shard, config, mode, output):
+    """runs in the worker ... never raises, so a failure stays with its shard"""
+    key = _shard_key(shard)
+    start = time.perf_counter()
+    # the peak of this shard only (matters when shards run in this process)
+    profiling.reset_peak_rss()
+    try:
+        engine = Engine(
+            mode=mode,
+            book_ids=list(shard.book_ids),
+            date=datetime.datetime.combine(shard.date, datetime.time()),
+            config=config,
+        )
+        engine.run()
+        directory = os.path.join(output, f"run_date={shard.date.isoformat()}", f"book_group={shard.group}")
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, OUTPUT_NAME)
+        _write_atomic(path, partial(_write_parquet, _parquet_frame(engine.results)))
+        _write_atomic(os.path.join(directory, PROFILE_NAME), lambda profile_path: engine.profile.to_json(profile_path))
+        return ShardResult(
+            key,
+            DONE,
+            len(engine.results),
+            os.path.relpath(path, output),
+            time.perf_counter() - start,
+            profiling.peak_rss(),
+            None,
+        )
+    except Exception:
+        return _failed(shard, traceback.format_exc(), time.perf_counter() - start)
+
+
+def _failed(shard, error, elapsed=None):
+    return ShardResult(_shard_key(shard), FAILED, None, None, elapsed, None, error)
+
+
+def _shard_key(shard):
+    return f"{shard.date.isoformat()}/{shard.group}"
+
+
+def _book_groups(book_ids, book_groups, group_size):
+    if book_groups is not None:
+        if isinstance(book_groups, dict):
+            return {str(name): [str(book) for book in books] for name, books in book_groups.items()}
+        groups = [[str(book) for book in books] for books in book_groups]
+    else:
+        books = [str(book) for book in book_ids]
+        size = group_size or len(books)
+        groups = [books[index : index + size] for index in range(0, len(books), size)]
+    return {book_group_name(books): books for books in groups}
+
+
+def _parquet_frame(frame):
+    """see (c) ... enums by name, columns parquet can't hold as one type as strings"""
+    frame = frame.copy()
+    for column in frame.columns:
+        if frame[column].dtype != object:
+            continue
+        try:
+            pa.array(frame[column])
+            continue
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            pass
+        values = frame[column].map(lambda value: value.name if isinstance(value, Enum) else value)
+        try:
+            pa.array(values)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            values = values.map(lambda value: value if value is None else str(value))
+        frame[column] = values
+    return frame
+
+
+def _write_parquet(frame, path):
+    pq.write_table(pa.Table.from_pandas(frame, preserve_index=False), path)
+
+
+def _dump_json(value, path):
+    with open(path, "w") as file:
+        json.dump(value, file, indent=1, sort_keys=True, default=str)
+
+
+def _write_atomic(path, write):
+    """write(temp_path) then rename over path"""
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    descriptor, temp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    os.close(descriptor)
+    try:
+        write(temp_path)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def _available_memory():
+    """MemAvailable in bytes (None off Linux)"""
+    try:
+        with open("/proc/meminfo") as meminfo:
+            for line in meminfo:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the engine over a date range & book universe")
+    parser.add_argument("--output", required=True, help="root of the partitioned output dataset")
+    parser.add_argument("--start", help="first date (YYYY-MM-DD)")
+    parser.add_argument("--end", help="last date (YYYY-MM-DD), default: start")
+    parser.add_argument("--dates", default=None, help="comma separated dates instead of --start/--end")
+    parser.add_argument("--books", required=True, help="comma separated book ids")
+    parser.add_argument("--group-size", type=int, default=None, help="books per shard, default: all")
+    parser.add_argument("--config", default=None, help="JSON file with the Engine config")
+    parser.add_argument("--mode", default="passive_analysis")
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--memory-per-shard-gb", type=float, default=4)
+    parser.add_argument("--min-free-memory-gb", type=float, default=1)
+    parser.add_argument("--overwrite", action="store_true", help="rerun shards that are already done")
+    arguments = parser.parse_args()
+
+    if arguments.dates:
+        batch_dates = arguments.dates.split(",")
+    elif arguments.start:
+        batch_dates = business_dates(arguments.start, arguments.end or arguments.start)
+    else:
+        parser.error("give --start (& --end) or --dates")
+    batch_config = {}
+    if arguments.config:
+        with open(arguments.config) as config_file:
+            batch_config = json.load(config_file)
+
+    runner = BatchRunner(
+        arguments.output,
+        batch_dates,
+        book_ids=arguments.books.split(","),
+        group_size=arguments.group_size,
+        config=batch_config,
+        mode=arguments.mode,
+        max_workers=arguments.workers,
+        memory_per_shard=int(arguments.memory_per_shard_gb * 1024**3),
+        min_free_memory=int(arguments.min_free_memory_gb * 1024**3),
+        overwrite=arguments.overwrite,
+    )
+    print(runner.run().to_string(index=False))
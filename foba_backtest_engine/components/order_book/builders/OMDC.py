@@ -1,7 +1,11 @@
+import os
+import tempfile
 import warnings
+from itertools import chain
 
 from foba_backtest_engine.components.order_book.utils import enums
 from foba_backtest_engine.components.order_book.utils.foba_events import FobaEvent
+from foba_backtest_engine.components.order_book.utils.foba_feedupdates import FeedUpdateCursor
 from foba_backtest_engine.components.order_book.utils.foba_levels import (
     LevelManager,
 )
@@ -10,10 +14,18 @@ from foba_backtest_engine.components.order_book.utils.foba_order import (
     OrderManager,
 )
 from foba_backtest_engine.components.order_book.utils.foba_states import (
+    FEED_STATE_DTYPES,
+    ORDER_COUNT_STATE_DTYPES,
     FeedState,
     OrderCountState,
+    snapshot_fields,
 )
 from foba_backtest_engine.components.order_book.utils.order_queue import OrderQueue
+from foba_backtest_engine.components.order_book.utils.state_recorder import (
+    ChangeStateRecorder,
+    StateRecorder,
+)
+from foba_backtest_engine.utils.spill_list import SpillList
 
 """
 OMDC Book Builder
@@ -24,8 +36,8 @@ a) Structure
     - bids & asks are handled by the OrderManager ... these stores orders in a hash-map {order_number : Order (obj)}
     
     - bid_levels & ask_levels are handled by the LevelManager  
-        ... the level prices are stored in a deque (sorted)
-        ... each price maps to a Level object which stored our orders in a list maintained according to FIFO
+        ... the level prices are stored in a sorted list (best first)
+        ... each price maps to a Level object which stored our orders in FIFO order
         ... the orders are stored as Order objects w/ various attributes
 
     - order_queues ... are handled by the OrderQueue class
@@ -43,29 +55,101 @@ b) Methods/execution flow
     - We store rows from these dataframes as FeedUpdate_ objects & use this as a "standardized" input into our OmdcBookBuilder engine
 
     We have the update method that parses FeedUpdate_ rows & routes it to further processors that deal w/ different event types
+    ... update_columns does the same for a whole FeedUpdateColumns w/o a FeedUpdate per row (int command codes)
+
+c) Snapshots (feed_states & order_count_states)
+    - snapshot_depth ... number of levels per side that are filled (1-5), deeper levels are None
+        ... the StateRecorders only store the snapshot_depth levels (snapshot_fields), the deeper ones read as None
+    - snapshot_mode
+        ... "every_message" - a FeedState & OrderCountState stored after every message
+        ... "on_change" - a state is only stored when the visible top snapshot_depth levels changed (or for a trade),
+            every other message only stores its times & points at the last state (ChangeStateRecorder)
+            the states still read as one per message, exactly as "every_message" ... slippages, bbov & lifetime
+            windows see the same states, only the memory is smaller. Needs the StateRecorders (no spill_directory)
     
 """
 
+SNAPSHOT_DEPTH = 5
+SNAPSHOT_MODES = ("every_message", "on_change")
+
+# int codes of the commands update_columns dispatches on
+ADD = enums.Command.ADD.value
+UPDATE = enums.Command.UPDATE.value
+DELETE = enums.Command.DELETE.value
+
 
 class OmdcBookBuilder:
-    def __init__(self, book_id, **kwargs):
+    def __init__(
+        self,
+        book_id,
+        spill_directory=None,
+        snapshot_depth=SNAPSHOT_DEPTH,
+        snapshot_mode="every_message",
+        **kwargs,
+    ):
+        """
+        :param spill_directory: if given the per-message outputs (feed_states, order_count_states & order queue
+            snapshots) are SpillLists in this directory instead of in-memory lists ... trades/pulls stay in memory
+            ... otherwise feed_states & order_count_states are columnar StateRecorders
+        :param snapshot_depth: levels per side filled in the feed/order count states (1-5)
+        :param snapshot_mode: "every_message" | "on_change" ... see c) Snapshots
+        """
+        if not 1 <= snapshot_depth <= SNAPSHOT_DEPTH:
+            raise ValueError(f"snapshot_depth must be between 1 and {SNAPSHOT_DEPTH}, got {snapshot_depth}")
+        if snapshot_mode not in SNAPSHOT_MODES:
+            raise ValueError(f"snapshot_mode must be one of {SNAPSHOT_MODES}, got {snapshot_mode!r}")
+        if snapshot_mode == "on_change" and spill_directory is not None:
+            raise ValueError('snapshot_mode="on_change" needs the in-memory StateRecorders, not a spill_directory')
         self.book = book_id
+        self.snapshot_depth = snapshot_depth
+        self.snapshot_on_change = snapshot_mode == "on_change"
+        # the levels deeper than snapshot_depth (price|count, volume) ... always None, only the full records of the
+        # SpillLists have them, the StateRecorders don't store them
+        self._padding = () if spill_directory is None else (None, None) * (SNAPSHOT_DEPTH - snapshot_depth)
+        self._last_visible_levels = None
+        self._last_visible_counts = None
         self.bids = OrderManager()
         self.asks = OrderManager()
         self.bid_levels = LevelManager(is_bid=True)
         self.ask_levels = LevelManager(is_bid=False)
 
         self.persist_order_queue = True
-        self.bid_order_queue = OrderQueue(bid_side=True)
-        self.ask_order_queue = OrderQueue(bid_side=False)
+        self.bid_order_queue = OrderQueue(
+            bid_side=True, order_queue=self._state_list(spill_directory, "bid_order_queue")
+        )
+        self.ask_order_queue = OrderQueue(
+            bid_side=False, order_queue=self._state_list(spill_directory, "ask_order_queue")
+        )
 
         self.trades = []
         self.pulls = []
 
-        self.feed_states = []
-        self.order_count_states = []
+        recorder = ChangeStateRecorder if self.snapshot_on_change else StateRecorder
+        self.feed_states = self._state_list(
+            spill_directory,
+            "feed_states",
+            recorder(FeedState, FEED_STATE_DTYPES, fields=snapshot_fields(FeedState, snapshot_depth)),
+        )
+        self.order_count_states = self._state_list(
+            spill_directory,
+            "order_count_states",
+            recorder(
+                OrderCountState,
+                ORDER_COUNT_STATE_DTYPES,
+                fields=snapshot_fields(OrderCountState, snapshot_depth),
+            ),
+        )
         self.event_trades = []
 
+    def _state_list(self, spill_directory, name, in_memory=None):
+        if spill_directory is None:
+            return [] if in_memory is None else in_memory
+        file_descriptor, path = tempfile.mkstemp(
+            prefix=f"{self.book}_{name}_", suffix=".pkl", dir=spill_directory
+        )
+        os.close(file_descriptor)
+        return SpillList(path)
+
     def total_traded_volume(self):
         return sum([t.trade_volume for t in self.trades])
 
@@ -75,17 +159,54 @@ class OmdcBookBuilder:
         :param message: The FeedUpdate row.  See db_to_feed_update.
         :return:
         """
-        is_bid = message.side == enums.Side.BID
+        self._apply(message, message.command.value)
+
+    def update_columns(self, feed_updates):
+        """
+        update() for every row of a FeedUpdateColumns (in its order) w/o a FeedUpdate per message ... one
+        FeedUpdateCursor is moved over the python values of each chunk & the commands are dispatched on their int codes
+        :param feed_updates: FeedUpdateColumns of this book
+        """
+        message = FeedUpdateCursor()
+        for start in range(0, len(feed_updates), feed_updates.chunk_size):
+            stop = min(start + feed_updates.chunk_size, len(feed_updates))
+            commands = feed_updates.columns["command"][start:stop].tolist()
+            for command, values in zip(commands, zip(*feed_updates.python_values(start, stop))):
+                (
+                    message.received,
+                    message.created,
+                    message.timestamp,
+                    message.command,
+                    message.side,
+                    message.book,
+                    message.order_number,
+                    message.change_reason,
+                    message.price,
+                    message.volume,
+                    message.inferred,
+                    message.aggressor_order_number,
+                    message.sequence_number,
+                ) = values
+                try:
+                    self._apply(message, command)
+                except Exception as exception:
+                    raise Exception(
+                        f"Exception while processing feed update: {message.feed_update()}"
+                    ) from exception
+
+    def _apply(self, message, command):
+        """:param command: int code of message.command (see enums.Command)"""
+        is_bid = message.side is enums.Side.BID
         order_manager = self.bids if is_bid else self.asks
         level_manager = self.bid_levels if is_bid else self.ask_levels
         is_trade = message.change_reason == 3
         is_multi_trade_end = message.inferred == 1 and len(self.event_trades) > 0
 
-        if message.command == enums.Command.ADD:
+        if command == ADD:
             self.update_add(message, order_manager, level_manager, is_multi_trade_end)
-        elif message.command == enums.Command.DELETE:
+        elif command == DELETE:
             self.update_delete(message, order_manager, level_manager, is_trade)
-        elif message.command == enums.Command.UPDATE:
+        elif command == UPDATE:
             if message.order_number not in order_manager.orders:
                 self.update_add(message, order_manager, level_manager, False)
             self.update_update(message, order_manager, level_manager, is_trade)
@@ -252,9 +373,16 @@ class OmdcBookBuilder:
         level_manager.enrich_open_levels_with_pull(pull, order_manager)
 
     def append_feed_state(self, message, is_trade):
-        retail_bids = self.bid_levels.get_levels(5)
-        retail_asks = self.ask_levels.get_levels(5)
+        retail_bids = self.bid_levels.get_levels(self.snapshot_depth)
+        retail_asks = self.ask_levels.get_levels(self.snapshot_depth)
+        if self.snapshot_on_change and not is_trade:
+            if (retail_bids, retail_asks) == self._last_visible_levels:
+                self.feed_states.repeat_row(message.created, message.received, message.timestamp)
+                return
+            self._last_visible_levels = (retail_bids, retail_asks)
         if is_trade:
+            # the next non-trade message can't repeat the trade's state
+            self._last_visible_levels = None
             price_ = self.trades[-1].trade_price
             volume_ = self.trades[-1].trade_volume
             foreignLd_aggressorSide_ = "S" if message.side is enums.Side.BID else "B"
@@ -265,70 +393,51 @@ class OmdcBookBuilder:
             foreignLd_aggressorSide_ = " "
             isTrade_ = 0
 
-        feed_state = FeedState(
-            bookId_=message.book,
-            createdNanos_=message.created,
-            received_=message.received,
-            timestamp_=message.timestamp,
-            bids_0_price_=retail_bids[0][0],
-            bids_0_volume_=retail_bids[0][1],
-            bids_1_price_=retail_bids[1][0],
-            bids_1_volume_=retail_bids[1][1],
-            bids_2_price_=retail_bids[2][0],
-            bids_2_volume_=retail_bids[2][1],
-            bids_3_price_=retail_bids[3][0],
-            bids_3_volume_=retail_bids[3][1],
-            bids_4_price_=retail_bids[4][0],
-            bids_4_volume_=retail_bids[4][1],
-            asks_0_price_=retail_asks[0][0],
-            asks_0_volume_=retail_asks[0][1],
-            asks_1_price_=retail_asks[1][0],
-            asks_1_volume_=retail_asks[1][1],
-            asks_2_price_=retail_asks[2][0],
-            asks_2_volume_=retail_asks[2][1],
-            asks_3_price_=retail_asks[3][0],
-            asks_3_volume_=retail_asks[3][1],
-            asks_4_price_=retail_asks[4][0],
-            asks_4_volume_=retail_asks[4][1],
-            price_=price_,
-            volume_=volume_,
-            foreignLd_aggressorSide_=foreignLd_aggressorSide_,
-            isTrade_=isTrade_,
+        # FeedState fields in order ... bids_{0-4}_price_/volume_, then asks_{0-4}_price_/volume_
+        self._append_state(
+            self.feed_states,
+            FeedState,
+            message.book,
+            message.created,
+            message.received,
+            message.timestamp,
+            *chain.from_iterable(retail_bids),
+            *self._padding,
+            *chain.from_iterable(retail_asks),
+            *self._padding,
+            price_,
+            volume_,
+            foreignLd_aggressorSide_,
+            isTrade_,
         )
 
-        self.feed_states.append(feed_state)
-
     def append_order_count_state(self, message):
-        retail_bids = self.bid_levels.get_count_on_levels(5)
-        retail_asks = self.ask_levels.get_count_on_levels(5)
-        order_count_state = OrderCountState(
-            bookId_=message.book,
-            createdNanos_=message.created,
-            received_=message.received,
-            timestamp_=message.timestamp,
-            bids_0_count_=retail_bids[0][0],
-            bids_0_max_volume_=retail_bids[0][1],
-            bids_1_count_=retail_bids[1][0],
-            bids_1_max_volume_=retail_bids[1][1],
-            bids_2_count_=retail_bids[2][0],
-            bids_2_max_volume_=retail_bids[2][1],
-            bids_3_count_=retail_bids[3][0],
-            bids_3_max_volume_=retail_bids[3][1],
-            bids_4_count_=retail_bids[4][0],
-            bids_4_max_volume_=retail_bids[4][1],
-            asks_0_count_=retail_asks[0][0],
-            asks_0_max_volume_=retail_asks[0][1],
-            asks_1_count_=retail_asks[1][0],
-            asks_1_max_volume_=retail_asks[1][1],
-            asks_2_count_=retail_asks[2][0],
-            asks_2_max_volume_=retail_asks[2][1],
-            asks_3_count_=retail_asks[3][0],
-            asks_3_max_volume_=retail_asks[3][1],
-            asks_4_count_=retail_asks[4][0],
-            asks_4_max_volume_=retail_asks[4][1],
-            isTrade_=0,
+        retail_bids = self.bid_levels.get_count_on_levels(self.snapshot_depth)
+        retail_asks = self.ask_levels.get_count_on_levels(self.snapshot_depth)
+        if self.snapshot_on_change:
+            if (retail_bids, retail_asks) == self._last_visible_counts:
+                self.order_count_states.repeat_row(message.created, message.received, message.timestamp)
+                return
+            self._last_visible_counts = (retail_bids, retail_asks)
+        # OrderCountState fields in order ... bids_i_count_/max_volume_ & asks_i_count_/max_volume_ per level i
+        self._append_state(
+            self.order_count_states,
+            OrderCountState,
+            message.book,
+            message.created,
+            message.received,
+            message.timestamp,
+            *chain.from_iterable(bid + ask for bid, ask in zip(retail_bids, retail_asks)),
+            *self._padding,
+            *self._padding,
+            0,
         )
-        self.order_count_states.append(order_count_state)
+
+    def _append_state(self, states, record_type, *values):
+        if isinstance(states, StateRecorder):
+            states.append_row(*values)
+        else:
+            states.append(record_type._make(values))
 
     def update_event_trades(self):
         aggressor_volume = sum([t.trade_volume for t in self.event_trades])
@@ -1,3 +1,5 @@
+import os
+import tempfile
 import traceback
 from collections import defaultdict
 from enum import Enum
@@ -6,26 +8,147 @@ import pandas as pd
 from foba_backtest_engine.components.order_book.builders.OMDC import OmdcBookBuilder
 from foba_backtest_engine.components.order_book.utils import enums
 from foba_backtest_engine.components.order_book.utils.foba_feedupdates import (
+    FeedFileSlice,
+    FeedUpdateColumns,
     get_feed_updates,
+    iter_feed_update_batches,
+    read_feed_slice,
+    write_feed_file,
 )
+from foba_backtest_engine.components.order_book.utils.foba_slippages import book_slippages
 from foba_backtest_engine.utils import futures
 from foba_backtest_engine.utils.base_utils import get_logger
+from foba_backtest_engine.utils.spill_list import SpillList
 
 """
 MULTIBOOKBUILDER CLASS
 
 This is a core class that manages execution of multiple OmdcBookBuilders for different securityCode_ (books)
 i)  We can pass in feedUpdate objects (using @Provide) or this will pull in feed
-ii) If parallel = True ... we will split the feed above based on securityCode_ across various workers
+        ... the pulled feed is a FeedUpdateColumns (struct-of-arrays) & goes book by book through
+            OmdcBookBuilder.update_columns (no FeedUpdate per row) ... feed updates passed in as rows still go
+            through update()
+ii) If parallel = True ... every book is built in its own worker (build_book)
+        ... feed_transport="storage" (default): the worker loads its own book from storage (nothing but the filter is
+            pickled to it), unless feed updates were passed in ... then those are split per book & pickled to it
+        ... feed_transport="memory_map": the feed (passed in, or read once here) is written to one Arrow IPC file in
+            spill_directory (see foba_feedupdates.write_feed_file) & a worker only gets its (path, offset, length) ...
+            the workers memory-map their slice, so the feed is neither pickled nor copied per worker
+        ... the builder itself never comes back: the worker returns a BookBuildResult with what the downstream
+            processors read (trades, pulls, the columnar feed/order count states & the order queues) + the book's
+            slippage frame when slippage_options are given (published as built_slippages, so annotate_slippages then
+            skips its own pass)
+        ... the result comes back pickled & is loaded with the cyclic GC paused (futures.unpickle_result)
+        ... books come back in the order of books (the filter's book_ids), whichever finishes first
 iii) once the books are built - we can extract trades, pull etc into pandas dataframes
+iv) If streaming = True ... the feed is never loaded up front
+        ... FeedUpdateColumns batches are pulled from iter_feed_update_batches (one book at a time) & pushed
+            through the builders
+        ... each builder spills its feed_states, order_count_states & order queue snapshots to SpillLists
+            (one temp file each) in spill_directory (default: the system temp dir), trades & pulls stay in memory
+        ... peak memory is ~ batch_size + live book state (+ trades/pulls) instead of the full day
 
 """
 
 
-def process_book_events(book, events, book_id):
-    for fu in events:
-        book.update(fu)
-    return book_id, book
+def build_book(
+    book_builder, exchange, filter, book_id, builder_options, slippage_options=None, events=None
+):
+    """
+    Worker of the parallel build ... builds one book & returns (book_id, BookBuildResult | None if it has no feed)
+    :param events: the book's feed updates | its FeedFileSlice ... loaded here (only this book) if None
+    """
+    if events is None:
+        events = get_feed_updates(exchange, filter=filter._replace(book_ids=[book_id]))
+    elif isinstance(events, FeedFileSlice):
+        events = read_feed_slice(events)
+    book = None
+    if len(events):
+        book = book_builder(_first_book(events), **builder_options)
+        _update_book(book, events)
+    del events
+    if book is None:
+        return book_id, None
+    return book_id, BookBuildResult(book, slippage_options)
+
+
+class BookBuildResult:
+    """
+    What the parallel build sends back per book instead of the OmdcBookBuilder (no orders, levels or managers) ...
+    the attributes the downstream processors read, so it stands in for the builder in pybuilders.
+    slippages ... foba_slippages.book_slippages of the feed states computed w/ slippage_options (None w/o options)
+    """
+
+    def __init__(self, builder, slippage_options=None):
+        self.book = builder.book
+        self.trades = builder.trades
+        self.pulls = builder.pulls
+        self.feed_states = builder.feed_states
+        self.order_count_states = builder.order_count_states
+        self.bid_order_queue = builder.bid_order_queue
+        self.ask_order_queue = builder.ask_order_queue
+        self.slippage_options = slippage_options
+        self.slippages = None
+        if slippage_options is not None and len(self.feed_states):
+            self.slippages = book_slippages(
+                self.feed_states.to_frame(), self.book, **slippage_options
+            )
+
+
+def stream_book_events(
+    book_builder,
+    exchange,
+    filter,
+    book_id,
+    batch_size,
+    spill_directory,
+    builder_options,
+    hand_over=False,
+):
+    """
+    Worker of the parallel streaming build ... streams one book into a builder w/ spilled states & returns
+    (book_id, BookBuildResult | None if it has no feed)
+    :param hand_over: the result is sent to another process (e.g. a process pool task's return value) ... its copy
+        then owns the spill files, as this one is gone once the task is done. False when the caller keeps the result
+    """
+    book = None
+    for book_key, batch in iter_feed_update_batches(
+        exchange, filter, book_ids=[book_id], batch_size=batch_size
+    ):
+        if book is None:
+            book = book_builder(book_key, spill_directory=spill_directory, **builder_options)
+        book.update_columns(batch)
+    # states are in spill files ... the slippages are left to annotate_slippages
+    if book is None:
+        return book_id, None
+    result = BookBuildResult(book)
+    if not hand_over:
+        return book_id, result
+    for states in (
+        result.feed_states,
+        result.order_count_states,
+        result.bid_order_queue.order_queue,
+        result.ask_order_queue.order_queue,
+    ):
+        if isinstance(states, SpillList):
+            states.hand_over()
+    return book_id, result
+
+
+FEED_TRANSPORTS = ("storage", "memory_map")
+
+
+def _first_book(events):
+    return next(iter(events.rows(0, 1) if isinstance(events, FeedUpdateColumns) else events)).book
+
+
+def _update_book(book, events):
+    """a FeedUpdateColumns goes through update_columns (no FeedUpdate per row), anything else row by row"""
+    if isinstance(events, FeedUpdateColumns):
+        book.update_columns(events)
+    else:
+        for fu in events:
+            book.update(fu)
 
 
 class MultiBookBuilder:
@@ -41,7 +164,21 @@ class MultiBookBuilder:
         log_triggers=False,
         feed_updates=None,
         filter=None,
+        streaming=False,
+        batch_size=100_000,
+        spill_directory=None,
+        snapshot_depth=5,
+        snapshot_mode="every_message",
+        slippage_options=None,
+        feed_transport="storage",
     ):
+        """
+        :param slippage_options: kwargs of foba_slippages.book_slippages ... the parallel build computes each book's
+            slippages in its worker (ignored otherwise)
+        :param feed_transport: "storage" | "memory_map" ... how the parallel build gets the feed to its workers (see ii)
+        """
+        if feed_transport not in FEED_TRANSPORTS:
+            raise ValueError(f"feed_transport must be one of {FEED_TRANSPORTS}, got {feed_transport!r}")
         self.exchange = exchange
         self.books_string = books
         self.start = start
@@ -54,17 +191,31 @@ class MultiBookBuilder:
         self.log_triggers = log_triggers
         self.filter = filter
 
+        self.streaming = streaming
+        self.batch_size = batch_size
+        self.spill_directory = spill_directory
+        # passed to every book builder, whichever way the books are built ... see OmdcBookBuilder c) Snapshots
+        self.builder_options = dict(
+            log_triggers=log_triggers,
+            trade_change_reason=False,
+            snapshot_depth=snapshot_depth,
+            snapshot_mode=snapshot_mode,
+        )
+        self.slippage_options = slippage_options
+        self.feed_transport = feed_transport
+
+        # loaded by build_books ... the parallel build leaves the loading to its workers
+        self.feed_updates = feed_updates
         self.feed_updates_final = []
         self.unconsolidated_lds = []
         self.aggressive_ose_volumes = None
-        self.get_feed_updates_final(feed_updates)
 
         self.optiver_only = optiver_only
         self.optiver_order_numbers = set(optiver_order_numbers)
 
     def get_feed_updates_final(self, feed_updates):
         """
-        Needs to be run to get all the feed updates for a given set of books. Run by default on creation.
+        Needs to be run to get all the feed updates for a given set of books. Run by build_books (not in parallel).
         :return:
         """
         if not feed_updates:
@@ -76,8 +227,6 @@ class MultiBookBuilder:
             self.feed_updates_final = feed_updates
 
     def build_books(self, parallel=False, max_workers=5):
-        log_triggers = self.log_triggers
-        trade_change_reason = False
         if self.exchange == enums.Exchange.OMDC:
             book_builder = OmdcBookBuilder
         else:
@@ -86,6 +235,10 @@ class MultiBookBuilder:
             )
 
         self.logger.debug("build_books using " + book_builder.__name__ + ": Started")
+        if self.streaming:
+            self.stream_books(book_builder, parallel, max_workers)
+            self.logger.debug("build_books using " + book_builder.__name__ + ": Completed")
+            return
         self.logger.debug(
             "build_books using "
             + book_builder.__name__
@@ -94,7 +247,12 @@ class MultiBookBuilder:
             + "-"
             + self.end
         )
+        if parallel:
+            self.build_books_parallel(book_builder, max_workers)
+            self.logger.debug("build_books using " + book_builder.__name__ + ": Completed")
+            return
 
+        self.get_feed_updates_final(self.feed_updates)
         feed_update_count = len(self.feed_updates_final)
         self.logger.debug(
             "build_books using "
@@ -106,73 +264,182 @@ class MultiBookBuilder:
         progress_percent = 0.1
         processed_count = 0
 
-        if not parallel:
-            for fu in self.feed_updates_final:
-                if ~self.optiver_only or fu.order_number in self.optiver_order_numbers:
-                    try:
-                        if fu.book not in self.books.keys():
-                            self.books[fu.book] = book_builder(
-                                fu.book,
-                                log_triggers=log_triggers,
-                                trade_change_reason=trade_change_reason,
-                            )
-                        self.books[fu.book].update(fu)
-                    except Exception as exception:
-                        traceback.print_exception(
-                            type(exception), exception, exception.__traceback__
-                        )
-                        raise Exception(
-                            f"Exception while processing feed update: {fu}"
-                        ) from exception
-
-                    processed_count += 1
-                    if processed_count / feed_update_count >= progress_percent:
-                        self.logger.debug(
-                            "build_books using "
-                            + book_builder.__name__
-                            + ": Percent Complete - "
-                            + str(round(progress_percent, 1))
-                        )
-                        progress_percent += 0.1
-        else:
-            self.logger.debug("BUILDING BOOK IN PARALLEL")
-            book_processed_count = 0
-            per_book_feed_updates = defaultdict(list)
-            for fu in self.feed_updates_final:
-                if ~self.optiver_only or fu.order_number in self.optiver_order_numbers:
-                    per_book_feed_updates[fu.book].append(fu)
-            num_books = len(per_book_feed_updates)
-
-            exchange = self.exchange
-            with futures.make_executor(
-                parallel=parallel, max_workers=max_workers
-            ) as executor:
-
-                def book_event_futures():
-                    for book_id, events in per_book_feed_updates.items():
-                        book = book_builder(
-                            book_id,
-                            log_triggers=log_triggers,
-                            trade_change_reason=trade_change_reason,
-                        )
-                        yield executor.submit(
-                            process_book_events, book, events, book_id
-                        )
-
-                for future in futures.as_completed(book_event_futures()):
-                    book_processed_count += 1
-                    if book_processed_count / num_books >= progress_percent:
-                        self.logger.debug(
-                            "build_books using "
-                            + book_builder.__name__
-                            + ": Percent Complete - "
-                            + str(round(progress_percent, 1))
-                        )
-                        progress_percent += 0.1
-                    book_id, book = future.result()
-                    self.books[book_id] = book
+        if isinstance(self.feed_updates_final, FeedUpdateColumns):
+            # book by book through update_columns ... books are independent, so this is the same as the feed order
+            for book_id, book_feed_updates in self.feed_updates_final.iter_books():
+                self.books[book_id] = book_builder(book_id, **self.builder_options)
+                try:
+                    self.books[book_id].update_columns(book_feed_updates)
+                except Exception as exception:
+                    traceback.print_exception(
+                        type(exception), exception, exception.__traceback__
+                    )
+                    raise
+                processed_count += len(book_feed_updates)
+                self.logger.debug(
+                    "build_books using "
+                    + book_builder.__name__
+                    + ": Percent Complete - "
+                    + str(round(processed_count / feed_update_count, 1))
+                )
+            self.logger.debug("build_books using " + book_builder.__name__ + ": Completed")
+            return
+
+        for fu in self.feed_updates_final:
+            if ~self.optiver_only or fu.order_number in self.optiver_order_numbers:
+                try:
+                    if fu.book not in self.books.keys():
+                        self.books[fu.book] = book_builder(fu.book, **self.builder_options)
+                    self.books[fu.book].update(fu)
+                except Exception as exception:
+                    traceback.print_exception(
+                        type(exception), exception, exception.__traceback__
+                    )
+                    raise Exception(
+                        f"Exception while processing feed update: {fu}"
+                    ) from exception
+
+                processed_count += 1
+                if processed_count / feed_update_count >= progress_percent:
+                    self.logger.debug(
+                        "build_books using "
+                        + book_builder.__name__
+                        + ": Percent Complete - "
+                        + str(round(progress_percent, 1))
+                    )
+                    progress_percent += 0.1
         self.logger.debug("build_books using " + book_builder.__name__ + ": Completed")
 
+    def build_books_parallel(self, book_builder, max_workers=5):
+        self.logger.debug("BUILDING BOOK IN PARALLEL")
+        feed_file = None
+        if self.feed_transport == "memory_map":
+            feed_updates = self.feed_updates
+            if not feed_updates:
+                feed_updates = get_feed_updates(self.exchange, filter=self.filter)
+            if isinstance(feed_updates, FeedUpdateColumns):
+                feed_file = self._feed_file_path()
+                self.logger.debug("BUILDING BOOK IN PARALLEL: memory-mapping the feed from " + feed_file)
+                per_book_feed_updates = write_feed_file(feed_updates, feed_file)
+            else:
+                self.logger.warning("feed_transport='memory_map' needs a FeedUpdateColumns ... pickling the feed")
+                per_book_feed_updates = self._split_feed_updates(feed_updates)
+            del feed_updates
+        elif self.feed_updates:
+            # passed in ... split per book & sent along
+            per_book_feed_updates = self._split_feed_updates(self.feed_updates)
+        else:
+            # the workers load their own book
+            per_book_feed_updates = dict.fromkeys(self.books_string)
+        try:
+            self._build_books_in_workers(book_builder, per_book_feed_updates, max_workers)
+        finally:
+            if feed_file is not None:
+                os.remove(feed_file)
+
+    def _build_books_in_workers(self, book_builder, per_book_feed_updates, max_workers):
+        num_books = len(per_book_feed_updates)
+
+        progress_percent = 0.1
+        book_processed_count = 0
+        with futures.make_executor(parallel=True, max_workers=max_workers) as executor:
+            book_futures = [
+                executor.submit(
+                    futures.PicklingFunction(build_book),
+                    book_builder,
+                    self.exchange,
+                    self.filter,
+                    book_id,
+                    self.builder_options,
+                    self.slippage_options,
+                    events,
+                )
+                for book_id, events in per_book_feed_updates.items()
+            ]
+            for future in futures.as_completed(book_futures):
+                book_processed_count += 1
+                if book_processed_count / num_books >= progress_percent:
+                    self.logger.debug(
+                        "build_books using "
+                        + book_builder.__name__
+                        + ": Percent Complete - "
+                        + str(round(progress_percent, 1))
+                    )
+                    progress_percent += 0.1
+        for future in book_futures:
+            book_id, result = futures.unpickle_result(future.result())
+            if result is not None:
+                self.books[result.book] = result
+
+    def _split_feed_updates(self, feed_updates):
+        if isinstance(feed_updates, FeedUpdateColumns):
+            return feed_updates.by_book()
+        per_book_feed_updates = defaultdict(list)
+        for fu in feed_updates:
+            per_book_feed_updates[fu.book].append(fu)
+        return per_book_feed_updates
+
+    def _feed_file_path(self):
+        file_descriptor, path = tempfile.mkstemp(
+            prefix="feed_", suffix=".arrow", dir=self._spill_directory()
+        )
+        os.close(file_descriptor)
+        return path
+
+    def _spill_directory(self):
+        return self.spill_directory if self.spill_directory is not None else tempfile.gettempdir()
+
+    def stream_books(self, book_builder, parallel=False, max_workers=5):
+        spill_directory = self._spill_directory()
+        self.logger.debug(
+            "stream_books using " + book_builder.__name__ + ": spilling states to " + spill_directory
+        )
+        if not parallel:
+            batch_count = 0
+            for book_id, batch in iter_feed_update_batches(
+                self.exchange, self.filter, batch_size=self.batch_size
+            ):
+                if book_id not in self.books:
+                    self.books[book_id] = book_builder(
+                        book_id, spill_directory=spill_directory, **self.builder_options
+                    )
+                try:
+                    self.books[book_id].update_columns(batch)
+                except Exception as exception:
+                    traceback.print_exception(
+                        type(exception), exception, exception.__traceback__
+                    )
+                    raise
+                batch_count += 1
+                self.logger.debug(
+                    "stream_books using "
+                    + book_builder.__name__
+                    + ": batches processed - "
+                    + repr(batch_count)
+                )
+            return
+
+        self.logger.debug("STREAMING BOOKS IN PARALLEL")
+        with futures.make_executor(parallel=parallel, max_workers=max_workers) as executor:
+            book_futures = [
+                executor.submit(
+                    stream_book_events,
+                    book_builder,
+                    self.exchange,
+                    self.filter,
+                    book_id,
+                    self.batch_size,
+                    spill_directory,
+                    self.builder_options,
+                    hand_over=parallel,
+                )
+                for book_id in self.books_string
+            ]
+            for future in futures.as_completed(book_futures):
+                book_id, book = future.result()
+                if book is not None:
+                    self.books[book.book] = book
+
     def get_result_as_df(self, include_etfs=None, include_pulls=False):
         all_events = []
         for b in self.books:
@@ -10,18 +10,47 @@ def pybuilders(
     pybuilder_exchange,
     filter,
     book_build_parallel=False,
+    book_build_feed_transport="storage",
     max_workers=5,
     optiver_only=False,
     optiver_order_numbers=(),
+    book_build_streaming=False,
+    stream_batch_size=100_000,
+    spill_directory=None,
+    snapshot_depth=5,
+    snapshot_mode="every_message",
+    pnl_slippage_times=None,
+    exclude_lunch=True,
+    bbov_weights=[1, 6, 6, 1],
+    smooth_bbov_alpha=0.10,
+    bbov_interval_s=10,
 ):
     """
     Pulls data from FeedUpdates_ and builds the books using the python book builder/
     The pybuilders contain foba data and feed states, among other properties.
     :param pybuilder_exchange: foba_backtest_engine.components.order_book.utils.enums.Exchange
     :param filter: Requires: book_ids, start_time, end_time
+    :param book_build_feed_transport: "storage" | "memory_map" ... how the parallel build gets the feed to its workers,
+        see MultiBookBuilder
+    :param book_build_streaming: stream the feed in batches of stream_batch_size & spill the per-message
+        states of each builder to disk (under spill_directory) ... see MultiBookBuilder
+    :param snapshot_depth: levels per side filled in the feed states (1-5)
+    :param snapshot_mode: "every_message" | "on_change" ... see OmdcBookBuilder
+    :param pnl_slippage_times: w/ book_build_parallel the workers also compute the slippages of their book (with this
+        & the other annotate_slippages parameters) ... the builders come back as BookBuildResults
     :return: @provides('pybuilders')
     """
 
+    slippage_options = None
+    if book_build_parallel and pnl_slippage_times is not None:
+        slippage_options = dict(
+            exclude_lunch=exclude_lunch,
+            pnl_slippage_times=pnl_slippage_times,
+            bbov_weights=bbov_weights,
+            smooth_bbov_alpha=smooth_bbov_alpha,
+            bbov_interval_s=bbov_interval_s,
+        )
+
     book_builder = MultiBookBuilder(
         exchange=pybuilder_exchange,
         books=filter.book_ids,
@@ -30,6 +59,13 @@ def pybuilders(
         optiver_only=optiver_only,
         optiver_order_numbers=optiver_order_numbers,
         filter=filter,
+        streaming=book_build_streaming,
+        batch_size=stream_batch_size,
+        spill_directory=spill_directory,
+        snapshot_depth=snapshot_depth,
+        snapshot_mode=snapshot_mode,
+        slippage_options=slippage_options,
+        feed_transport=book_build_feed_transport,
     )
     book_builder.build_books(book_build_parallel, max_workers)
 
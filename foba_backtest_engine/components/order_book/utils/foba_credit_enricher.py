@@ -2,19 +2,32 @@ from collections import namedtuple
 
 import numpy as np
 import pandas as pd
-from numba import njit
 
+from foba_backtest_engine.analysis_utils.calc_utils.range_min_max import RangeMinMax
 from foba_backtest_engine.components.order_book.utils.enums import Side
+from foba_backtest_engine.components.order_book.utils.state_recorder import states_frames
 from foba_backtest_engine.enrichment import enriches, provides
 from foba_backtest_engine.utils.base_utils import ImmutableDict
 
 
-@njit
-def compute_credits(midspots, rws, optiver_xgb_val, event_price, multiplier):
-    midspot_credits = multiplier * (midspots - event_price)
-    rws_credits = multiplier * (rws - event_price)
-    xgb_val_credits = multiplier * (optiver_xgb_val - event_price)
-    return midspot_credits, rws_credits, xgb_val_credits
+"""
+EVENT ENRICHMENT
+
+Lifetime credits of every FobaEvent ... min/max of midspot, rws & optiver_xgb_val over the feed states received in
+[max(avg_join_sent_time, 9:30), avg_event_sent_time] of its book, turned into credits against the event price
+
+i) per book index ... the feed states are read in chunks of whole books (states_frames, only LIFETIME_FIELDS), each
+   chunk sorted by (book, received_) once, a book is rows book_bounds[b]:book_bounds[b+1] of its chunk
+ii) a RangeMinMax (calc_utils/range_min_max.py) per book, built & dropped in turn (its tables grow w/ the book's rows,
+    so one over every book would hold them all at once), over the series that aren't all NaN in the book (an all NaN
+    series, e.g. optiver_xgb_val, has a NaN min & max in every window), each step batched over the book's events
+    - window ... [start, end] in the book's received_ (both ends inclusive, compared as float64 ... as the old per event
+      DataFrame slice did, a NaN start gives an empty window & a NaN end runs to the book's end)
+    - min/max ... sparse table lookups. A NaN in the window makes its min & max NaN (as np.min/np.max)
+iii) credits ... multiplier * (value - event_price) is monotone in value, so the max/min credit is the credit of the
+     max/min value (of the min/max value for an ASK) ... events w/o a book or feed state in the window get NaN
+
+"""
 
 
 EventEnrichment = namedtuple(
@@ -52,6 +65,17 @@ EventEnrichment = namedtuple(
 )
 
 
+# the feed state columns the lifetimes read
+LIFETIME_FIELDS = (
+    "bookId_",
+    "received_",
+    "bids_0_price_",
+    "bids_0_volume_",
+    "asks_0_price_",
+    "asks_0_volume_",
+)
+
+
 def fetch_optiver_val(length):
     return np.full((length, 1), np.nan)
 
@@ -75,106 +99,110 @@ def event_enricher(
 
         - find credit at event ... + bps/ticks
     """
-    feed_state_df = (
-        pd.DataFrame([record._asdict() for event_id, record in feed_states.items()])
-        .set_index(["bookId_", "received_"])
-        .sort_index()
+
+    """
+    To not get nonsense values ... we restrict the search time period to 9:30 - 16:00
+    """
+    start = filter.end_time.replace(hour=9, minute=30).float_timestamp * 1e9
+
+    event_ids = list(foba_events.keys())
+    events = list(foba_events.values())
+    sent_times = [send_times[event_id] for event_id in event_ids]
+    feeds = [full_feed_state_enrichment[event_id] for event_id in event_ids]
+    event_books = np.array([event.book_id for event in events], dtype=object)
+    starts = np.maximum(_float_array(sent_time.avg_join_sent_time for sent_time in sent_times), start)
+    ends = _float_array(sent_time.avg_event_sent_time for sent_time in sent_times)
+    event_prices = _float_array(event.event_price for event in events)
+    multipliers = np.array([1 if event.side == Side.BID else -1 for event in events], dtype=np.float64)
+    tick_sizes = _float_array(static_data_enrichment[event_id].tick_size for event_id in event_ids)
+    at_event = np.vstack(
+        (
+            _float_array(feed.midspot for feed in feeds),
+            _float_array(feed.rws for feed in feeds),
+            _float_array(feed.optiver_xgb_val for feed in feeds),
+        )
     )
 
-    feed_state_df["midspot"] = 0.5 * (
-        feed_state_df["bids_0_price_"] + feed_state_df["asks_0_price_"]
+    # a chunk of books at a time ... see i)
+    found = np.zeros(len(events), dtype=bool)
+    lifetime_max = np.full((len(at_event), len(events)), np.nan)
+    lifetime_min = np.full((len(at_event), len(events)), np.nan)
+    for states in states_frames(feed_states, fields=LIFETIME_FIELDS):
+        _chunk_lifetimes(states, event_books, starts, ends, found, lifetime_max, lifetime_min)
+
+    columns = []
+    is_bid = multipliers > 0
+    for series in range(len(at_event)):
+        max_credit = np.where(
+            is_bid, lifetime_max[series] - event_prices, -(lifetime_min[series] - event_prices)
+        )
+        min_credit = np.where(
+            is_bid, lifetime_min[series] - event_prices, -(lifetime_max[series] - event_prices)
+        )
+        columns += [
+            max_credit,
+            min_credit,
+            10000 * max_credit / event_prices,
+            10000 * min_credit / event_prices,
+            max_credit / tick_sizes,
+            min_credit / tick_sizes,
+        ]
+    for series in range(len(at_event)):
+        credit = multipliers * (at_event[series] - event_prices)
+        columns += [credit, 10000 * credit / event_prices, credit / tick_sizes]
+    columns = [np.where(found, column, np.nan).tolist() for column in columns]
+
+    book_ids = [event.book_id for event in events]
+    return ImmutableDict(
+        zip(event_ids, map(EventEnrichment._make, zip(book_ids, *columns)))
     )
-    feed_state_df["rws"] = (
-        feed_state_df["bids_0_price_"] * feed_state_df["asks_0_volume_"]
-        + feed_state_df["asks_0_price_"] * feed_state_df["bids_0_volume_"]
-    ) / (feed_state_df["bids_0_volume_"] + feed_state_df["asks_0_volume_"])
-    feed_state_df["optiver_xgb_val"] = fetch_optiver_val(len(feed_state_df))
 
-    start = filter.end_time.replace(hour=9, minute=30).float_timestamp * 1e9
 
-    def enriched_events():
-        for event_id, event in foba_events.items():
-            static_data = static_data_enrichment[event_id]
-            sent_time = send_times[event_id]
-            feed = full_feed_state_enrichment[event_id]
-
-            (
-                bookId,
-                event_price,
-                side,
-                avg_join_sent_time,
-                avg_event_sent_time,
-                tick_size,
-            ) = (
-                event.book_id,
-                event.event_price,
-                event.side,
-                sent_time.avg_join_sent_time,
-                sent_time.avg_event_sent_time,
-                static_data.tick_size,
-            )
-
-            """
-            To not get nonsense values ... we restrict the search time period to 9:30 - 16:00
-            """
-            try:
-                subset = feed_state_df.loc[bookId].loc[
-                    max(avg_join_sent_time, start) : avg_event_sent_time
-                ]
-            except:  # Deals w/ no key present issues
-                yield event_id, EventEnrichment(bookId, *(np.nan for _ in range(27)))
-                continue
-
-            if len(subset) == 0:
-                yield event_id, EventEnrichment(bookId, *(np.nan for _ in range(27)))
-                continue
-
-            midspots, rws, optiver_xgb_val = (
-                subset["midspot"].values,
-                subset["rws"].values,
-                subset["optiver_xgb_val"].values,
-            )
-            multiplier = 1 if side == Side.BID else -1
-
-            midspot_credits, rws_credits, xgb_val_credits = compute_credits(
-                midspots, rws, optiver_xgb_val, event_price, multiplier
-            )
-
-            credit_midspot_at_event = multiplier * (feed.midspot - event_price)
-            credit_rws_at_event = multiplier * (feed.rws - event_price)
-            credit_xgb_at_event = multiplier * (feed.optiver_xgb_val - event_price)
-
-            output = EventEnrichment(
-                bookId,
-                np.max(midspot_credits),
-                np.min(midspot_credits),
-                10000 * np.max(midspot_credits) / event_price,
-                10000 * np.min(midspot_credits) / event_price,
-                np.max(midspot_credits) / tick_size,
-                np.min(midspot_credits) / tick_size,
-                np.max(rws_credits),
-                np.min(rws_credits),
-                10000 * np.max(rws_credits) / event_price,
-                10000 * np.min(rws_credits) / event_price,
-                np.max(rws_credits) / tick_size,
-                np.min(rws_credits) / tick_size,
-                np.max(xgb_val_credits),
-                np.min(xgb_val_credits),
-                10000 * np.max(xgb_val_credits) / event_price,
-                10000 * np.min(xgb_val_credits) / event_price,
-                np.max(xgb_val_credits) / tick_size,
-                np.min(xgb_val_credits) / tick_size,
-                credit_midspot_at_event,
-                10000 * credit_midspot_at_event / event_price,
-                credit_midspot_at_event / tick_size,
-                credit_rws_at_event,
-                10000 * credit_rws_at_event / event_price,
-                credit_rws_at_event / tick_size,
-                credit_xgb_at_event,
-                10000 * credit_xgb_at_event / event_price,
-                credit_xgb_at_event / tick_size,
-            )
-            del subset
-            yield event_id, output
-
-    return ImmutableDict(enriched_events())
+"""
+HELPERS
+"""
+
+
+def _chunk_lifetimes(states, event_books, starts, ends, found, lifetime_max, lifetime_min):
+    """ii) for the events of the books of the states chunk ... fills their found, lifetime_max & lifetime_min"""
+    book_codes, books = pd.factorize(states["bookId_"])
+    received = states["received_"].to_numpy(dtype=np.float64)
+    order = np.lexsort((received, book_codes))
+    book_bounds = np.searchsorted(book_codes[order], np.arange(len(books) + 1))
+
+    midspots = 0.5 * (states["bids_0_price_"] + states["asks_0_price_"])
+    rws = (
+        states["bids_0_price_"] * states["asks_0_volume_"]
+        + states["asks_0_price_"] * states["bids_0_volume_"]
+    ) / (states["bids_0_volume_"] + states["asks_0_volume_"])
+    values = (
+        midspots.to_numpy(dtype=np.float64),
+        rws.to_numpy(dtype=np.float64),
+        fetch_optiver_val(len(states))[:, 0],
+    )
+    del midspots, rws
+
+    # events of other chunks' books get -1 & sort before every book
+    event_codes = pd.Index(books).get_indexer(event_books)
+    event_order = np.argsort(event_codes, kind="stable")
+    event_bounds = np.searchsorted(event_codes[event_order], np.arange(len(books) + 1))
+    for code in range(len(books)):
+        queries = event_order[event_bounds[code] : event_bounds[code + 1]]
+        if not len(queries):
+            continue
+        rows = order[book_bounds[code] : book_bounds[code + 1]]
+        book_values = [series_values[rows] for series_values in values]
+        present = [index for index, series_values in enumerate(book_values) if not np.isnan(series_values).all()]
+        book_series = np.array([book_values[index] for index in present]).reshape(len(present), len(rows))
+        lifetimes = RangeMinMax(received[rows], book_series)
+        lows, highs = lifetimes.windows(starts[queries], ends[queries])
+        found[queries] = highs > lows
+        if present:
+            lifetime_max[np.ix_(present, queries)] = lifetimes.max(lows, highs)
+            lifetime_min[np.ix_(present, queries)] = lifetimes.min(lows, highs)
+        del lifetimes, book_values, book_series
+
+
+def _float_array(values):
+    """float64 array of the values ... None as NaN"""
+    return np.array([np.nan if value is None else value for value in values], dtype=np.float64)
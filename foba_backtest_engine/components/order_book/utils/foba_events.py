@@ -30,14 +30,16 @@ class FobaEvent:
         self.aggressor_volume = self.trade_volume  # Must be updated by book builder if multi lds for single aggressor
         self.volume_at_join = orders[message.order_number].volume_at_join
         self.volume_pulled = orders[message.order_number].volume_pulled
+        (
+            self.volume_ahead_at_trade,
+            self.count_ahead_at_trade,
+            self.volume_behind_at_trade,
+            self.count_behind_at_trade,
+        ) = orders[message.order_number].queue_position
         self.volume_ahead_at_join = orders[message.order_number].volume_ahead_at_join
-        self.volume_ahead_at_trade = orders[message.order_number].volume_ahead
         self.count_ahead_at_join = orders[message.order_number].count_ahead_at_join
-        self.count_ahead_at_trade = orders[message.order_number].count_ahead
         self.rank_at_join = orders[message.order_number].rank_at_join
         self.depth_at_join = orders[message.order_number].depth_at_join
-        self.volume_behind_at_trade = orders[message.order_number].volume_behind
-        self.count_behind_at_trade = orders[message.order_number].count_behind
         self.depth_at_trade = event_depth
         self.passive_side = message.side
         self.aggressive_at_join = orders[message.order_number].aggressive_at_join
@@ -1,152 +1,93 @@
-from collections import defaultdict, namedtuple
-from itertools import chain
-from operator import attrgetter
-
-from foba_backtest_engine.enrichment import enriches, id_dict, provides
-from foba_backtest_engine.utils.base_utils import (
-    ImmutableDict,
-    priority_process_and_dispatch,
-    sorted_multi_dict,
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+from foba_backtest_engine.components.order_book.utils.foba_states import (
+    FEED_STATE_DTYPES,
+    FeedState,
+)
+from foba_backtest_engine.components.order_book.utils.state_recorder import (
+    StateTable,
+    from_storage,
+    states_frame,
+    states_frames,
 )
+from foba_backtest_engine.enrichment import enriches, provides
+from foba_backtest_engine.utils.base_utils import ImmutableDict
 
 """
 FEEDSTATE ENRICHMENT
 
 - FeedState contains bookId, received timestamp, createdNanos & [price, volume] x [0-4] levels
 
-i) We use the EnrichmentHelper to combine a FeedState to each FobaEvent ... using priority process dispatch function
-ii) priority_process_and_dispatch function sorts (FobaEvent) & (FeedState) by bookId_
-    - then we sort by createdNanos_ for the feed_states & foba_events
-    - we then try and match the most "recent" feed_state with the foba_events
+i) feed_state_lookups matches every FobaEvent to the most "recent" feed_state & slippage row ... at its event time &
+   at its join time, computed once for both enrichers
+    - per book the rows are sorted by createdNanos_ (stable ... rows at the same time keep their order)
+    - the match is the LAST row strictly before the event's time (feed states: trade states are skipped) ... a row at
+      the exact same time isn't seen yet. If there is none, the book's first row
+    - one np.searchsorted per book & lookup over the sorted createdNanos_
+    - only bookId_, createdNanos_ & isTrade_ of the feed states are read (states_frames, a chunk of books at a time)
+ii) full_feed_state_enrichment (event time) & feed_states_at_join (join time) gather their fields from the columns of
+    feed_states (chunk by chunk, see _state_columns) & foba_slippages at the matched rows
 
 """
 
-
-EnrichmentHelper = namedtuple(
-    "EnrichmentHelper",
+FeedStateLookups = namedtuple(
+    "FeedStateLookups",
     (
-        "original_key",
-        "group_key",
-        "sort_key",
-        "payload",
+        "event_ids",
+        "event_states",
+        "event_slippages",
+        "join_states",
+        "join_slippages",
     ),
 )
 
 
-class FeedStateEnricher:
-    def __init__(self, foba_events, feed_states, foba_slippages, join_driver_created):
-        self.foba_events = [
-            EnrichmentHelper(
-                event_id,
-                event.book_id,
-                (
-                    event.join_driver_created
-                    if join_driver_created
-                    else event.event_driver_created
-                ),
-                event,
-            )
-            for event_id, event in foba_events.items()
-        ]
-        self.feed_states = [
-            EnrichmentHelper(key, value.bookId_, value.createdNanos_, value)
-            for key, value in feed_states.items()
-        ]
-        self.foba_slippages = [
-            EnrichmentHelper(key, slippage.bookId_, slippage.createdNanos_, slippage)
-            for key, slippage in foba_slippages.items()
-        ]
-        self.sorted_foba_events = sorted_multi_dict(
-            self.foba_events,
-            group_key=attrgetter("group_key"),
-            sort_key=attrgetter("sort_key"),
-        )
-        self.sorted_feed_states = sorted_multi_dict(
-            self.feed_states,
-            group_key=attrgetter("group_key"),
-            sort_key=attrgetter("sort_key"),
-        )
-        self.sorted_slippages = sorted_multi_dict(
-            self.foba_slippages,
-            group_key=attrgetter("group_key"),
-            sort_key=attrgetter("sort_key"),
-        )
-        self.join_driver_created = join_driver_created
-        self.previous_retail_state = defaultdict(list)
-        self.previous_slippage_event = defaultdict(list)
-        self.enriched_foba_events = {"feed_state": {}, "slippages": {}}
-        self.run()
-
-    def update_feed_state(self, enrichment_helper):
-        if enrichment_helper.payload.isTrade_ == 0:
-            self.previous_retail_state[enrichment_helper.group_key] = [
-                enrichment_helper.payload
-            ]
-
-    def update_slippages(self, enrichment_helper):
-        self.previous_slippage_event[enrichment_helper.group_key] = [
-            enrichment_helper.payload
-        ]
-
-    def update_foba_event(self, enrichment_helper):
-        if len(self.previous_retail_state[enrichment_helper.group_key]) > 0:
-            self.enriched_foba_events["feed_state"][enrichment_helper.original_key] = (
-                self.previous_retail_state[enrichment_helper.group_key][0]
-            )
-        else:
-            self.enriched_foba_events["feed_state"][enrichment_helper.original_key] = (
-                self.sorted_feed_states[enrichment_helper.group_key][0].payload
-            )
-
-        if self.join_driver_created:
-            pass
-        else:
-            if len(self.previous_slippage_event[enrichment_helper.group_key]) > 0:
-                self.enriched_foba_events["slippages"][
-                    enrichment_helper.original_key
-                ] = self.previous_slippage_event[enrichment_helper.group_key][0]
-            else:
-                self.enriched_foba_events["slippages"][
-                    enrichment_helper.original_key
-                ] = self.sorted_slippages[enrichment_helper.group_key][0].payload
-
-    def run(self):
-        if not self.join_driver_created:
-            for book in self.sorted_foba_events:
-                book_events = self.sorted_foba_events[book]
-                book_feed_states = self.sorted_feed_states[book]
-                book_slippages = self.sorted_slippages[book]
-                priority_process_and_dispatch(
-                    (iter(book_events), self.update_foba_event, attrgetter("sort_key")),
-                    (
-                        iter(book_feed_states),
-                        self.update_feed_state,
-                        attrgetter("sort_key"),
-                    ),
-                    (
-                        iter(book_slippages),
-                        self.update_slippages,
-                        attrgetter("sort_key"),
-                    ),
-                )
-        else:
-            for book in self.sorted_foba_events:
-                book_events = self.sorted_foba_events[book]
-                book_feed_states = self.sorted_feed_states[book]
-                priority_process_and_dispatch(
-                    (iter(book_events), self.update_foba_event, attrgetter("sort_key")),
-                    (
-                        iter(book_feed_states),
-                        self.update_feed_state,
-                        attrgetter("sort_key"),
-                    ),
-                )
+@provides("feed_state_lookups")
+def feed_state_lookups(foba_events, feed_states, foba_slippages):
+    """
+    :return: FeedStateLookups ... per event (foba_events order) the feed_states & foba_slippages keys matched at its
+        event time (event_driver_created) & join time (join_driver_created)
+    """
+    event_ids = list(foba_events.keys())
+    books = np.array([event.book_id for event in foba_events.values()], dtype=object)
+    event_times = np.array(
+        [event.event_driver_created for event in foba_events.values()], dtype=np.int64
+    )
+    join_times = np.array(
+        [event.join_driver_created for event in foba_events.values()], dtype=np.int64
+    )
+
+    keys, (state_books, state_times, is_trade) = _read_columns(
+        feed_states, ("bookId_", "createdNanos_", "isTrade_")
+    )
+    state_rows = _BookRows(keys, state_books, state_times, visible=is_trade == 0)
+    del keys, state_books, state_times, is_trade
+    slippages = states_frame(foba_slippages)
+    # createdNanos_ is a float64 here ... so the event times are compared as float64 too
+    slippage_rows = _BookRows(
+        slippages.index.to_numpy(),
+        slippages["bookId_"].to_numpy(),
+        slippages["createdNanos_"].to_numpy(dtype=np.float64),
+    )
+    del slippages
+
+    return FeedStateLookups(
+        event_ids,
+        state_rows.as_of(books, event_times),
+        slippage_rows.as_of(books, event_times.astype(np.float64)),
+        state_rows.as_of(books, join_times),
+        slippage_rows.as_of(books, join_times.astype(np.float64)),
+    )
 
 
 @provides("feed_states")
 def fetch_feed_stats_from_book_builders(pybuilders):
-    return id_dict(
-        chain.from_iterable(builder.feed_states for builder in pybuilders.values())
+    # keys are row numbers across the builders ... StateTable.frames() reads the columns directly
+    return StateTable(
+        FeedState, [builder.feed_states for builder in pybuilders.values()]
     )
 
 
@@ -211,112 +152,129 @@ def full_feed_state_enrichment(
     foba_events,
     feed_states,
     foba_slippages,
+    feed_state_lookups,
     join_driver_created=False,
     pnl_slippage_times=[5, 15, 30, 60, 120, 240, 300, 600, 900, 1800, 3600, 7200],
 ):
-    feed_state_enricher = FeedStateEnricher(
-        foba_events,
-        feed_states,
-        foba_slippages,
-        join_driver_created=join_driver_created,
-    )
     dynamic_fields = [f"midspot_{x}" for x in pnl_slippage_times] + [
         f"rws_{x}" for x in pnl_slippage_times
     ]
-    all_fields = (
-        static_fields_event
-        + ("raw_bbov", "smooth_bbov")
+    slippage_fields = (
+        ("raw_bbov", "smooth_bbov")
         + tuple(dynamic_fields)
         + tuple(["rws", "rws_skew", "optiver_xgb_val", "midspot"])
     )
+    all_fields = static_fields_event + slippage_fields
 
     FullFeedStateAtEvent = namedtuple("FullFeedStateAtEvent", all_fields)
 
-    def items():
-        for event_id, event in foba_events.items():
-            feed_state = feed_state_enricher.enriched_foba_events["feed_state"][
-                event_id
-            ]
-            slippage = feed_state_enricher.enriched_foba_events["slippages"][event_id]
-
-            static_values = [
-                getattr(feed_state, x)
-                for x in ["bookId_", "createdNanos_", "received_", "timestamp_"]
-            ]
-            feed_state_values = []
-            for level in range(5):
-                feed_state_values.extend(
-                    [
-                        getattr(feed_state, f"bids_{level}_price_"),
-                        getattr(feed_state, f"bids_{level}_volume_"),
-                        getattr(feed_state, f"asks_{level}_price_"),
-                        getattr(feed_state, f"asks_{level}_volume_"),
-                    ]
-                )
-
-            dynamic_midspot_values = [
-                getattr(slippage, f"midspot_{x}") for x in pnl_slippage_times
-            ]
-            dynamic_rws_values = [
-                getattr(slippage, f"rws_{x}") for x in pnl_slippage_times
-            ]
-            bbov_values = [slippage.raw_bbov, slippage.smooth_bbov]
-            misc = [
-                getattr(slippage, x)
-                for x in ["rws", "rws_skew", "optiver_xgb_val", "midspot"]
-            ]
-
-            combined_values = (
-                tuple(static_values)
-                + tuple(feed_state_values)
-                + tuple(bbov_values)
-                + tuple(dynamic_midspot_values)
-                + tuple(dynamic_rws_values)
-                + tuple(misc)
-            )
-            output = FullFeedStateAtEvent(*combined_values)
-
-            yield event_id, output
-
-    return ImmutableDict(items())
+    if join_driver_created:
+        state_keys, slippage_keys = feed_state_lookups.join_states, feed_state_lookups.join_slippages
+    else:
+        state_keys, slippage_keys = feed_state_lookups.event_states, feed_state_lookups.event_slippages
+    columns = _state_columns(feed_states, state_keys) + _gathered_columns(
+        states_frame(foba_slippages), slippage_keys, slippage_fields
+    )
+
+    return ImmutableDict(
+        zip(feed_state_lookups.event_ids, map(FullFeedStateAtEvent._make, zip(*columns)))
+    )
 
 
 @provides("feed_states_at_join")
 @enriches("foba_events")
 def feed_states_at_join(
-    foba_events, feed_states, foba_slippages, join_driver_created=True
+    foba_events, feed_states, foba_slippages, feed_state_lookups, join_driver_created=True
 ):
-    feed_state_enricher = FeedStateEnricher(
-        foba_events,
-        feed_states,
-        foba_slippages,
-        join_driver_created=join_driver_created,
-    )
     all_fields = static_fields_join
     FeedStateAtJoin = namedtuple("FeedStateAtJoin", all_fields)
 
-    def items():
-        for event_id, event in foba_events.items():
-            feed_state = feed_state_enricher.enriched_foba_events["feed_state"][
-                event_id
-            ]
-            static_values = [
-                getattr(feed_state, x)
-                for x in ["bookId_", "createdNanos_", "received_", "timestamp_"]
-            ]
-            feed_state_values = []
-            for level in range(5):
-                feed_state_values.extend(
-                    [
-                        getattr(feed_state, f"bids_{level}_price_"),
-                        getattr(feed_state, f"bids_{level}_volume_"),
-                        getattr(feed_state, f"asks_{level}_price_"),
-                        getattr(feed_state, f"asks_{level}_volume_"),
-                    ]
-                )
-            combined_values = tuple(static_values) + tuple(feed_state_values)
-            output = FeedStateAtJoin(*combined_values)
-
-            yield event_id, output
-
-    return ImmutableDict(items())
+    state_keys = (
+        feed_state_lookups.join_states
+        if join_driver_created
+        else feed_state_lookups.event_states
+    )
+    columns = _state_columns(feed_states, state_keys)
+
+    return ImmutableDict(
+        zip(feed_state_lookups.event_ids, map(FeedStateAtJoin._make, zip(*columns)))
+    )
+
+
+"""
+HELPERS
+"""
+
+
+class _BookRows:
+    def __init__(self, keys, books, times, visible=None):
+        """
+        :param keys: of the rows (e.g. feed_states keys)
+        :param visible: rows a lookup can match (the first row of a book is still the fallback)
+        """
+        self.keys = keys
+        self.times = times
+        self.visible = visible
+        codes, books = pd.factorize(books)
+        self.books = pd.Index(books)
+        # by book, then time ... lexsort is stable
+        self.order, self.bounds = _grouped(codes, len(books), times)
+
+    def as_of(self, books, times):
+        """:return: per lookup the key of the last (visible) row of its book before its time ... see i)"""
+        result = np.empty(len(times), dtype=self.keys.dtype)
+        lookup_codes = self.books.get_indexer(books)
+        if (lookup_codes < 0).any():
+            raise KeyError(f"No rows for the books {set(books[lookup_codes < 0])}")
+        lookup_order, lookup_bounds = _grouped(lookup_codes, len(self.books))
+        for code in range(len(self.books)):
+            lookups = lookup_order[lookup_bounds[code] : lookup_bounds[code + 1]]
+            if not len(lookups):
+                continue
+            rows = self.order[self.bounds[code] : self.bounds[code + 1]]
+            candidates = rows if self.visible is None else rows[self.visible[rows]]
+            # side="left" on purpose ... a row at the lookup's exact time is NOT matched (feed states & slippages
+            # alike), as the heap merge of the previous FeedStateEnricher did. Don't change it to "right"
+            before = np.searchsorted(self.times[candidates], times[lookups], side="left") - 1
+            matched = np.full(len(lookups), rows[0])
+            found = before >= 0
+            matched[found] = candidates[before[found]]
+            result[lookups] = self.keys[matched]
+        return result
+
+
+def _grouped(codes, num_codes, times=None):
+    """:return: (positions grouped by code (by time within a code, stable), bounds of each code's group)"""
+    order = np.argsort(codes, kind="stable") if times is None else np.lexsort((times, codes))
+    return order, np.searchsorted(codes[order], np.arange(num_codes + 1))
+
+
+def _read_columns(states, fields):
+    """:return: (keys, [column per field]) of the states ... read a chunk of books at a time, only the fields"""
+    keys, columns = [], [[] for _ in fields]
+    for frame in states_frames(states, fields=fields):
+        keys.append(frame.index.to_numpy())
+        for column, field in zip(columns, fields):
+            column.append(frame[field].to_numpy())
+    if not keys:
+        return np.empty(0, dtype=np.int64), [np.empty(0, dtype=object) for _ in fields]
+    return np.concatenate(keys), [np.concatenate(column) for column in columns]
+
+
+def _state_columns(feed_states, keys):
+    """
+    the static_fields_event of the feed states at keys as python values (None where the records have None) ... one
+    chunk of books at a time, each gives the keys it has
+    """
+    columns = [np.empty(len(keys), dtype=object) for _ in static_fields_event]
+    for states in states_frames(feed_states, fields=static_fields_event):
+        rows = states.index.get_indexer(keys)
+        found = rows >= 0
+        for column, field in zip(columns, static_fields_event):
+            column[found] = from_storage(states[field].to_numpy()[rows[found]], FEED_STATE_DTYPES[field])
+    return [column.tolist() for column in columns]
+
+
+def _gathered_columns(frame, keys, fields):
+    rows = frame.index.get_indexer(keys)
+    return [frame[field].to_numpy()[rows].tolist() for field in fields]
@@ -2,8 +2,15 @@ from collections import namedtuple
 
 import numpy as np
 import pandas as pd
+import pyarrow as pa
 
 from foba_backtest_engine.components.order_book.utils import enums
+from foba_backtest_engine.data.feed_store import iter_store_batches, read_store_table
+from foba_backtest_engine.data.parquet_reader import (
+    iter_table_batches,
+    read_arrow_table,
+    read_table,
+)
 
 """
 -------------------
@@ -81,34 +88,318 @@ def db_to_feed_update(row, exchange):
     )
 
 
-def get_feed_updates(exchange, filter=None):
-    table_class_map = {
-        "add_order": 0,
-        "update_order": 1,
-        "delete_order": 2,
-        "clear_book": 3,
-    }
-    table_map = {
-        "add_order": "AddOrder",
-        "update_order": "ModifyOrder",
-        "delete_order": "DeleteOrder",
-        "clear_book": "ClearOrder",
-    }
+FEED_UPDATE_COLUMNS = (
+    ("received", "received_"),
+    ("created", "createdNanos_"),
+    ("timestamp", "timestampNanos_"),
+    ("command", "class_"),
+    ("side", "side_"),
+    ("book", "securityCode_"),
+    ("order_number", "orderId_"),
+    ("change_reason", "changeReason_"),
+    ("price", "price_"),
+    ("volume", "volume_"),
+    ("inferred", "end_"),
+    ("aggressor_order_number", "aggressorId_"),
+    ("sequence_number", "sequenceNumber_"),
+)
+# the raw columns feed_order sorts by
+FEED_ORDER_COLUMNS = ("class_", "createdNanos_", "sequenceNumber_")
+
+"""
+-------------------------
+    FEED UPDATE COLUMNS
+-------------------------
+
+Struct-of-arrays view over the feed. The raw dataframe is sorted once and each FeedUpdate field is kept
+as a typed numpy array, so we never hold a list of per-row dicts or a list of every FeedUpdate in memory.
+
+    - command | side are stored as int codes (class_ | side_) ... the Enum member for each code is looked
+      up once per distinct code, rows just pick up a reference to it (no Enum() construction per message)
+    - nullable float columns are converted NaN -> None when rows are materialized (same as the old
+      .replace({np.nan: None}))
+    - orderId_ is cast to int (nulls -> None)
+
+Iterating yields FeedUpdate namedtuples in chunks (rows of a chunk are materialized column-by-column
+with .tolist() which is far cheaper than DataFrame.to_dict). OmdcBookBuilder.update_columns skips the namedtuples:
+it moves one FeedUpdateCursor over the python values of each chunk & dispatches on the int command codes. by_book() splits the columns into one
+FeedUpdateColumns per book (order preserved) ... this is what we ship to workers when building in parallel.
+
+iter_feed_update_batches(...) is the streaming variant: it yields (book_id, FeedUpdateColumns) batches one book
+at a time & never holds the full day (nor a whole book as FeedUpdateColumns).
+
+write_feed_file(...) is the memory-mapped transport of the parallel build (MultiBookBuilder feed_transport="memory_map")
+    - the feed is written once to an Arrow IPC file grouped by book (feed order within a book)
+    - a worker only gets its FeedFileSlice (path, offset, length) & read_feed_slice memory-maps that range ... numeric
+      columns are views on the (shared) page cache, nothing is pickled & no worker holds the other books
+    - object columns (book, order_number w/ nulls) come back as the same python values (str | int | None)
+
+"""
+
+
+class FeedUpdateColumns:
+    chunk_size = 1 << 16
+
+    def __init__(self, columns, length):
+        self.columns = columns
+        self.length = length
+
+    @classmethod
+    def from_dataframe(cls, dataframe, exchange, presorted=False):
+        """
+        :param presorted: rows are already in feed order within each book (e.g. read from the feed store) ... skip the sort
+        """
+        if exchange != enums.Exchange.OMDC:
+            raise ValueError("Valid exchanges are OMDC ")
+
+        order = np.arange(len(dataframe)) if presorted else feed_order(dataframe)
+        columns = {}
+        for field, column in FEED_UPDATE_COLUMNS:
+            values = dataframe[column].to_numpy()[order]
+            if field == "order_number" and values.dtype.kind == "f":
+                values = values.astype(object)
+                not_null = ~pd.isnull(values)
+                values[not_null] = [int(value) for value in values[not_null]]
+                values[~not_null] = None
+            columns[field] = values
+        return cls(columns, len(order))
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        for start in range(0, self.length, self.chunk_size):
+            yield from self.rows(start, min(start + self.chunk_size, self.length))
+
+    def rows(self, start, stop):
+        return map(FeedUpdate._make, zip(*self.python_values(start, stop)))
+
+    def python_values(self, start, stop):
+        """the python values of rows start:stop per FeedUpdate field (in field order) ... as rows() has them"""
+        values = []
+        for field, _ in FEED_UPDATE_COLUMNS:
+            column = self.columns[field][start:stop]
+            if field == "command":
+                values.append(_codes_to_members(column, enums.Command))
+            elif field == "side":
+                values.append(_codes_to_members(column, enums.Side))
+            else:
+                values.append(_to_python(column))
+        return values
+
+    def batches(self, batch_size):
+        for start in range(0, self.length, batch_size):
+            stop = min(start + batch_size, self.length)
+            yield FeedUpdateColumns(
+                {field: column[start:stop] for field, column in self.columns.items()},
+                stop - start,
+            )
+
+    def take(self, indices):
+        return FeedUpdateColumns(
+            {field: column[indices] for field, column in self.columns.items()},
+            len(indices),
+        )
+
+    def by_book(self):
+        """
+        Splits the feed into one FeedUpdateColumns per book ... books come out in order of first appearance
+        and rows within a book keep the global feed order.
+        """
+        return dict(self.iter_books())
+
+    def iter_books(self):
+        """(book_id, FeedUpdateColumns) as by_book() ... one book's copy at a time"""
+        codes, book_ids = pd.factorize(self.columns["book"])
+        grouped = np.argsort(codes, kind="stable")
+        bounds = np.concatenate(([0], np.cumsum(np.bincount(codes, minlength=len(book_ids)))))
+        for code, book_id in enumerate(book_ids):
+            yield _as_python_scalar(book_id), self.take(grouped[bounds[code] : bounds[code + 1]])
+
 
-    dataframe = pd.read_parquet(filter.order_book_path)
-    dataframe = dataframe[dataframe['securityCode_'].isin(filter.book_ids)]
-    
-    data_as_dict = (
-        dataframe.sort_values(["sequenceNumber_", "createdNanos_", "class_"], ascending=[True, True, False])
-        .replace({np.nan: None})
-        .to_dict(orient="records")
+class FeedUpdateCursor:
+    """
+    One row of a FeedUpdateColumns at a time, w/ the attributes of a FeedUpdate (command | side as Enum members) ...
+    moved row by row (see OmdcBookBuilder.update_columns), so nothing may keep it (Order, FobaEvent & Level copy the
+    attributes they need)
+    """
+
+    __slots__ = FeedUpdate._fields
+
+    def feed_update(self):
+        return FeedUpdate._make(getattr(self, field) for field in FeedUpdate._fields)
+
+
+FeedFileSlice = namedtuple("FeedFileSlice", ("path", "offset", "length"))
+
+
+def write_feed_file(feed_updates, path):
+    """
+    :param feed_updates: FeedUpdateColumns
+    :return: {book_id: FeedFileSlice} ... books in order of first appearance
+    """
+    codes, book_ids = pd.factorize(feed_updates.columns["book"])
+    grouped = np.argsort(codes, kind="stable")
+    bounds = np.concatenate(([0], np.cumsum(np.bincount(codes, minlength=len(book_ids)))))
+
+    arrays, object_fields = [], []
+    for field, _ in FEED_UPDATE_COLUMNS:
+        column = feed_updates.columns[field][grouped]
+        if column.dtype == object:
+            object_fields.append(field)
+        arrays.append(pa.array(column))
+    schema = pa.schema(
+        [pa.field(field, array.type) for (field, _), array in zip(FEED_UPDATE_COLUMNS, arrays)],
+        metadata={"object_fields": ",".join(object_fields)},
     )
-    for item in data_as_dict:
-        if item["orderId_"]:
-            item["orderId_"] = int(item["orderId_"])
+    with pa.OSFile(path, "wb") as sink:
+        with pa.ipc.new_file(sink, schema) as writer:
+            writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+
+    return {
+        _as_python_scalar(book_id): FeedFileSlice(
+            path, int(bounds[code]), int(bounds[code + 1] - bounds[code])
+        )
+        for code, book_id in enumerate(book_ids)
+    }
+
+
+def read_feed_slice(feed_slice):
+    """the FeedUpdateColumns of one FeedFileSlice (see write_feed_file)"""
+    with pa.memory_map(feed_slice.path, "r") as source:
+        table = pa.ipc.open_file(source).read_all()
+    table = table.slice(feed_slice.offset, feed_slice.length)
+    object_fields = table.schema.metadata[b"object_fields"].decode().split(",")
+    columns = {}
+    for field, _ in FEED_UPDATE_COLUMNS:
+        array = table.column(field)
+        if field in object_fields:
+            columns[field] = np.array(array.to_pylist(), dtype=object)
+        else:
+            columns[field] = array.to_numpy()
+    return FeedUpdateColumns(columns, feed_slice.length)
+
+
+def _as_python_scalar(value):
+    return value.item() if isinstance(value, np.generic) else value
+
 
-    result = list(map(lambda fu: db_to_feed_update(fu, exchange), data_as_dict))
+def _codes_to_members(codes, enum_cls):
+    """
+    Maps int codes to Enum members, calling the Enum constructor once per distinct code.
+    Nulls (factorize code -1) pick up the trailing slot ... enum_cls(None) e.g. Side.NONE.
+    """
+    positions, unique_codes = pd.factorize(codes)
+    members = np.empty(len(unique_codes) + 1, dtype=object)
+    members[:-1] = [enum_cls(_as_python_scalar(code)) for code in unique_codes]
+    if (positions < 0).any():
+        members[-1] = enum_cls(None)
+    return members[positions].tolist()
+
+
+def _to_python(column):
+    if column.dtype.kind in "fO":
+        nulls = pd.isnull(column)
+        if nulls.any():
+            values = column.astype(object)
+            values[nulls] = None
+            return values.tolist()
+    return column.tolist()
+
+
+def get_feed_updates(exchange, filter=None):
+    """
+    Reads the feed for filter.book_ids within [start_time, end_time].
+    If the filter carries a feed_store_path the per book partitions of the feed store are read (these are
+    already sorted so the global sort is skipped ... rows come out grouped by book) otherwise order_book_path.
+    """
+    columns = [column for _, column in FEED_UPDATE_COLUMNS]
+    feed_store_path = getattr(filter, "feed_store_path", None)
+    if feed_store_path:
+        dataframe = read_store_table(
+            feed_store_path,
+            "order_book",
+            filter.start_time.format("YYYY-MM-DD"),
+            filter.book_ids,
+            columns=columns,
+            start_time=filter.start_time,
+            end_time=filter.end_time,
+        )
+    else:
+        dataframe = read_table(
+            filter.order_book_path,
+            columns=columns,
+            book_column="securityCode_",
+            book_ids=filter.book_ids,
+            time_column="createdNanos_",
+            start_time=filter.start_time,
+            end_time=filter.end_time,
+        )
+
+    result = FeedUpdateColumns.from_dataframe(
+        dataframe, exchange, presorted=bool(feed_store_path)
+    )
     del dataframe
-    del data_as_dict
 
     return result
+
+
+def feed_order(dataframe):
+    """positions of the raw feed rows in feed order ... by sequenceNumber_, createdNanos_ & class_ (descending)"""
+    return np.lexsort(
+        (
+            -dataframe["class_"].to_numpy(dtype=np.int64),
+            dataframe["createdNanos_"].to_numpy(),
+            dataframe["sequenceNumber_"].to_numpy(),
+        )
+    )
+
+
+def iter_feed_update_batches(exchange, filter, book_ids=None, batch_size=100_000):
+    """
+    Streaming counterpart of get_feed_updates ... yields (book_id, FeedUpdateColumns) batches one book at a time
+    so only one batch is decoded at a time.
+    - feed store ... its partitions are already in feed order, read batch by batch
+    - order_book_path ... the book's sort columns (FEED_ORDER_COLUMNS) are read first. If the rows already are in
+      feed order (e.g. a capture written in order) they are read batch by batch, otherwise the book is read as an
+      arrow table & each batch is taken from it in feed order (no DataFrame | FeedUpdateColumns of the whole book)
+    :param book_ids: defaults to filter.book_ids
+    """
+    book_ids = filter.book_ids if book_ids is None else book_ids
+    columns = [column for _, column in FEED_UPDATE_COLUMNS]
+    feed_store_path = getattr(filter, "feed_store_path", None)
+    if feed_store_path:
+        for book_id, dataframe in iter_store_batches(
+            feed_store_path,
+            "order_book",
+            filter.start_time.format("YYYY-MM-DD"),
+            book_ids,
+            columns=columns,
+            batch_size=batch_size,
+            start_time=filter.start_time,
+            end_time=filter.end_time,
+        ):
+            yield book_id, FeedUpdateColumns.from_dataframe(dataframe, exchange, presorted=True)
+        return
+
+    for book_id in book_ids:
+        scan = dict(
+            book_column="securityCode_",
+            book_ids=[book_id],
+            time_column="createdNanos_",
+            start_time=filter.start_time,
+            end_time=filter.end_time,
+        )
+        order = feed_order(read_table(filter.order_book_path, columns=list(FEED_ORDER_COLUMNS), **scan))
+        if (order == np.arange(len(order))).all():
+            dataframes = iter_table_batches(
+                filter.order_book_path, columns=columns, batch_size=batch_size, **scan
+            )
+        else:
+            table = read_arrow_table(filter.order_book_path, columns=columns, **scan)
+            dataframes = (
+                table.take(order[start : start + batch_size]).to_pandas()
+                for start in range(0, len(order), batch_size)
+            )
+        for dataframe in dataframes:
+            yield str(book_id), FeedUpdateColumns.from_dataframe(dataframe, exchange, presorted=True)
@@ -1,7 +1,35 @@
-import operator
-from collections import deque
-import itertools
 import bisect
+import heapq
+import operator
+
+
+class FifoPrefixSums:
+    """
+    Fenwick (binary indexed) tree over the FIFO slots of a level ... slot i holds the value (volume or count) of the
+    i-th order that joined the level & 0 once that order has left. append | add | prefix are all O(log n).
+    Slots are 1-based & never reused.
+    """
+
+    def __init__(self):
+        self._tree = [0]
+
+    def append(self, value):
+        slot = len(self._tree)
+        # node slot covers (slot - lowbit, slot]
+        self._tree.append(value + self.prefix(slot - 1) - self.prefix(slot - (slot & -slot)))
+        return slot
+
+    def add(self, slot, delta):
+        while slot < len(self._tree):
+            self._tree[slot] += delta
+            slot += slot & -slot
+
+    def prefix(self, slot):
+        total = 0
+        while slot > 0:
+            total += self._tree[slot]
+            slot -= slot & -slot
+        return total
 
 
 class Level:
@@ -14,7 +42,13 @@ class Level:
         self.end_created = None
         self.end_received = None
         self.end_timestamp = None
-        self.orders = [initializing_order]
+        # FIFO of the resting orders (dict for O(1) removal) ... queue positions come from the prefix sums below
+        self.orders = {}
+        self._volume_slots = FifoPrefixSums()
+        self._count_slots = FifoPrefixSums()
+        # counted multiset of the resting |volume|s + a lazy max-heap over it ... largest_order_on_level w/o a scan
+        self._volume_counts = {}
+        self._largest_volumes = []
         self.last_dones = []
         self.pulls = []
         self.volume_on_level = initializing_order.volume
@@ -22,6 +56,7 @@ class Level:
         self.volume_traded_on_level = 0
         self.volume_pulled_on_level = 0
         self.aggressive_volume = initializing_order.aggressive_volume_at_join
+        self._enqueue(initializing_order)
 
     @property
     def number_of_orders_on_level(self):
@@ -29,49 +64,71 @@ class Level:
 
     @property
     def largest_order_on_level(self):
-        return max([abs(x.volume) for x in self.orders])
+        # drop heap entries whose volume is no longer resting on the level
+        while not self._volume_counts.get(-self._largest_volumes[0]):
+            heapq.heappop(self._largest_volumes)
+        return -self._largest_volumes[0]
+
+    def _count_volume(self, volume):
+        volume = abs(volume)
+        count = self._volume_counts.get(volume, 0)
+        self._volume_counts[volume] = count + 1
+        if not count:
+            heapq.heappush(self._largest_volumes, -volume)
+
+    def _uncount_volume(self, volume):
+        volume = abs(volume)
+        count = self._volume_counts[volume] - 1
+        if count:
+            self._volume_counts[volume] = count
+        else:
+            del self._volume_counts[volume]
 
     def _adjust_volume_through_level(self, order_volume):
         self.volume_through_level += order_volume
 
+    def _enqueue(self, order):
+        self.orders[order] = None
+        self._count_volume(order.volume)
+        order.join_queue(self, self._volume_slots.append(order.volume))
+        self._count_slots.append(1)
+
+    def queue_position(self, order):
+        """
+        :return: (volume_ahead, count_ahead, volume_behind, count_behind) of an order resting on this level
+        """
+        slot = order.queue_slot
+        volume_ahead = self._volume_slots.prefix(slot - 1)
+        count_ahead = self._count_slots.prefix(slot - 1)
+        return (
+            volume_ahead,
+            count_ahead,
+            self.volume_on_level - self._volume_slots.prefix(slot),
+            len(self.orders) - count_ahead - 1,
+        )
+
     def add_order_to_level(self, order):
         order.calculate_join_statistics()
         self.volume_on_level += order.volume
-
-        for o in self.orders:
-            o.volume_behind += order.volume
-            o.count_behind += 1
-
-        self.orders.append(order)
+        self._enqueue(order)
         self._adjust_volume_through_level(order.volume)
 
     def remove_order_from_level(self, order):
+        slot = order.queue_slot
+        # the order keeps the queue position it had when it left
+        order.leave_queue(self.queue_position(order))
+        self._volume_slots.add(slot, -order.volume)
+        self._count_slots.add(slot, -1)
         self.volume_on_level -= order.volume
-        index = self.orders.index(order)
-
-        if index != 0:
-            for o in self.orders[:index]:
-                o.volume_behind -= order.volume
-                o.count_behind -= 1
-
-        if index != len(self.orders) + 1:
-            for o in self.orders[index + 1:]:
-                o.volume_ahead -= order.volume
-                o.count_ahead -= 1
-
-        self.orders.remove(order)
+        self._uncount_volume(order.volume)
+        del self.orders[order]
 
     def update_volume(self, order, volume_to_remove):
+        # called before the order's volume is reduced
         self.volume_on_level -= volume_to_remove
-        index = self.orders.index(order)
-
-        if index != 0:
-            for o in self.orders[:index]:
-                o.volume_behind -= volume_to_remove
-
-        if index != len(self.orders) + 1:
-            for o in self.orders[index + 1:]:
-                o.volume_ahead -= volume_to_remove
+        self._volume_slots.add(order.queue_slot, -volume_to_remove)
+        self._uncount_volume(order.volume)
+        self._count_volume(order.volume - volume_to_remove)
 
     def close_level(self, closing_message):
         self.end_created = closing_message.created
@@ -95,7 +152,10 @@ class LevelManager:
 
         self.is_bid = is_bid
         self.best_price = None
-        self.ordered_prices = deque()
+        # price ladder ... ordered_prices is best-first & _keys holds the matching sort keys (-price for bids,
+        # price for asks) in ascending order, so bisect on _keys gives insert/delete/distance/next-best in O(log n)
+        self.ordered_prices = []
+        self._keys = []
 
         self._best = max if self.is_bid else min
         self._better = operator.gt if self.is_bid else operator.lt
@@ -113,22 +173,22 @@ class LevelManager:
         level.close_level(message)
         self.closed_levels.append(level)
 
-    def _sorted_prices_append_middle(self, price):
-        if self.is_bid:
-            self.ordered_prices.reverse()
-        pos = bisect.bisect_left(self.ordered_prices, price)
-        self.ordered_prices.rotate(-pos)
-        self.ordered_prices.appendleft(price)
-        self.ordered_prices.rotate(pos)
-        if self.is_bid:
-            self.ordered_prices.reverse()
-
-    def _sorted_prices_pop_middle(self, price):
-        if self.is_bid:
-            self.ordered_prices.reverse()
-        del self.ordered_prices[bisect.bisect_left(self.ordered_prices, price)]
-        if self.is_bid:
-            self.ordered_prices.reverse()
+    def _key(self, price):
+        return -price if self.is_bid else price
+
+    def _insert_price(self, price):
+        index = bisect.bisect_left(self._keys, self._key(price))
+        self._keys.insert(index, self._key(price))
+        self.ordered_prices.insert(index, price)
+        if index == 0:
+            self.best_price = price
+
+    def _remove_price(self, price):
+        index = bisect.bisect_left(self._keys, self._key(price))
+        del self._keys[index]
+        del self.ordered_prices[index]
+        if index == 0:
+            self.best_price = self.ordered_prices[0] if self.ordered_prices else None
 
     def process_add_message(self, order):
         if order.level is None:
@@ -142,11 +202,7 @@ class LevelManager:
         else:
             self._initialize_level(order)
             if order.price is not None:
-                if len(self.ordered_prices) == 0 or self._better(order.price, self.ordered_prices[0]):
-                    self.ordered_prices.appendleft(order.price)
-                    self.best_price = self.ordered_prices[0]
-                else:
-                    self._sorted_prices_append_middle(order.price)
+                self._insert_price(order.price)
 
     def process_delete_message(self, message, orders, implied_price=False):
         price = orders[message.order_number].price if not implied_price else implied_price
@@ -154,11 +210,7 @@ class LevelManager:
         my_level.remove_order_from_level(orders[message.order_number])
         if len(my_level.orders) == 0:
             self._close_levels(my_level, message)
-            if price == self.ordered_prices[0]:
-                self.ordered_prices.popleft()
-                self.best_price = None if len(self.ordered_prices) == 0 else self.ordered_prices[0]
-            else:
-                self._sorted_prices_pop_middle(price)
+            self._remove_price(price)
 
     def enrich_open_levels_with_last_done(self, last_done, order_manager):
         if last_done.trade_volume > 0:
@@ -184,7 +236,7 @@ class LevelManager:
         return True if self._worse_equal(price, self.best_price) else False
 
     def get_levels(self, num):
-        prices = list(itertools.islice(self.ordered_prices, 0, num))
+        prices = self.ordered_prices[:num]
         volumes = [self.open_levels[p].volume_on_level for p in prices]
 
         num_empty = num - len(prices)
@@ -192,13 +244,13 @@ class LevelManager:
         return list(zip(prices, volumes)) + [(None, None)] * num_empty
 
     def get_non_empty_levels(self, num):
-        prices = list(itertools.islice(self.ordered_prices, 0, num))
+        prices = self.ordered_prices[:num]
         volumes = [self.open_levels[p].volume_on_level for p in prices]
 
         return list(zip(prices, volumes))
 
     def get_count_on_levels(self, num):
-        prices = list(itertools.islice(self.ordered_prices, 0, num))
+        prices = self.ordered_prices[:num]
         count = [self.open_levels[p].number_of_orders_on_level for p in prices]
         largest_order = [self.open_levels[p].largest_order_on_level for p in prices]
 
@@ -212,21 +264,18 @@ class LevelManager:
                 or self._better(price, self.ordered_prices[0]):
             return -1
         else:
-            num_in_front = 0
-            while len(self.ordered_prices) > num_in_front \
-                    and self._better(self.ordered_prices[num_in_front], price):
-                num_in_front += 1
-            return num_in_front
+            # number of levels strictly better than price
+            return bisect.bisect_left(self._keys, self._key(price))
 
     def get_next_best_level(self, price):
         if price is None or not self.ordered_prices:
             return None
         else:
-            try:
-                return next(self.open_levels[level_price] for level_price in self.ordered_prices
-                            if self._worse(level_price, price))
-            except StopIteration:
+            # first level strictly worse than price
+            index = bisect.bisect_right(self._keys, self._key(price))
+            if index == len(self.ordered_prices):
                 return None
+            return self.open_levels[self.ordered_prices[index]]
 
     def update_order_best_level_times_for_add(self, order):
         order.best_level_times = []
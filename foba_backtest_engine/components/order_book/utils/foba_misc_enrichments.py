@@ -1,9 +1,10 @@
 from collections import namedtuple
 from enum import Enum, unique
 
+import numpy as np
 import pytz
 
-from foba_backtest_engine.enrichment import enriches, provides
+from foba_backtest_engine.enrichment import enriches, enriches_columns, provides
 from foba_backtest_engine.utils.base_utils import ImmutableDict
 from foba_backtest_engine.utils.time_utils import (
     _convert_unix_to_datetime,
@@ -38,7 +39,6 @@ class Side(Enum):
     ASK = -1
 
 
-CategoryEnrichment = namedtuple("CategoryEnrichment", "category")
 DerivedEnrichment = namedtuple(
     "DerivedEnrichment",
     (
@@ -61,28 +61,26 @@ DerivedEnrichment = namedtuple(
 
 
 @provides("category_enrichment")
-@enriches("foba_events")
+@enriches_columns("foba_events")
 def category_enrichment(foba_events, early_cutoff_time, market_open=None):
+    if foba_events.empty:
+        # no events ... the frame has no columns either
+        return ImmutableDict()
     open = to_nano_timestamp(market_open) if market_open else None
-
-    def items():
-        for event_id, event in foba_events.items():
-            if open and event.join_driver_received < open:
-                category = Category.PRE_OPEN
-            elif event.join_aggressive_volume > 0:
-                category = Category.BOOV
-            elif event.join_depth > 0:
-                category = Category.DEPTH
-            elif (
-                event.join_driver_received
-                < event.level_driver_received + early_cutoff_time
-            ):
-                category = Category.EARLY
-            else:
-                category = Category.LATE
-            yield event_id, CategoryEnrichment(category=category)
-
-    return ImmutableDict(items())
+    join_received = foba_events["join_driver_received"].to_numpy()
+
+    # first matching condition wins
+    category = np.select(
+        [
+            join_received < open if open else np.zeros(len(foba_events), dtype=bool),
+            foba_events["join_aggressive_volume"].to_numpy() > 0,
+            foba_events["join_depth"].to_numpy() > 0,
+            join_received < foba_events["level_driver_received"].to_numpy() + early_cutoff_time,
+        ],
+        [Category.PRE_OPEN, Category.BOOV, Category.DEPTH, Category.EARLY],
+        default=Category.LATE,
+    )
+    return {"category": category}
 
 
 @provides("derived_enrichment")
@@ -1,8 +1,9 @@
 from collections import namedtuple
 
-import pandas as pd
 
 from foba_backtest_engine.components.order_book.utils import MyRow as MyRow
+from foba_backtest_engine.data.feed_store import read_store_table
+from foba_backtest_engine.data.parquet_reader import read_table
 from foba_backtest_engine.enrichment import provides
 from foba_backtest_engine.utils.base_utils import ImmutableDict
 from foba_backtest_engine.utils.time_utils import to_milli_timestamp
@@ -59,20 +60,34 @@ def get_omdc_broker_queue(filter, security_codes):
     # omdc = pd.read_feather(
     #     "/Users/kartikeyabisht/FobaBacktestEngine/temp_data/OMDC.feather"
     # )
-    omdc = pd.read_parquet(filter.conflated_broker_queue_path)
-    
+    feed_store_path = getattr(filter, "feed_store_path", None)
+    if feed_store_path:
+        # partitions are sorted per book ... the per book order below is the same w/o the global sort
+        omdc = read_store_table(
+            feed_store_path,
+            "broker_queue",
+            date_to_pull,
+            security_codes,
+            start_time=int(start_time),
+            end_time=int(end_time),
+        )
+    else:
+        omdc = read_table(
+            filter.conflated_broker_queue_path,
+            book_column="securityCode_",
+            book_ids=security_codes,
+            time_column="createdNanos_",
+            start_time=int(start_time),
+            end_time=int(end_time),
+        )
 
     omdc["securityCode_"] = omdc["securityCode_"].apply(
         lambda x: str(x) if isinstance(x, int) else x
     )
-    omdc = omdc[omdc["securityCode_"].isin(security_codes)]
-    omdc_filter_time = omdc[
-        (omdc["createdNanos_"] >= start_time)
-        & (omdc["createdNanos_"] <= end_time)
-    ]
-    omdc_final = omdc_filter_time.sort_values(
-        by=["timestampNanos_", "side_", "priority_"]
-    )
+    if feed_store_path:
+        omdc_final = omdc
+    else:
+        omdc_final = omdc.sort_values(by=["timestampNanos_", "side_", "priority_"])
     omdc_final_list = []
     for _, row in omdc_final.iterrows():
         row_dict = row.to_dict()
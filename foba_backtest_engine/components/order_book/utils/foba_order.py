@@ -13,6 +13,9 @@ b) Aggressive Volume
     - Has an aggressive volume (i.e volume that matches) & non-aggressive volume (posted)
 
 c) Order statistics - these track the order's position ... rank_at_join, count_ahead_at_join etc
+    - the *_at_join fields are fixed when the order joins its level
+    - volume_ahead | count_ahead | volume_behind | count_behind are computed on read from the level's prefix sums
+      while the order rests (see Level.queue_position) & frozen when it leaves the level
 
 d) Quote Type
     - CROSS: If the order crosses the spread (aggressive volume).
@@ -48,10 +51,9 @@ class Order(ReprMixin):
         self.count_ahead_at_join = 0
         self.volume_ahead_at_join = 0
         self.rank_at_join = 0
-        self.volume_ahead = 0
-        self.count_ahead = 0
-        self.volume_behind = 0
-        self.count_behind = 0
+        self.queue_level = None
+        self.queue_slot = None
+        self._queue_position = (0, 0, 0, 0)
         self.level = None
         self.depth_at_join = 0
         self.quote_type = None
@@ -71,6 +73,38 @@ class Order(ReprMixin):
         self.volume_on_next_best_level_at_join = 0
         self.best_level_times = None
 
+    @property
+    def queue_position(self):
+        """(volume_ahead, count_ahead, volume_behind, count_behind)"""
+        if self.queue_level is None:
+            return self._queue_position
+        return self.queue_level.queue_position(self)
+
+    @property
+    def volume_ahead(self):
+        return self.queue_position[0]
+
+    @property
+    def count_ahead(self):
+        return self.queue_position[1]
+
+    @property
+    def volume_behind(self):
+        return self.queue_position[2]
+
+    @property
+    def count_behind(self):
+        return self.queue_position[3]
+
+    def join_queue(self, level, slot):
+        self.queue_level = level
+        self.queue_slot = slot
+
+    def leave_queue(self, queue_position):
+        self._queue_position = queue_position
+        self.queue_level = None
+        self.queue_slot = None
+
     def give_associated_level_object(self, level):
         if self.level is None:
             self.level = level
@@ -89,8 +123,6 @@ class Order(ReprMixin):
         self.count_ahead_at_join = self.level.number_of_orders_on_level
         self.volume_ahead_at_join = self.level.volume_on_level
         self.rank_at_join = self.level.volume_through_level
-        self.count_ahead = self.level.number_of_orders_on_level
-        self.volume_ahead = self.level.volume_on_level
 
     def determine_quote_type(self):
         if self.price is None:
@@ -9,6 +9,8 @@ from foba_backtest_engine.components.order_book.utils.enums import (
     ProductClass,
     Side,
 )
+from foba_backtest_engine.data.feed_store import read_store_table
+from foba_backtest_engine.data.parquet_reader import read_table
 from foba_backtest_engine.enrichment import enriches, id_dict, provides
 from foba_backtest_engine.utils.base_utils import ImmutableDict
 
@@ -134,24 +136,29 @@ OptiverTrade = namedtuple(
 )
 
 
+def _read_own_table(filter, path, store_table_name):
+    feed_store_path = getattr(filter, "feed_store_path", None)
+    if feed_store_path:
+        df = read_store_table(
+            feed_store_path,
+            store_table_name,
+            filter.start_time.format("YYYY-MM-DD"),
+            filter.book_ids,
+        )
+    else:
+        df = read_table(path, book_column="feedcode", book_ids=filter.book_ids)
+    return df.reset_index(drop=True)
+
 def get_private_feed_data(filter):
-    df = pd.read_parquet(filter.private_feed_path)
-    df = df[df["feedcode"].isin(filter.book_ids)].reset_index(drop=True)
-    return df
+    return _read_own_table(filter, filter.private_feed_path, "private_feed")
 
 def get_own_order_data(filter, table_name):
     if table_name == "order_insert":
-        df = pd.read_parquet(filter.order_insert_path)
-        df = df[df["feedcode"].isin(filter.book_ids)].reset_index(drop=True)
-        return df
+        return _read_own_table(filter, filter.order_insert_path, "order_insert")
     elif table_name == "delete_operations":
-        df = pd.read_parquet(filter.delete_operation_path)
-        df = df[df["feedcode"].isin(filter.book_ids)].reset_index(drop=True)
-        return df
+        return _read_own_table(filter, filter.delete_operation_path, "delete_operation")
     elif table_name == "private_trade":
-        df = pd.read_parquet(filter.private_trade_path)
-        df = df[df["feedcode"].isin(filter.book_ids)].reset_index(drop=True)
-        return df
+        return _read_own_table(filter, filter.private_trade_path, "private_trade")
     else:
         raise ValueError("Wtf is this")
 
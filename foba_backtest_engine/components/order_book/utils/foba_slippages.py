@@ -10,9 +10,13 @@ from foba_backtest_engine.analysis_utils.feature_functions.bbov import (
 from foba_backtest_engine.analysis_utils.target_function.delayed_rws import (
     adjust_for_lunch_inplace,
     calculate_delayed_rws_midspot,
+    delayed_rws_midspot_books,
 )
+from foba_backtest_engine.components.order_book.utils.state_recorder import states_frames
 from foba_backtest_engine.enrichment import provides
-from foba_backtest_engine.utils.base_utils import ImmutableDict
+from foba_backtest_engine.utils.base_utils import ColumnDict
+
+BuiltSlippages = namedtuple("BuiltSlippages", "options frames")
 
 """
 Any custom metric or val can be inserted here ... ive done RWS as its a decent indicator of the tick.
@@ -35,7 +39,12 @@ def get_slipped_fields(
     bbov_weights=[1, 6, 6, 1],
     smooth_bbov_alpha=0.10,
     bbov_interval_s=10,
+    delayed=None,
 ):
+    """
+    :param delayed: the calculate_delayed_rws_midspot result of df if already computed (e.g. by annotate_slippages for
+        all books in one delayed_rws_midspot_books call)
+    """
     createdNanos_, received_, timestamp_ = (
         df["createdNanos_"].values,
         df["received_"].values,
@@ -53,11 +62,13 @@ def get_slipped_fields(
         np.array(pnl_slippage_times),
     )
     result_shape = (len(rws), 2 * len(pnl_slippage_times))
-    result = np.empty(result_shape, dtype=np.float64)
-
-    calculate_delayed_rws_midspot(
-        createdNanos_, createdNanos_, midspot, rws, pnl_slippage_times, result
-    )
+    if delayed is None:
+        result = np.empty(result_shape, dtype=np.float64)
+        calculate_delayed_rws_midspot(
+            createdNanos_, createdNanos_, midspot, rws, pnl_slippage_times, result
+        )
+    else:
+        result = delayed
 
     bbov_length = len(bbov_weights)
     if bbov_length % 2 != 0:
@@ -121,6 +132,44 @@ def get_slipped_fields(
     return result_df
 
 
+def book_slippages(
+    states,
+    book,
+    exclude_lunch=True,
+    pnl_slippage_times=[5, 15, 30, 60, 120, 240, 300, 600, 900, 1800, 3600, 7200],
+    bbov_weights=[1, 6, 6, 1],
+    smooth_bbov_alpha=0.10,
+    bbov_interval_s=10,
+    delayed=None,
+):
+    """
+    The slippage rows of one book ... states is that book's feed states as a DataFrame indexed by their event ids.
+    Gaps (e.g. no future price near the close) are filled within the book, so books never fill each other.
+    Run per book by annotate_slippages & by the workers of the parallel book build (see BookBuildResult).
+    :param delayed: see get_slipped_fields ... then states must already be _slippage_frame(states)
+    """
+    enriched_df = states if delayed is not None else _slippage_frame(states)
+
+    future_prices = get_slipped_fields(
+        df=enriched_df,
+        bookId=book,
+        exclude_lunch=exclude_lunch,
+        pnl_slippage_times=pnl_slippage_times,
+        bbov_weights=bbov_weights,
+        smooth_bbov_alpha=smooth_bbov_alpha,
+        bbov_interval_s=bbov_interval_s,
+        delayed=delayed,
+    )
+    del enriched_df
+    slippage_columns = [
+        c
+        for c in future_prices.columns
+        if c not in ["bookId_", "event_id_match", "createdNanos_"]
+    ]
+    future_prices[slippage_columns] = future_prices[slippage_columns].ffill().bfill()
+    return future_prices
+
+
 @provides("foba_slippages")
 def annotate_slippages(
     feed_states,
@@ -129,6 +178,7 @@ def annotate_slippages(
     bbov_weights=[1, 6, 6, 1],
     smooth_bbov_alpha=0.10,
     bbov_interval_s=10,
+    built_slippages=None,
 ):
     """
     This calculates midspot/rws/rdvwap_{x}s for x in [1s,2s,30s,...etc]
@@ -136,14 +186,83 @@ def annotate_slippages(
     i) First we enrich the feed-states to have rws, midspot
     ii) We then use a guvectorized method to efficiently iterate through the rows and using a type of searchsorted algorithm annotate the correct future price
     iii) We then attach these to feed_states
+
+    i) & ii) run per book (book_slippages) ... if the parallel book build already ran them in its workers with the same
+    parameters (built_slippages, see fetch_slippages_from_book_builders) those frames are used instead, otherwise the feed
+    states are read in chunks of whole books (states_frames), the books of a chunk are the slices of one stable argsort
+    by book & ii) runs over all of them in one delayed_rws_midspot_books call
+    iii) the rows are put in feed_states order by position ... the result is a ColumnDict of FeedStateSlippages keyed
+    by the feed_states keys, so the columns stay arrays (states_frame hands back its frame)
     """
-    event_ids = []
-    enriched = []
-    for event_id, event in feed_states.items():
-        enriched.append(event._asdict())
-        event_ids.append(event_id)
+    options = dict(
+        exclude_lunch=exclude_lunch,
+        pnl_slippage_times=pnl_slippage_times,
+        bbov_weights=bbov_weights,
+        smooth_bbov_alpha=smooth_bbov_alpha,
+        bbov_interval_s=bbov_interval_s,
+    )
+    state_ids = pd.Index(list(feed_states.keys()))
+    if built_slippages is not None and built_slippages.options == _comparable(options):
+        book_results = list(built_slippages.frames)
+    else:
+        book_results = [
+            frame for states in states_frames(feed_states) for frame in _book_slippages(states, options)
+        ]
 
-    enriched_df = pd.DataFrame(enriched)
+    future_valuation = pd.concat(book_results, axis=0, ignore_index=True)
+    del book_results
+
+    rows = state_ids.get_indexer(future_valuation["event_id_match"].to_numpy())
+    if len(rows) != len(state_ids) or (rows < 0).any() or len(np.unique(rows)) != len(rows):
+        raise AssertionError(
+            "enriched slippages should have same number of rows as feed states!"
+        )
+    # position of each feed state's row in future_valuation
+    positions = np.empty(len(rows), dtype=np.int64)
+    positions[rows] = np.arange(len(rows))
+    future_valuation = future_valuation.drop(columns="event_id_match").take(positions)
+    future_valuation.index = state_ids
+
+    return ColumnDict(future_valuation, typename="FeedStateSlippages")
+
+
+@provides("built_slippages")
+def fetch_slippages_from_book_builders(pybuilders, feed_states):
+    """
+    The per book slippage frames the parallel book build computed in its workers (see BookBuildResult) w/ their
+    event_id_match moved to the feed_states keys ... annotate_slippages uses them when their options match its own.
+    :return: BuiltSlippages ... options None (& no frames) unless every book w/ feed states has them for the same
+        options
+    """
+    options = None
+    frames = []
+    for builder in pybuilders.values():
+        keys = feed_states.keys_of(builder.feed_states)
+        if not len(keys):
+            continue
+        builder_options = getattr(builder, "slippage_options", None)
+        if builder_options is None or getattr(builder, "slippages", None) is None:
+            return BuiltSlippages(None, ())
+        builder_options = _comparable(builder_options)
+        if options is not None and builder_options != options:
+            return BuiltSlippages(None, ())
+        options = builder_options
+        frames.append(
+            builder.slippages.assign(
+                event_id_match=builder.slippages["event_id_match"].to_numpy() + keys.start
+            )
+        )
+    return BuiltSlippages(options, tuple(frames))
+
+
+"""
+HELPERS
+"""
+
+
+def _slippage_frame(states):
+    """get_slipped_fields' df ... a book's states + rws, rws_skew, optiver_xgb_val & midspot, sorted by createdNanos_"""
+    enriched_df = states.reset_index(names="event_id")
     enriched_df["rws"] = (
         enriched_df.bids_0_volume_ * enriched_df.asks_0_price_
         + enriched_df.asks_0_volume_ * enriched_df.bids_0_price_
@@ -155,52 +274,56 @@ def annotate_slippages(
     enriched_df["midspot"] = (
         enriched_df.asks_0_price_ + enriched_df.bids_0_price_
     ) / 2.0
-    enriched_df["event_id"] = event_ids
-    enriched_df = enriched_df.sort_values("createdNanos_").reset_index(drop=True)
+    # stable ... messages w/ the same createdNanos_ keep their feed order
+    enriched_df = enriched_df.sort_values("createdNanos_", kind="stable").reset_index(drop=True)
+    return enriched_df
 
-    book_results = []
-    for book in enriched_df["bookId_"].unique():
-        book_enriched = enriched_df[enriched_df["bookId_"] == book].reset_index(
-            drop=True
-        )
-        book_future_prices = get_slipped_fields(
-            df=book_enriched,
-            bookId=book,
-            exclude_lunch=exclude_lunch,
-            pnl_slippage_times=pnl_slippage_times,
-            bbov_weights=bbov_weights,
-            smooth_bbov_alpha=smooth_bbov_alpha,
-            bbov_interval_s=bbov_interval_s,
-        )
-        book_results.append(book_future_prices)
-        del book_enriched
-        del book_future_prices
 
-    future_valuation = pd.concat(book_results, axis=0)
-    slippage_columns = [
-        c
-        for c in future_valuation.columns
-        if c not in ["bookId_", "event_id_match", "createdNanos_"]
+def _book_slippages(states, options):
+    """
+    book_slippages of every book of the states frame ... the books are slices of one stable argsort by bookId_ & the
+    delayed midspots/rws of all of them come from one delayed_rws_midspot_books call
+    """
+    codes, books = pd.factorize(states["bookId_"])
+    order = np.argsort(codes, kind="stable")
+    bounds = np.searchsorted(codes[order], np.arange(len(books) + 1))
+    frames = [
+        _slippage_frame(states.take(order[start:stop])) for start, stop in zip(bounds[:-1], bounds[1:])
+    ]
+    if not frames:
+        return []
+    delayed = _delayed_rws_midspots(frames, bounds, options)
+    return [
+        book_slippages(frame, book, **options, delayed=delayed[start:stop])
+        for frame, book, start, stop in zip(frames, books, bounds[:-1], bounds[1:])
     ]
-    future_valuation[slippage_columns] = (
-        future_valuation[slippage_columns].ffill().bfill()
-    )
 
-    FeedStateSlippages = namedtuple(
-        "FeedStateSlippages",
-        [c for c in future_valuation.columns if c != "event_id_match"],
+
+def _delayed_rws_midspots(frames, bounds, options):
+    """calculate_delayed_rws_midspot of every book's _slippage_frame in one call ... rows in frames order"""
+    times = np.concatenate([frame["createdNanos_"].to_numpy() for frame in frames])
+    if options["exclude_lunch"]:
+        adjust_for_lunch_inplace(timestamp=times, exclude_lunch=True)
+    times = times.astype(np.float64)
+    intervals = np.asarray(options["pnl_slippage_times"], dtype=np.float64)
+    result = np.empty((len(times), 2 * len(intervals)), dtype=np.float64)
+    bounds = np.asarray(bounds, dtype=np.int64)
+    delayed_rws_midspot_books(
+        times,
+        times,
+        np.concatenate([frame["midspot"].to_numpy(dtype=np.float64) for frame in frames]),
+        np.concatenate([frame["rws"].to_numpy(dtype=np.float64) for frame in frames]),
+        intervals,
+        bounds,
+        bounds,
+        result,
     )
-    future_valuation = future_valuation.set_index("event_id_match")
-
-    def items():
-        for event_id, event in feed_states.items():
-            try:
-                row = future_valuation.loc[event_id]
-            except:
-                raise AssertionError(
-                    "enriched slippages should have same number of rows as feed states!"
-                )
-            FeedStateSlippage = FeedStateSlippages(*row)
-            yield event_id, FeedStateSlippage
-
-    return ImmutableDict(items())
+    return result
+
+
+def _comparable(options):
+    """options w/ their sequences as tuples (e.g. pnl_slippage_times as a list in one place & a tuple in another)"""
+    return {
+        name: tuple(value) if isinstance(value, (list, tuple, np.ndarray)) else value
+        for name, value in options.items()
+    }
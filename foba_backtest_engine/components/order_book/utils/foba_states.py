@@ -72,6 +72,30 @@ OrderCountState = namedtuple(
     ),
 )
 
+
+def _state_dtype(field):
+    """column dtype of a FeedState/OrderCountState field in a StateRecorder"""
+    if field in ("bookId_", "foreignLd_aggressorSide_"):
+        return "object"
+    if field in ("createdNanos_", "received_", "timestamp_", "isTrade_"):
+        return "int64"
+    if field.endswith("price_"):
+        return "float64"
+    return "Int64"
+
+
+FEED_STATE_DTYPES = {field: _state_dtype(field) for field in FeedState._fields}
+ORDER_COUNT_STATE_DTYPES = {field: _state_dtype(field) for field in OrderCountState._fields}
+
+
+def snapshot_fields(record_type, depth):
+    """the FeedState/OrderCountState fields w/o the levels from depth on (bids_{i}_... | asks_{i}_... w/ i >= depth)"""
+    return tuple(
+        field
+        for field in record_type._fields
+        if not (field.startswith(("bids_", "asks_")) and int(field.split("_")[1]) >= depth)
+    )
+
 FeedStateAtJoin = namedtuple(
     "FeedStateAtJoin",
     (
@@ -1,8 +1,8 @@
 from operator import attrgetter
 
-import pandas as pd
 
 from foba_backtest_engine.components.order_book.utils import MyRow
+from foba_backtest_engine.data.parquet_reader import read_table
 from foba_backtest_engine.enrichment import provides
 from foba_backtest_engine.utils.base_utils import (
     ImmutableDict,
@@ -24,9 +24,9 @@ def static_data_info(filter, product_filter=None):
     """
     Provides an ImmutableDict of StaticDataInfo
     """
-    feeInfo = pd.read_feather(filter.fee_info_path)
-    tickSchedule = pd.read_feather(filter.tick_schedule_path)
-    feeSchedule = pd.read_feather(filter.fee_schedule_path)
+    feeInfo = read_table(filter.fee_info_path, format="feather")
+    tickSchedule = read_table(filter.tick_schedule_path, format="feather")
+    feeSchedule = read_table(filter.fee_schedule_path, format="feather")
 
     # feeInfo = pd.read_feather(
     #     "/Users/kartikeyabisht/FobaBacktestEngine/temp_data/FeeInfo.feather"
@@ -1,5 +1,3 @@
-import copy
-
 """
 ORDER QUEUE
 - This maintains a LIST of orders arranged in time-sequence form. Each entry is a "snapshot" of the orderBook at some time
@@ -19,12 +17,17 @@ would result in ...
 
 
 Main use is in the OMDC BrokerQueue matching algorithm I have made
+
+Snapshots share structure ... each message copies the (short) list of levels & only the [price, [order_number]]
+entry it changes, every other entry is the same object as in the previous snapshot (volume decreases share the
+whole level list). Snapshots are therefore READ-ONLY once appended ... never mutate order_queue[i] in place.
 """
 
 
 class OrderQueue:
-    def __init__(self, bid_side=None):
-        self.order_queue = []
+    def __init__(self, bid_side=None, order_queue=None):
+        # order_queue can be any list-like w/ append (e.g. a SpillList when streaming)
+        self.order_queue = [] if order_queue is None else order_queue
         self.prices = set()
         if bid_side is None:
             raise ValueError("Argument bid_side must be either True or False.")
@@ -42,50 +45,51 @@ class OrderQueue:
             self.order_queue.append(curr_queue)
             return
 
-        if inplace:
-            curr_queue = self.order_queue[-1]
-        else:
-            curr_queue = copy.deepcopy(self.order_queue[-1])
-        curr_queue[0] = time
-
+        levels = list(self.order_queue[-1][1])
         if price not in self.prices:
             self.prices.add(price)
-            if len(curr_queue[1]) < 1 or not self._better(price, curr_queue[1][-1][0]):
-                curr_queue[1].append([price, [order_number]])
+            if len(levels) < 1 or not self._better(price, levels[-1][0]):
+                levels.append([price, [order_number]])
             else:
-                for idx, entry in enumerate(curr_queue[1]):
+                for idx, entry in enumerate(levels):
                     if self._better(price, entry[0]):
-                        curr_queue[1].insert(idx, [price, [order_number]])
+                        levels.insert(idx, [price, [order_number]])
                         break
         else:
-            for entry in curr_queue[1]:
+            for idx, entry in enumerate(levels):
                 if entry[0] == price:
-                    entry[1].append(order_number)
+                    levels[idx] = [entry[0], entry[1] + [order_number]]
                     break
-        if not inplace:
-            self.order_queue.append(curr_queue)
+
+        if inplace:
+            # the latest snapshot's [time, levels] pair is never shared so it can be replaced in place
+            self.order_queue[-1][0] = time
+            self.order_queue[-1][1] = levels
+        else:
+            self.order_queue.append([time, levels])
 
     def delete(self, time, price, order_number, remove_empty=True):
         if len(self.order_queue) < 1 or price not in self.prices:
             return
 
-        curr_queue = copy.deepcopy(self.order_queue[-1])
-        curr_queue[0] = time
-        for idx, entry in enumerate(curr_queue[1]):
+        levels = list(self.order_queue[-1][1])
+        for idx, entry in enumerate(levels):
             if entry[0] == price:
-                if order_number in entry[1]:
-                    entry[1].remove(order_number)
-                if len(entry[1]) == 0 and remove_empty:
+                order_numbers = list(entry[1])
+                if order_number in order_numbers:
+                    order_numbers.remove(order_number)
+                if len(order_numbers) == 0 and remove_empty:
                     self.prices.remove(price)
-                    del curr_queue[1][idx]
+                    del levels[idx]
+                else:
+                    levels[idx] = [entry[0], order_numbers]
                 break
-        self.order_queue.append(curr_queue)
+        self.order_queue.append([time, levels])
 
     def update(self, time, price, order_number, volume_decrease):
         if volume_decrease:
-            curr_queue = copy.deepcopy(self.order_queue[-1])
-            curr_queue[0] = time
-            self.order_queue.append(curr_queue)
+            # nothing in the queue changed ... the new snapshot shares the previous levels
+            self.order_queue.append([time, self.order_queue[-1][1]])
             return
         self.delete(time, price, order_number, remove_empty=False)
         self.add(time, price, order_number, inplace=True)
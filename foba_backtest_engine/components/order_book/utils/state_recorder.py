@@ -0,0 +1,384 @@
+import bisect
+from collections import namedtuple
+from collections.abc import ItemsView, Mapping, Sequence, ValuesView
+
+import numpy as np
+import pandas as pd
+
+from foba_backtest_engine.utils.base_utils import ColumnDict
+
+"""
+STATE RECORDER
+
+Columnar store for the per-message book snapshots (FeedState | OrderCountState). Instead of keeping one namedtuple
+per message alive for the whole run the builder appends its snapshot to a StateRecorder which ...
+
+    - buffers chunk_size rows as tuples (append(record) | append_row(*values), the builder passes its scalars straight
+      in w/o a namedtuple per message) & then writes them column-by-column into growable numpy arrays
+      (capacity doubles, so appends are amortized O(1))
+    - stores every field w/ a fixed dtype (see foba_states.FEED_STATE_DTYPES)
+        object  ... kept as is (bookId_, foreignLd_aggressorSide_)
+        int64   ... never None (timestamps, isTrade_)
+        float64 ... None <-> NaN (prices)
+        Int64   ... None <-> NaN, stored as float64 & handed back as int (volumes, counts)
+    - still behaves like a list of namedtuples (len | [i] | iteration) ... rows are rebuilt on access
+    - to_frame() ... DataFrame over the columns w/o going through the namedtuples (read-only views where possible)
+    - fields ... only those are stored, the others read as None (levels deeper than the snapshot_depth)
+    - ChangeStateRecorder (snapshot_mode="on_change") ... stores a state only when it changed & per message just its
+      times + the row of its state, reads still give one record per message
+
+STATE TABLE
+
+The mapping the "feed_states" loader provides ... keys are row numbers across the builders' recorders, values are the
+namedtuples (built on access) so existing processors keep working. frame() gives the whole table as one DataFrame
+indexed by those keys ... frames() (states_frames) gives it in chunks of whole books, so annotate_slippages,
+feed_state_lookups & event_enricher only hold one chunk of the states at a time (& only the columns they read).
+
+"""
+
+NULLABLE_DTYPES = ("float64", "Int64")
+# rows per StateTable.frames() chunk
+CHUNK_ROWS = 1 << 20
+
+
+class StateRecorder(Sequence):
+    def __init__(self, record_type, dtypes, chunk_size=4096, fields=None):
+        """
+        :param fields: the fields that are stored (default: all of them) ... the others are always None, e.g. the
+            levels deeper than the builder's snapshot_depth (see foba_states.snapshot_fields)
+        """
+        self.record_type = record_type
+        self.dtypes = dtypes
+        self.chunk_size = chunk_size
+        self.fields = tuple(record_type._fields if fields is None else fields)
+        # positions of the stored fields in a record ... None when every field is stored
+        self._positions = (
+            None
+            if self.fields == tuple(record_type._fields)
+            else tuple(record_type._fields.index(field) for field in self.fields)
+        )
+        self._columns = {
+            field: np.empty(0, dtype=_storage_dtype(dtypes[field]))
+            for field in self.fields
+        }
+        self._length = 0
+        self._buffer = []
+
+    def append(self, record):
+        if self._positions is not None:
+            record = tuple(record[position] for position in self._positions)
+        self._buffer.append(record)
+        if len(self._buffer) >= self.chunk_size:
+            self._flush()
+
+    def append_row(self, *values):
+        """append(record_type(*values)) w/o building the record ... values of the stored fields, in fields order"""
+        self._buffer.append(values)
+        if len(self._buffer) >= self.chunk_size:
+            self._flush()
+
+    def _flush(self):
+        if not self._buffer:
+            return
+        rows, self._buffer = self._buffer, []
+        end = self._length + len(rows)
+        capacity = len(next(iter(self._columns.values())))
+        if end > capacity:
+            self._grow(max(end, 2 * capacity))
+        for field, values in zip(self.fields, zip(*rows)):
+            self._columns[field][self._length:end] = _to_storage(values, self.dtypes[field])
+        self._length = end
+
+    def _grow(self, capacity):
+        for field, column in self._columns.items():
+            grown = np.empty(capacity, dtype=column.dtype)
+            grown[: self._length] = column[: self._length]
+            self._columns[field] = grown
+
+    def __len__(self):
+        return self._length + len(self._buffer)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("StateRecorder index out of range")
+        if index >= self._length:
+            return self._record(self._buffer[index - self._length])
+        return next(self._rows(index, index + 1))
+
+    def __iter__(self):
+        length = self._length
+        for start in range(0, length, 1 << 16):
+            yield from self._rows(start, min(start + (1 << 16), length))
+        yield from map(self._record, self._buffer[:])
+
+    def _rows(self, start, stop):
+        columns = [
+            from_storage(self._columns[field][start:stop], self.dtypes[field])
+            for field in self.fields
+        ]
+        return map(self._record, zip(*columns))
+
+    def _record(self, values):
+        """the record of the values of the stored fields"""
+        if self._positions is None:
+            return self.record_type._make(values)
+        record = [None] * len(self.record_type._fields)
+        for position, value in zip(self._positions, values):
+            record[position] = value
+        return self.record_type._make(record)
+
+    def column(self, field):
+        """
+        field as a numpy array (storage dtype ... NaN for None), read-only view when nothing is buffered ... all
+        NaN (None for objects) if the field isn't stored
+        """
+        self._flush()
+        if field not in self._columns:
+            column = np.full(self._length, None if self.dtypes[field] == "object" else np.nan)
+        else:
+            column = self._columns[field][: self._length].view()
+        column.flags.writeable = False
+        return column
+
+    def to_frame(self, index=None, fields=None):
+        """:param fields: the columns (default: every record_type field)"""
+        self._flush()
+        data = {}
+        for field in self.record_type._fields if fields is None else fields:
+            column = self.column(field)
+            if self.dtypes[field] == "Int64" and not np.isnan(column).any():
+                # same dtype pandas infers from python ints w/o any None
+                column = column.astype(np.int64)
+            data[field] = column
+        return pd.DataFrame(data, index=index, copy=False)
+
+    def __getstate__(self):
+        self._flush()
+        state = self.__dict__.copy()
+        state["_columns"] = {
+            field: column[: self._length] for field, column in self._columns.items()
+        }
+        return state
+
+    def __setstate__(self, state):
+        # pickled before only some fields could be stored
+        state.setdefault("fields", tuple(state["record_type"]._fields))
+        state.setdefault("_positions", None)
+        self.__dict__.update(state)
+
+
+StateMessage = namedtuple("StateMessage", ("createdNanos_", "received_", "timestamp_", "state_row"))
+
+
+class ChangeStateRecorder(StateRecorder):
+    """
+    A StateRecorder for snapshot_mode="on_change" ... a state row is only stored when the state changed, every message
+    just stores its times & the row of its state (a StateMessage). Reads (len | [i] | iteration | column | to_frame)
+    still give one record per message: the state as of that message w/ the message's own times, so they are the same
+    as a StateRecorder of every message
+    """
+
+    def __init__(self, record_type, dtypes, chunk_size=4096, fields=None):
+        super().__init__(record_type, dtypes, chunk_size, fields)
+        self.messages = StateRecorder(StateMessage, dict.fromkeys(StateMessage._fields, "int64"), chunk_size)
+        self._time_positions = tuple(self.fields.index(field) for field in StateMessage._fields[:-1])
+        self._states = 0
+
+    def append(self, record):
+        raise TypeError("ChangeStateRecorder only takes rows ... see append_row & repeat_row")
+
+    def append_row(self, *values):
+        """a new state ... as StateRecorder.append_row"""
+        super().append_row(*values)
+        self._states += 1
+        self.messages.append_row(*(values[position] for position in self._time_positions), self._states - 1)
+
+    def repeat_row(self, created, received, timestamp):
+        """a message that left the state as it was"""
+        self.messages.append_row(created, received, timestamp, self._states - 1)
+
+    def __len__(self):
+        return len(self.messages)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        message = self.messages[index]
+        times = dict(zip(StateMessage._fields[:-1], message[:-1]))
+        return super().__getitem__(message.state_row)._replace(**times)
+
+    def __iter__(self):
+        state_rows = self.messages.column("state_row")
+        times = [self.messages.column(field).tolist() for field in StateMessage._fields[:-1]]
+        for start in range(0, len(state_rows), 1 << 16):
+            stop = min(start + (1 << 16), len(state_rows))
+            columns = [
+                from_storage(self._state_column(field, state_rows[start:stop]), self.dtypes[field])
+                for field in self.fields
+            ]
+            for position, field_times in zip(self._time_positions, times):
+                columns[position] = field_times[start:stop]
+            yield from map(self._record, zip(*columns))
+
+    def column(self, field):
+        if field in StateMessage._fields[:-1]:
+            return self.messages.column(field)
+        column = self._state_column(field, self.messages.column("state_row"))
+        column.flags.writeable = False
+        return column
+
+    def _state_column(self, field, state_rows):
+        return super().column(field)[state_rows]
+
+
+class StateTable(Mapping):
+    def __init__(self, record_type, parts):
+        """
+        :param parts: sequences of record_type (StateRecorders, or any list-like e.g. a SpillList)
+        """
+        self.record_type = record_type
+        self.parts = [part for part in parts if len(part)]
+        self._offsets = [0]
+        for part in self.parts:
+            self._offsets.append(self._offsets[-1] + len(part))
+
+    def __len__(self):
+        return self._offsets[-1]
+
+    def __iter__(self):
+        return iter(range(len(self)))
+
+    def __contains__(self, key):
+        return isinstance(key, (int, np.integer)) and 0 <= key < len(self)
+
+    def __getitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        part = bisect.bisect_right(self._offsets, key) - 1
+        return self.parts[part][key - self._offsets[part]]
+
+    def items(self):
+        return _StateItems(self)
+
+    def values(self):
+        return _StateValues(self)
+
+    def keys_of(self, part):
+        """the keys of the rows of part (one of the sequences the table was built from) ... empty if it has no rows"""
+        for index, table_part in enumerate(self.parts):
+            if table_part is part:
+                return range(self._offsets[index], self._offsets[index + 1])
+        if len(part):
+            raise KeyError("not a part of this StateTable")
+        return range(0)
+
+    def frame(self, fields=None):
+        """all rows as one DataFrame indexed by the table keys ... prefer frames(), this holds every part at once"""
+        frames = [
+            self._part_frame(part, offset, fields) for part, offset in zip(self.parts, self._offsets)
+        ]
+        if not frames:
+            return pd.DataFrame(columns=self.record_type._fields if fields is None else list(fields))
+        return frames[0] if len(frames) == 1 else pd.concat(frames)
+
+    def frames(self, chunk_rows=CHUNK_ROWS, fields=None):
+        """
+        frame() in chunks of whole parts (a builder's states ... one book) of ~chunk_rows rows, a bigger part is a chunk
+        of its own ... only one chunk is read at a time
+        :param fields: the columns (default: every record_type field)
+        """
+        start = 0
+        while start < len(self.parts):
+            stop = start + 1
+            while stop < len(self.parts) and self._offsets[stop + 1] - self._offsets[start] <= chunk_rows:
+                stop += 1
+            frames = [
+                self._part_frame(part, offset, fields)
+                for part, offset in zip(self.parts[start:stop], self._offsets[start:stop])
+            ]
+            yield frames[0] if len(frames) == 1 else pd.concat(frames)
+            start = stop
+
+    def _part_frame(self, part, offset, fields):
+        index = pd.RangeIndex(offset, offset + len(part))
+        if isinstance(part, StateRecorder):
+            return part.to_frame(index=index, fields=fields)
+        frame = pd.DataFrame.from_records(list(part), columns=self.record_type._fields, index=index)
+        return frame if fields is None else frame[list(fields)]
+
+
+class _StateItems(ItemsView):
+    def __iter__(self):
+        key = 0
+        for part in self._mapping.parts:
+            for record in part:
+                yield key, record
+                key += 1
+
+
+class _StateValues(ValuesView):
+    def __iter__(self):
+        for part in self._mapping.parts:
+            yield from part
+
+
+def states_frames(states, chunk_rows=CHUNK_ROWS, fields=None):
+    """
+    states_frame in chunks of whole books ... StateTable.frames() for a StateTable (one chunk read at a time), the one
+    frame of any other states mapping (nothing if it is empty)
+    :param fields: the columns (default: all of them)
+    """
+    if isinstance(states, StateTable):
+        yield from states.frames(chunk_rows, fields)
+        return
+    if len(states):
+        frame = states_frame(states)
+        yield frame if fields is None else frame[list(fields)]
+
+
+def states_frame(states):
+    """
+    DataFrame of a states mapping (e.g. feed_states, foba_slippages) indexed by its keys ... straight from the columns
+    for a StateTable, the frame itself for a ColumnDict
+    """
+    if isinstance(states, StateTable):
+        return states.frame()
+    if isinstance(states, ColumnDict):
+        return states.frame
+    records = list(states.values())
+    if records and isinstance(records[0], tuple) and hasattr(records[0], "_fields"):
+        # namedtuples ... their fields are the columns
+        return pd.DataFrame.from_records(
+            records, columns=records[0]._fields, index=list(states.keys())
+        )
+    return pd.DataFrame(
+        [record._asdict() for record in records], index=list(states.keys())
+    )
+
+
+def _storage_dtype(dtype):
+    if dtype == "object":
+        return object
+    if dtype == "int64":
+        return np.int64
+    return np.float64
+
+
+def _to_storage(values, dtype):
+    if dtype in NULLABLE_DTYPES:
+        return [np.nan if value is None else value for value in values]
+    return values
+
+
+def from_storage(column, dtype):
+    """python values of a stored column (e.g. a column of states_frame) ... as the records have them (None for NaN)"""
+    values = column.tolist()
+    if dtype == "float64":
+        return [None if value != value else value for value in values]
+    if dtype == "Int64":
+        return [None if value != value else int(value) for value in values]
+    return values
@@ -12,6 +12,8 @@ import boto3
 import pandas as pd
 from botocore.exceptions import ClientError
 
+from foba_backtest_engine.utils.base_utils import load_legacy_pickle
+
 OPTIVER_BUCKET_NAME = "hkexsampledata"
 
 
@@ -132,7 +134,7 @@ class S3BucketActions:
 
     def get_pickle(self, path: str):
         return self._get_via_temp_file(
-            path, lambda filename: pickle.load(open(filename, "rb"))
+            path, lambda filename: load_legacy_pickle(open(filename, "rb"))
         )
 
     def put_pickle(self, path: str, data):
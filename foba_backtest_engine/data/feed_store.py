@@ -0,0 +1,254 @@
+import argparse
+import json
+import os
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from foba_backtest_engine.data.parquet_reader import as_nanos, read_table
+from foba_backtest_engine.utils.base_utils import get_logger
+
+"""
+----------------
+    FEED STORE
+----------------
+
+Hive-partitioned copy of the raw captures so that a run only opens the files for its date & books.
+
+    <store>/<table>/date=YYYY-MM-DD/<book_column>=<book>/part-0.parquet
+    <store>/<table>/_manifest.json
+
+a) Ingestion  (python -m foba_backtest_engine.data.feed_store --table order_book --source OrderBook.parquet --store /data/foba_store)
+    - rows are split by local date (time_zone) of the table's time_column & by book
+    - each partition is sorted by the table's sort_keys ... the order book is sorted exactly like
+      get_feed_updates sorts (sequenceNumber_, createdNanos_ asc, class_ desc) so readers can skip the sort
+    - the book column is kept inside the files (the directory name is only used for pruning)
+    - re-ingesting a date/book replaces that partition
+
+b) Manifest
+    - one entry per partition keyed "date/book" w/ path | rows | min_time | max_time (time_column, nanos)
+
+c) Reading
+    - read_store_table(store, table, date, book_ids, ...) opens only the manifest partitions for the books,
+      skips partitions outside [start_time, end_time] & concatenates them in book_ids order
+    - rows come out grouped by book (sorted within each book) ... NOT globally sorted across books
+    - iter_store_batches(...) streams the same rows as (book, DataFrame) batches for the streaming book build
+
+"""
+
+logger = get_logger(__name__)
+
+MANIFEST_NAME = "_manifest.json"
+
+StoreTable = namedtuple("StoreTable", ("book_column", "time_column", "sort_keys"))
+
+STORE_TABLES = {
+    "order_book": StoreTable(
+        "securityCode_",
+        "createdNanos_",
+        (
+            ("sequenceNumber_", "ascending"),
+            ("createdNanos_", "ascending"),
+            ("class_", "descending"),
+        ),
+    ),
+    "broker_queue": StoreTable(
+        "securityCode_",
+        "createdNanos_",
+        (
+            ("timestampNanos_", "ascending"),
+            ("side_", "ascending"),
+            ("priority_", "ascending"),
+        ),
+    ),
+    "order_insert": StoreTable("feedcode", "publish_time", ()),
+    "delete_operation": StoreTable("feedcode", "publish_time", ()),
+    "private_trade": StoreTable("feedcode", "trade_time", ()),
+    "private_feed": StoreTable("feedcode", "log_time", ()),
+}
+
+
+def ingest(source_path, store_path, table_name, date=None, time_zone="Asia/Hong_Kong"):
+    """
+    Rewrites a raw capture into the store & updates the manifest.
+    :param date: YYYY-MM-DD ... if given every row goes to this date, otherwise the date is taken from time_column
+    :return: the manifest entries written
+    """
+    spec = STORE_TABLES[table_name]
+    table = ds.dataset(source_path, format="parquet").to_table()
+    table = table.drop_columns(
+        [name for name in table.column_names if name.startswith("__index_level_")]
+    )
+
+    times = table.column(spec.time_column).to_numpy()
+    if date is None:
+        dates = (
+            pd.to_datetime(times, utc=True).tz_convert(time_zone).strftime("%Y-%m-%d")
+        )
+    else:
+        dates = pd.Index([date] * len(times))
+    books = table.column(spec.book_column).to_pandas().astype(str)
+
+    table_path = os.path.join(store_path, table_name)
+    manifest = load_manifest(store_path, table_name)
+    written = {}
+    for (partition_date, book), indices in (
+        pd.DataFrame({"date": dates, "book": books.values})
+        .groupby(["date", "book"], sort=True)
+        .indices.items()
+    ):
+        partition = table.take(indices)
+        if spec.sort_keys:
+            partition = partition.sort_by(list(spec.sort_keys))
+        relative_path = os.path.join(
+            f"date={partition_date}", f"{spec.book_column}={book}", "part-0.parquet"
+        )
+        os.makedirs(os.path.dirname(os.path.join(table_path, relative_path)), exist_ok=True)
+        pq.write_table(partition, os.path.join(table_path, relative_path))
+
+        partition_times = partition.column(spec.time_column).to_numpy()
+        written[_partition_key(partition_date, book)] = dict(
+            date=partition_date,
+            book=book,
+            path=relative_path,
+            rows=partition.num_rows,
+            min_time=int(partition_times.min()),
+            max_time=int(partition_times.max()),
+        )
+        logger.debug(f"feed_store: wrote {table_name} {partition_date}/{book} ({partition.num_rows} rows)")
+
+    manifest["partitions"].update(written)
+    with open(os.path.join(table_path, MANIFEST_NAME), "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=1, sort_keys=True)
+    return written
+
+
+def load_manifest(store_path, table_name):
+    spec = STORE_TABLES[table_name]
+    manifest_path = os.path.join(store_path, table_name, MANIFEST_NAME)
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as manifest_file:
+            return json.load(manifest_file)
+    return dict(
+        table=table_name,
+        book_column=spec.book_column,
+        time_column=spec.time_column,
+        sort_keys=[list(key) for key in spec.sort_keys],
+        partitions={},
+    )
+
+
+def read_store_table(
+    store_path,
+    table_name,
+    date,
+    book_ids,
+    columns=None,
+    start_time=None,
+    end_time=None,
+):
+    """
+    Reads the partitions of table_name for date & book_ids (in book_ids order) into a DataFrame.
+    The [start_time, end_time] window prunes partitions on the manifest bounds & is applied in the scan.
+    """
+    spec = STORE_TABLES[table_name]
+    manifest = load_manifest(store_path, table_name)
+    if not manifest["partitions"]:
+        raise FileNotFoundError(f"No {table_name} partitions in feed store {store_path}")
+
+    start, end = as_nanos(start_time), as_nanos(end_time)
+    paths = []
+    for book in book_ids:
+        entry = manifest["partitions"].get(_partition_key(date, str(book)))
+        if entry is None:
+            continue
+        if start is not None and entry["max_time"] < start:
+            continue
+        if end is not None and entry["min_time"] > end:
+            continue
+        paths.append(os.path.join(store_path, table_name, entry["path"]))
+
+    if not paths:
+        any_entry = next(iter(manifest["partitions"].values()))
+        schema = pq.read_schema(os.path.join(store_path, table_name, any_entry["path"]))
+        empty = schema.empty_table()
+        return (empty.select(columns) if columns is not None else empty).to_pandas()
+
+    return read_table(
+        paths,
+        columns=columns,
+        time_column=spec.time_column,
+        start_time=start,
+        end_time=end,
+        partitioning=None,
+    )
+
+
+def iter_store_batches(
+    store_path,
+    table_name,
+    date,
+    book_ids,
+    columns=None,
+    batch_size=100_000,
+    start_time=None,
+    end_time=None,
+):
+    """
+    Streams the partitions of table_name for date & book_ids (in book_ids order) as (book, DataFrame) batches of
+    at most batch_size rows ... only one row group is decoded at a time. Rows outside [start_time, end_time] are dropped.
+    """
+    spec = STORE_TABLES[table_name]
+    manifest = load_manifest(store_path, table_name)
+    start, end = as_nanos(start_time), as_nanos(end_time)
+    for book in book_ids:
+        entry = manifest["partitions"].get(_partition_key(date, str(book)))
+        if entry is None:
+            continue
+        parquet_file = pq.ParquetFile(os.path.join(store_path, table_name, entry["path"]))
+        read_columns = None
+        if columns is not None:
+            read_columns = list(columns) + (
+                [spec.time_column] if spec.time_column not in columns else []
+            )
+        for batch in parquet_file.iter_batches(batch_size=batch_size, columns=read_columns):
+            dataframe = batch.to_pandas()
+            times = dataframe[spec.time_column].to_numpy()
+            in_window = np.ones(len(times), dtype=bool)
+            if start is not None:
+                in_window &= times >= start
+            if end is not None:
+                in_window &= times <= end
+            dataframe = dataframe[in_window]
+            if len(dataframe):
+                yield str(book), dataframe.reset_index(drop=True)[
+                    columns if columns is not None else dataframe.columns
+                ]
+
+
+def _partition_key(date, book):
+    return f"{date}/{book}"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Ingest a raw capture into the date/book partitioned feed store"
+    )
+    parser.add_argument("--table", required=True, choices=sorted(STORE_TABLES))
+    parser.add_argument("--source", required=True, help="raw capture (parquet file or directory)")
+    parser.add_argument("--store", required=True, help="feed store root")
+    parser.add_argument("--date", default=None, help="YYYY-MM-DD, default: derived from the time column")
+    parser.add_argument("--time-zone", default="Asia/Hong_Kong")
+    arguments = parser.parse_args()
+
+    entries = ingest(
+        arguments.source,
+        arguments.store,
+        arguments.table,
+        date=arguments.date,
+        time_zone=arguments.time_zone,
+    )
+    print(f"{arguments.table}: wrote {len(entries)} partitions ({sum(e['rows'] for e in entries.values())} rows)")
@@ -0,0 +1,155 @@
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+from foba_backtest_engine.utils.time_utils import to_nano_timestamp
+
+"""
+-------------------
+    TABLE READER
+-------------------
+
+Shared reader for the raw captures (order book, broker queue, own orders, static data). Instead of
+pd.read_parquet(path) followed by pandas filtering we open the file(s) as a pyarrow dataset & push the
+filters down into the scan:
+
+    - book filter ... book_column.isin(book_ids)
+        ... book_ids are cast to the on-disk type of book_column (e.g. securityCode_ is a str in the
+            order book but an int64 in the broker queue) so the comparison happens in arrow
+    - time window ... start_time <= time_column <= end_time   (inclusive, nanos)
+        ... start/end can be arrow objects (converted w/ to_nano_timestamp) or ints
+    - columns ... only the requested columns are decoded
+
+For parquet the scan uses the row-group min/max statistics of the filtered columns to skip row groups
+that can not match, so single-book runs against a full market capture only decode the row groups that
+contain the book (best when the file is written sorted/clustered by securityCode_).
+
+format="feather" reads Arrow IPC files (memory mapped) through the same path.
+
+read_arrow_table ... the same scan w/o the pandas conversion, iter_table_batches ... the same rows in DataFrames of at
+most batch_size rows, only one batch is decoded at a time
+
+"""
+
+
+def read_table(
+    path,
+    columns=None,
+    book_column=None,
+    book_ids=None,
+    time_column=None,
+    start_time=None,
+    end_time=None,
+    format="parquet",
+    partitioning="hive",
+):
+    """
+    Reads path into a pandas DataFrame applying the book/time filters and the column subset in the scan.
+    :param path: file, list of files or directory (a directory is read as a hive partitioned dataset)
+    :param columns: columns to decode, None for all
+    :param book_column: column compared against book_ids
+    :param book_ids: iterable of book ids (any type castable to the book_column type)
+    :param time_column: nanos column the [start_time, end_time] window is applied on
+    :param partitioning: passed to pyarrow.dataset.dataset, None to ignore key=value directories
+    :return: pandas.DataFrame
+    """
+    return read_arrow_table(
+        path, columns, book_column, book_ids, time_column, start_time, end_time, format, partitioning
+    ).to_pandas()
+
+
+def read_arrow_table(
+    path,
+    columns=None,
+    book_column=None,
+    book_ids=None,
+    time_column=None,
+    start_time=None,
+    end_time=None,
+    format="parquet",
+    partitioning="hive",
+):
+    """read_table as a pyarrow.Table"""
+    dataset = ds.dataset(path, format=format, partitioning=partitioning)
+    expression = table_filter(
+        dataset.schema, book_column, book_ids, time_column, start_time, end_time
+    )
+    return dataset.to_table(columns=columns, filter=expression)
+
+
+def iter_table_batches(
+    path,
+    columns=None,
+    book_column=None,
+    book_ids=None,
+    time_column=None,
+    start_time=None,
+    end_time=None,
+    batch_size=100_000,
+    format="parquet",
+    partitioning="hive",
+):
+    """read_table's rows (same order) as DataFrames of batch_size rows (the last one fewer)"""
+    dataset = ds.dataset(path, format=format, partitioning=partitioning)
+    expression = table_filter(
+        dataset.schema, book_column, book_ids, time_column, start_time, end_time
+    )
+    pending = None
+    for batch in dataset.to_batches(columns=columns, filter=expression, batch_size=batch_size):
+        if not batch.num_rows:
+            continue
+        table = pa.Table.from_batches([batch])
+        pending = table if pending is None else pa.concat_tables([pending, table])
+        while pending.num_rows >= batch_size:
+            yield pending.slice(0, batch_size).to_pandas()
+            pending = pending.slice(batch_size)
+    if pending is not None and pending.num_rows:
+        yield pending.to_pandas()
+
+
+def table_filter(
+    schema,
+    book_column=None,
+    book_ids=None,
+    time_column=None,
+    start_time=None,
+    end_time=None,
+):
+    expression = None
+    if book_column is not None and book_ids is not None:
+        expression = _and(
+            expression,
+            ds.field(book_column).isin(
+                _as_field_values(book_ids, schema.field(book_column).type)
+            ),
+        )
+    if time_column is not None and start_time is not None:
+        expression = _and(expression, ds.field(time_column) >= as_nanos(start_time))
+    if time_column is not None and end_time is not None:
+        expression = _and(expression, ds.field(time_column) <= as_nanos(end_time))
+    return expression
+
+
+def _and(expression, other):
+    return other if expression is None else expression & other
+
+
+def as_nanos(time):
+    if time is None or isinstance(time, int):
+        return time
+    return int(to_nano_timestamp(time))
+
+
+def _as_field_values(values, field_type):
+    if pa.types.is_integer(field_type):
+        cast, invalid = [], []
+        for value in values:
+            try:
+                cast.append(int(value))
+            except (TypeError, ValueError):
+                invalid.append(value)
+        if invalid:
+            raise ValueError(f"Can't cast the book ids {invalid} to the {field_type} book column")
+        return pa.array(cast, type=field_type)
+    if pa.types.is_string(field_type) or pa.types.is_large_string(field_type):
+        return pa.array([str(value) for value in values], type=field_type)
+    return pa.array(list(values), type=field_type)
@@ -1,5 +1,4 @@
-import pandas as pd
-
+from foba_backtest_engine.components.order_book.builders.OMDC import SNAPSHOT_DEPTH
 from foba_backtest_engine.components.order_book.processors.foba_book_builder import (
     pybuilders,
 )
@@ -20,6 +19,7 @@ from foba_backtest_engine.components.order_book.utils.foba_fee_enrichment import
     static_data_enrichment,
 )
 from foba_backtest_engine.components.order_book.utils.foba_feedstates import (
+    feed_state_lookups,
     feed_states_at_join,
     fetch_feed_stats_from_book_builders,
     full_feed_state_enrichment,
@@ -45,6 +45,7 @@ from foba_backtest_engine.components.order_book.utils.foba_own_orders import (
 )
 from foba_backtest_engine.components.order_book.utils.foba_slippages import (
     annotate_slippages,
+    fetch_slippages_from_book_builders,
 )
 from foba_backtest_engine.components.order_book.utils.foba_static_data_info import (
     static_data_info,
@@ -59,10 +60,14 @@ from foba_backtest_engine.components.order_book.utils.foba_time import (
 )
 from foba_backtest_engine.enrichment import Enrichment, configure
 from foba_backtest_engine.utils.base_utils import ImmutableRecord, get_logger
+from foba_backtest_engine.utils.resource_cache import DEFAULT_MAX_BYTES, ResourceCache
 from foba_backtest_engine.utils.time_utils import start_end_time
 
 logger = get_logger(__name__)
 
+# read all 5 levels of the feed states (bbov) ... see OmdcBookBuilder c) Snapshots
+FULL_DEPTH_PROCESSORS = ("fetch_slippages_from_book_builders", "annotate_slippages")
+
 
 class Engine:
     def __init__(
@@ -89,6 +94,7 @@ class Engine:
         self.result_type = result_type
         self.config = config or {}
         self.results = None
+        self.profile = None
 
     """
     ------------------
@@ -112,24 +118,56 @@ class Engine:
         logger.debug("Passive Analysis Mode: Started")
         configuration = self._generate_passive_analysis_configuration()
         processors = self._get_passive_analysis_processors(configuration)
-        enriched_events = list(
-            Enrichment(
-                processors, configuration, auto_cleanup_resources=True
-            ).joined_enrichments("foba_events")
+        enrichment = Enrichment(
+            processors,
+            configuration,
+            auto_cleanup_resources=True,
+            scheduler=self.config.get("enrichment_scheduler", "sequential"),
+            max_workers=self.config.get("enrichment_workers", 4),
+            enricher_processes=self.config.get("enricher_processes", False),
+            resource_cache=self._resource_cache(),
+            profile_capture=self.config.get("profile_capture", None),
+            profile_directory=self.config.get("profile_directory", None),
+        )
+        self.profile = enrichment.profile
+        self.profile.metadata.update(
+            mode=self.mode,
+            date=self.date,
+            book_ids=list(self.book_ids),
+            config={key: value for key, value in self.config.items() if isinstance(value, (bool, int, float, str))},
         )
+        self._export_profile(self.config.get("profile_report_path", None))
 
         logger.debug("Passive Analysis Mode: Completed")
         if result_type == "dataframe":
-            FOBA_df = pd.DataFrame([record._asdict() for record in enriched_events])
-            self.results = FOBA_df
+            self.results = enrichment.joined_frame("foba_events")
         elif result_type == "list":
-            self.results = enriched_events
+            self.results = list(enrichment.joined_enrichments("foba_events"))
         else:
-            self.results = enriched_events
+            self.results = list(enrichment.joined_enrichments("foba_events"))
             logger.error(
                 f"stored results as list - defaulted to this format as invalid result_type provided = {result_type}"
             )
 
+    def _export_profile(self, path):
+        """profile_report_path ... *.json is written as JSON, anything else as parquet"""
+        if path is None:
+            return
+        if path.endswith(".json"):
+            self.profile.to_json(path)
+        else:
+            self.profile.to_parquet(path)
+        logger.debug(f"Wrote the processor profile to {path}")
+
+    def _resource_cache(self):
+        directory = self.config.get("resource_cache_directory", None)
+        if directory is None:
+            return None
+        return ResourceCache(
+            directory,
+            max_bytes=self.config.get("resource_cache_max_bytes", DEFAULT_MAX_BYTES),
+        )
+
     """
     ------------------
      (2) CONFIG GENERATION
@@ -150,6 +188,12 @@ class Engine:
         include_only_optiver_pulls = self.config.get("include_only_optiver_pulls", True)
         exclude_inplace_updates = self.config.get("exclude_inplace_updates", True)
         book_build_parallel = self.config.get("book_build_parallel", False)
+        book_build_feed_transport = self.config.get("book_build_feed_transport", "storage")
+        book_build_streaming = self.config.get("book_build_streaming", False)
+        stream_batch_size = self.config.get("stream_batch_size", 100_000)
+        spill_directory = self.config.get("spill_directory", None)
+        snapshot_depth = self.config.get("snapshot_depth", 5)
+        snapshot_mode = self.config.get("snapshot_mode", "every_message")
         conflated_broker_queue_path = self.config.get("conflated_broker_queue_path", "/Workspace/Users/kartikeya.bisht@optiver.com.au/FOBA_create/data/ConflatedBrokerQueue.parquet")
         order_book_path = self.config.get("order_book_path", "/Workspace/Users/kartikeya.bisht@optiver.com.au/FOBA_create/data/OrderBook.parquet")
         fee_info_path = self.config.get("fee_info_path", "/Workspace/Users/kartikeya.bisht@optiver.com.au/FOBA_create/FeeInfo.parquet")
@@ -160,6 +204,8 @@ class Engine:
         private_trade_path=self.config.get("private_trade_path", "/Workspace/Users/kartikeya.bisht@optiver.com.au/FOBA_create/PrivateTrade.parquet")
         private_feed_path=self.config.get("private_feed_path", "/Workspace/Users/kartikeya.bisht@optiver.com.au/FOBA_create/PrivateFeed.parquet")
         broker_mapping_path=self.config.get("broker_mapping_path", "/Workspace/Users/kartikeya.bisht@optiver.com.au/FOBA_create/BrokerMapping.parquet")
+        # date/book partitioned store written by foba_backtest_engine.data.feed_store ... takes precedence over the paths above
+        feed_store_path = self.config.get("feed_store_path", None)
         
         sent_times = self.config.get(
             "sent_times",
@@ -211,7 +257,8 @@ class Engine:
             fee_info_path = fee_info_path,
             tick_schedule_path = tick_schedule_path,
             fee_schedule_path = fee_schedule_path,
-            broker_mapping_path=broker_mapping_path
+            broker_mapping_path=broker_mapping_path,
+            feed_store_path=feed_store_path,
         )
 
         configuration = dict(
@@ -219,6 +266,12 @@ class Engine:
             max_workers=max_workers,
             pybuilder_exchange=pybuilder_exchange,
             book_build_parallel=book_build_parallel,
+            book_build_feed_transport=book_build_feed_transport,
+            book_build_streaming=book_build_streaming,
+            stream_batch_size=stream_batch_size,
+            spill_directory=spill_directory,
+            snapshot_depth=snapshot_depth,
+            snapshot_mode=snapshot_mode,
             tick_schedule_table_name="TickScheduleTickRules",
             sent_times=sent_times,
             annotation_min_change=annotation_min_change,
@@ -270,7 +323,9 @@ class Engine:
         processors.append(send_times)
 
         processors.append(fetch_feed_stats_from_book_builders)
+        processors.append(fetch_slippages_from_book_builders)
         processors.append(annotate_slippages)
+        processors.append(feed_state_lookups)
         processors.append(full_feed_state_enrichment)
         processors.append(feed_states_at_join)
 
@@ -297,4 +352,21 @@ class Engine:
             processors.append(foreign_counterparty_enrichment)
             processors.append(broker_orders_enrichment)
 
+        _check_snapshot_depth(configuration["snapshot_depth"], processors)
         return processors
+
+
+"""
+HELPERS
+"""
+
+
+def _check_snapshot_depth(snapshot_depth, processors):
+    if snapshot_depth >= SNAPSHOT_DEPTH:
+        return
+    names = [processor.__name__ for processor in processors if processor.__name__ in FULL_DEPTH_PROCESSORS]
+    if names:
+        raise ValueError(
+            f"snapshot_depth={snapshot_depth} leaves the levels {snapshot_depth}-{SNAPSHOT_DEPTH - 1} empty but "
+            f"{', '.join(names)} read all {SNAPSHOT_DEPTH} for the bbov ... use snapshot_depth={SNAPSHOT_DEPTH}"
+        )
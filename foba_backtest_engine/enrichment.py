@@ -41,6 +41,19 @@ enricher
         The enrichments should be namedtuples (or, a similar type with the _fields attribute, e.g. ImmutableRecord).
         The keys of the map should be the ids of the resource named in @enriches.
 
+(c)     Columnar enrichers
+        ~~~~~~~~~~~~~~~~~~
+
+        An enricher that works on whole columns (e.g. w/ numpy) instead of record by record:
+
+        * Decorate the function with @provides and @enriches_columns('name of enriched resource')
+        * The parameter named like the enriched resource receives it as a DataFrame ... one column per field, indexed by
+        the ids (shared between columnar enrichers of the same resource, so don't modify it in place). An empty resource
+        is an empty frame w/o columns (there is no record to take the fields from) ... check frame.empty first
+        * Return a DataFrame indexed by (a subset of) those ids, or a dict of columns aligned with the frame.
+        It is provided as a ColumnDict (records named after the processor, e.g. CategoryEnrichment), so other
+        processors can still use it record by record & joined_frame joins its columns directly.
+
 Configuration
 -------------
 
@@ -60,7 +73,40 @@ The order of the processors is important:
 each processor can only depend on resources provided by other processors earlier in the list.
 
 Once the Enrichment is constructed, you can join all the enrichments for a particular loaded resource
-by calling joined_enrichments
+by calling joined_enrichments (one record per object) or joined_frame (one DataFrame, joined column by column)
+
+Scheduling
+----------
+
+scheduler="sequential" (default) runs the processors one after another in list order.
+
+scheduler="dag" builds the dependency graph from _requires/_provides (a processor waits for the latest earlier
+processor providing each resource it requires that isn't configuration) & runs every processor whose dependencies
+are done concurrently on a pool of max_workers ...
+
+* loaders (& enrichers by default) run on a thread pool ... good for I/O-bound loaders
+* enricher_processes=True (or a collection of enricher names) sends those enrichers to a process pool instead ...
+  for CPU-bound enrichers. The processor & its inputs are pickled to the worker, so only worth it when the work
+  dominates the transfer. Records of a namedtuple type created inside the enricher (e.g. FullFeedStateAtEvent) come
+  back (& go to other workers) as rows + fields (see utils/resource_cache.py encode_records); outputs that still can't
+  be pickled are rerun on the thread pool
+* enrichments are still recorded in list order, so joined_enrichments / joined_frame give the same columns
+* with auto_cleanup_resources a resource is dropped once every processor requiring it has finished ... & with
+  keep_resources_on_disk too, only the resources of the processors about to run stay in memory (the others are loaded
+  back from disk when needed)
+
+Caching
+-------
+
+resource_cache=ResourceCache(directory) loads a processor's output from disk when the same processor (code & configured
+kwargs) already ran on the same inputs, & stores it otherwise ... see utils/resource_cache.py
+
+Profiling
+---------
+
+enrichment.profile is a ProfileReport with one row per processor (wall & CPU time, peak RSS delta, rows in & out, bytes
+created & freed by auto cleanup) ... export it with to_json / to_parquet. profile_capture="cprofile" | "pyinstrument"
+also captures a profile of every processor into profile_directory ... see utils/profiling.py
 
 """
 
@@ -68,22 +114,40 @@ import copy
 import datetime
 import os
 import pickle
-import time
-from collections import defaultdict, deque, namedtuple
+import shutil
+import tempfile
+import weakref
+from collections import Counter, defaultdict, deque, namedtuple
+from collections.abc import Mapping
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from functools import partial
 from inspect import Parameter, signature
+from operator import attrgetter
 from warnings import warn
 
 import pandas as pd
 
+from foba_backtest_engine.utils import futures, profiling
+from foba_backtest_engine.utils.resource_cache import (
+    NotCacheable,
+    decode_records,
+    encode_records,
+    resource_token,
+    value_token,
+)
+from foba_backtest_engine.utils import resource_spill
 from foba_backtest_engine.utils.base_utils import (
+    ColumnDict,
     ImmutableDict,
     ImmutableRecord,
     get_logger,
+    load_legacy_pickle,
 )
 
 logger = get_logger(__name__)
 
+SCHEDULERS = ("sequential", "dag")
+
 
 class Enrichment:
     def __init__(
@@ -99,8 +163,20 @@ class Enrichment:
         keep_resources_on_disk=False,
         on_disk_location="/data/tmp/foba/",
         processor_resource_look_forward=3,
+        scheduler="sequential",
+        max_workers=4,
+        enricher_processes=False,
+        resource_cache=None,
+        profile_capture=None,
+        profile_directory=None,
     ):
         """Run the enrichment with the given processors and configuration."""
+        if scheduler not in SCHEDULERS:
+            raise ValueError(f"scheduler must be one of {SCHEDULERS}, got {scheduler!r}")
+        if profile_capture is not None and profile_capture not in profiling.CAPTURES:
+            raise ValueError(
+                f"profile_capture must be None or one of {profiling.CAPTURES}, got {profile_capture!r}"
+            )
         self.resources = dict()
         self.configuration = configuration.copy()
         self.enrichments = defaultdict(list)
@@ -109,6 +185,7 @@ class Enrichment:
         self.persist_dropped = persist_dropped
         self.keep_resources_on_disk = keep_resources_on_disk
         self.on_disk_location = on_disk_location
+        self._spill_directory = None
         self.successful_processors = []
         self.pending_processors = deque(processors)
 
@@ -116,6 +193,22 @@ class Enrichment:
         self.processor_resource_look_forward = processor_resource_look_forward
         self.auto_cleanup_resources = auto_cleanup_resources
         self.required_memory_resources = {}
+        self.scheduler = scheduler
+        self.max_workers = max_workers
+        self.enricher_processes = enricher_processes
+        self.resource_cache = resource_cache
+        self._resource_tokens = {}
+        self.profile_capture = profile_capture
+        self.profile_directory = profile_directory
+        self.profile = profiling.ProfileReport(
+            metadata=dict(
+                scheduler=scheduler,
+                max_workers=max_workers,
+                started=datetime.datetime.now().isoformat(),
+            )
+        )
+        self._resource_bytes = {}
+        self._frames = {}
 
         self.check_processors_requirements(processors, configuration)
         self.accumulate_in_memory_processors(processors, configuration)
@@ -125,16 +218,135 @@ class Enrichment:
     def run_processors(self, processors, test_mode, test_name, test_processor):
         if test_mode:
             self.run_test_mode(test_name, test_processor, processors)
+        elif self.scheduler == "dag":
+            self.run_dag(processors)
         else:
-            profile_dict = dict()
             for processor in processors:
-                start = time.time()
                 self._process(processor)
-                end = time.time()
-                profile_dict[processor.__name__] = {"TimeTaken": end - start}
-            print(
-                pd.DataFrame(profile_dict).T.sort_values("TimeTaken", ascending=False)
+        logger.info(f"Processor profile\n{self.profile}")
+
+    def run_dag(self, processors):
+        dependencies = _processor_dependencies(processors, self.configuration)
+        consumers = Counter(
+            name for processor in processors for name in _required_names(processor)
+        )
+        waiting = dict(enumerate(dependencies))
+        running = {}
+        call_kwargs = {}
+        cache_keys = {}
+        completed = []
+        done = set()
+        outputs = {}
+
+        thread_pool = futures.make_executor(
+            True,
+            safer=False,
+            max_workers=self.max_workers,
+            executor_cls=ThreadPoolExecutor,
+        )
+        process_pool = None
+        if self.enricher_processes:
+            # check_pickles ... an input that can't be pickled raises on submit instead of in the pool's feeder thread
+            process_pool = futures.check_pickles(
+                futures.make_executor(True, safer=False, max_workers=self.max_workers)
             )
+        try:
+            while waiting or running:
+                for index in [i for i, depends in waiting.items() if depends <= done]:
+                    del waiting[index]
+                    processor = processors[index]
+                    call_kwargs[index] = self._call_kwargs(processor)
+                    cache_keys[index] = self._cache_key(processor, call_kwargs[index])
+                    hit, output = self._load_cached(processor, cache_keys[index])
+                    if hit:
+                        completed.append((index, output, profiling.NO_CALL, True))
+                        continue
+                    logger.debug("Running processor: " + processor.__name__)
+                    if self._runs_in_process(processor):
+                        try:
+                            encoded_kwargs = {name: encode_records(value) for name, value in call_kwargs[index].items()}
+                            future = process_pool.submit(*self._profiled_call(processor, encoded_kwargs, _encoded_call))
+                        except (pickle.PicklingError, AttributeError, TypeError) as error:
+                            self._warn_not_in_process(processor, error)
+                        else:
+                            running[future] = index
+                            continue
+                    running[thread_pool.submit(*self._profiled_call(processor, call_kwargs[index], alone=False))] = index
+
+                # nothing to wait for when every ready processor was a cache hit
+                finished = wait(running, return_when=FIRST_COMPLETED)[0] if running else ()
+                for future in finished:
+                    index = running.pop(future)
+                    processor = processors[index]
+                    try:
+                        output, stats = future.result()
+                        output = _column_output(processor, call_kwargs[index], decode_records(output))
+                    except pickle.PicklingError as error:
+                        # the output couldn't be sent back from the worker
+                        self._warn_not_in_process(processor, error)
+                        running[thread_pool.submit(*self._profiled_call(processor, call_kwargs[index], alone=False))] = index
+                        continue
+                    except:
+                        if self.auto_persist:
+                            self._persist_on_failure(processor)
+                        raise
+                    logger.debug(f"{processor.__name__} produced {len(output)} results")
+                    self._store_cached(processor, cache_keys[index], output)
+                    completed.append((index, output, stats, False))
+
+                for index, output, stats, hit in completed:
+                    processor = processors[index]
+                    self._store_output(processor, output, cache_keys.pop(index))
+                    self._record_profile(processor, call_kwargs[index], output, stats, hit)
+                    if getattr(processor, "_enriches", None):
+                        outputs[index] = output
+                    del call_kwargs[index]
+                    done.add(index)
+                    self.successful_processors.append(processor)
+                    self.pending_processors.remove(processor)
+
+                    if self.auto_cleanup_resources:
+                        for name in _required_names(processor):
+                            consumers[name] -= 1
+                        freed = self._delete(
+                            name
+                            for name in (*_required_names(processor), *processor._provides)
+                            if not consumers[name]
+                            and name not in self.configuration
+                            and name != "foba_events"
+                        )
+                        self.profile.freed(processor.__name__, freed)
+                if self.auto_cleanup_resources and self.keep_resources_on_disk:
+                    # as auto_remove_processes_from_memory ... running processors already hold their inputs
+                    ready = [processors[i] for i, depends in waiting.items() if depends <= done]
+                    self._remove_from_memory(
+                        {name for ready_processor in ready for name in _required_names(ready_processor)}
+                    )
+                completed = []
+        finally:
+            for pool in (thread_pool, process_pool):
+                if pool is not None:
+                    pool.shutdown(cancel_futures=True)
+
+        # recorded in list order (not completion order) so the joined columns don't depend on the schedule
+        for index, processor in enumerate(processors):
+            enriches = getattr(processor, "_enriches", None)
+            if enriches:
+                self._record_enrichment(processor._provides, enriches, outputs[index])
+
+    @staticmethod
+    def _warn_not_in_process(processor, error):
+        # e.g. records of a namedtuple type created inside a processor can't be pickled
+        logger.warning(
+            f"{processor.__name__} can't run in a worker process ({error}), running it on a thread"
+        )
+
+    def _runs_in_process(self, processor):
+        if not hasattr(processor, "_enriches"):
+            return False
+        if self.enricher_processes is True:
+            return True
+        return processor.__name__ in (self.enricher_processes or ())
 
     def run_test_mode(self, test_name, test_processor, processors):
         if test_processor and test_name:
@@ -231,19 +443,24 @@ class Enrichment:
         return provided_since_start
 
     def auto_remove_processes_from_memory(self, processor):
-        not_required = (
-            set(self.resources.keys())
-            - self.required_memory_resources[processor.__name__]
-        )
+        self._remove_from_memory(self.required_memory_resources[processor.__name__])
+
+    def _remove_from_memory(self, required):
+        """drops every resource but required from memory ... it's loaded back from disk when needed"""
+        not_required = set(self.resources.keys()) - required
         not_required -= set(self.configuration.keys())
         for name in not_required:
             logger.debug(f"Deleting resource from memory: {name}")
             del self.resources[name]
+            self._frames.pop(name, None)
 
     def _process(self, processor):
         if self.auto_cleanup_resources:
             if hasattr(processor, "__name__"):
-                self._delete(self.expired_resources[processor.__name__])
+                freed = self._delete(self.expired_resources[processor.__name__])
+                if self.successful_processors:
+                    # expired once the previous processor had run
+                    self.profile.freed(self.successful_processors[-1].__name__, freed)
                 if self.keep_resources_on_disk:
                     self.auto_remove_processes_from_memory(processor)
         else:
@@ -259,28 +476,29 @@ class Enrichment:
                 return
 
         provides = processor._provides
-        self._check_duplicate_providers(provides)
-
-        kwargs = dict(self._processor_kwargs(processor))
-
+        kwargs = self._call_kwargs(processor)
         enriches = getattr(processor, "_enriches", None)
-        if enriches:
-            _check_enricher_parameters(processor, kwargs)
 
         processor_name = processor.__name__
-        logger.debug("Running processor: " + processor_name)
-        try:
-            output = processor(**kwargs)
-        except:
-            if self.auto_persist:
-                self._persist_on_failure(processor)
-            raise
-        logger.debug(f"{processor_name} produced {len(output)} results")
+        cache_key = self._cache_key(processor, kwargs)
+        hit, output = self._load_cached(processor, cache_key)
+        stats = profiling.NO_CALL
+        if not hit:
+            logger.debug("Running processor: " + processor_name)
+            try:
+                output, stats = profiling.profiled_call(
+                    processor, kwargs, self.profile_capture, self.profile_directory
+                )
+                output = _column_output(processor, kwargs, output)
+            except:
+                if self.auto_persist:
+                    self._persist_on_failure(processor)
+                raise
+            logger.debug(f"{processor_name} produced {len(output)} results")
+            self._store_cached(processor, cache_key, output)
 
-        for name in provides:
-            if self.keep_resources_on_disk:
-                self.save_resource_to_disk(output, name)
-            self.resources[name] = output
+        self._store_output(processor, output, cache_key)
+        self._record_profile(processor, kwargs, output, stats, hit)
 
         if enriches:
             self._record_enrichment(provides, enriches, output)
@@ -288,15 +506,117 @@ class Enrichment:
         self.successful_processors.append(processor)
         self.pending_processors.popleft()
 
+    def _call_kwargs(self, processor):
+        self._check_duplicate_providers(processor._provides)
+        kwargs = dict(self._processor_kwargs(processor))
+        if getattr(processor, "_enriches", None):
+            _check_enricher_parameters(processor, kwargs)
+        if getattr(processor, "_columnar", False):
+            kwargs[processor._enriches] = self._resource_frame(processor._enriches, kwargs[processor._enriches])
+        return kwargs
+
+    def _resource_frame(self, name, resource):
+        """the resource as a DataFrame indexed by its ids ... built once per resource"""
+        if isinstance(resource, ColumnDict):
+            return resource.frame
+        cached = self._frames.get(name)
+        if cached is not None and cached[0] is resource:
+            return cached[1]
+        frame = _records_frame(list(resource.values()))
+        frame.index = pd.Index(list(resource.keys()))
+        self._frames[name] = (resource, frame)
+        return frame
+
+    def _store_output(self, processor, output, cache_key=None):
+        for name in processor._provides:
+            if self.keep_resources_on_disk:
+                self.save_resource_to_disk(output, name)
+            self.resources[name] = output
+            if cache_key is not None:
+                try:
+                    self._resource_tokens[name] = resource_token(cache_key, output)
+                except NotCacheable as error:
+                    # nothing downstream of it is cached either
+                    logger.debug(f"Not caching the processors requiring {name}: {error}")
+                    self._resource_tokens[name] = None
+
+    def _profiled_call(self, processor, kwargs, call=profiling.profiled_call, alone=True):
+        """
+        :param alone: False for the thread pool ... other processors run in this process meanwhile
+        :return: the function & arguments to submit to a pool
+        """
+        return call, processor, kwargs, self.profile_capture, self.profile_directory, alone
+
+    def _record_profile(self, processor, kwargs, output, stats, cache_hit):
+        num_bytes = profiling.approximate_bytes(output)
+        for name in processor._provides:
+            self._resource_bytes[name] = num_bytes
+        rows_in = sum(
+            profiling.rows(kwargs[name]) or 0
+            for name in _required_names(processor)
+            if name in kwargs and name not in self.configuration
+        )
+        self.profile.add(
+            profiling.ProcessorProfile(
+                processor.__name__,
+                *stats,
+                rows_in=rows_in,
+                rows_out=profiling.rows(output),
+                bytes_created=num_bytes,
+                bytes_freed=0,
+                cache_hit=cache_hit,
+            )
+        )
+
+    def _cache_key(self, processor, kwargs):
+        if self.resource_cache is None:
+            return None
+        try:
+            input_tokens = {
+                name: (
+                    self._resource_token(name)
+                    if name in self._resource_tokens and name not in self.configuration
+                    else value_token(value)
+                )
+                for name, value in kwargs.items()
+            }
+            return self.resource_cache.key(processor, input_tokens)
+        except NotCacheable as error:
+            logger.debug(f"Not caching {processor.__name__}: {error}")
+            return None
+
+    def _resource_token(self, name):
+        token = self._resource_tokens[name]
+        if token is None:
+            raise NotCacheable(f"{name} has no token")
+        return token
+
+    def _load_cached(self, processor, cache_key):
+        if cache_key is None:
+            return False, None
+        return self.resource_cache.load(processor.__name__, cache_key)
+
+    def _store_cached(self, processor, cache_key, output):
+        if cache_key is not None:
+            self.resource_cache.store(processor.__name__, cache_key, output)
+
     def _delete(self, resource_names):
+        """:return: estimated bytes freed (a resource still known under another name isn't freed)"""
+        freed = 0
         for name in resource_names:
             if name in self.resources:
                 logger.debug(f"Deleting resource from memory: {name}")
-                del self.resources[name]
-            if self.keep_resources_on_disk:
-                if os.path.exists(self.on_disk_location + name):
-                    logger.debug(f"Deleting resource from disk: {name}")
-                    os.remove(self.on_disk_location + name)
+                resource = self.resources.pop(name)
+                self._frames.pop(name, None)
+                num_bytes = self._resource_bytes.pop(name, 0)
+                if not any(other is resource for other in self.resources.values()):
+                    freed += num_bytes
+            if self.keep_resources_on_disk and self._spill_directory is not None:
+                for path in resource_spill.spill_paths(os.path.join(self._spill_directory, name)):
+                    if os.path.exists(path):
+                        logger.debug(f"Deleting resource from disk: {name}")
+                        os.remove(path)
+        return freed
 
     def _record_enrichment(self, provides, enriches, output):
         for name in provides:
@@ -348,14 +668,36 @@ class Enrichment:
         for event_dict in all_event_dicts:
             yield ImmutableRecord(**event_dict)
 
+    def joined_frame(self, name):
+        """
+        DataFrame of the loaded resource with all of its enrichments ... same rows & columns as joined_enrichments
+        but built column by column (each enrichment is aligned on the common ids once) instead of merging a dict per event
+        """
+        resources, enrichments, common_ids = self._common_ids(name)
+        columns = {}
+        for source in (resources, *enrichments):
+            frame = _aligned_frame(source, common_ids)
+            # later enrichments overwrite earlier fields of the same name (as dict.update does)
+            columns.update(frame.items())
+        return pd.DataFrame(columns, index=pd.RangeIndex(len(common_ids)))
+
     def _joined_dicts(self, name):
+        resources, enrichments, common_ids = self._common_ids(name)
+        for event_id in common_ids:
+            event_dict = resources[event_id]._asdict()
+            for enrichment in enrichments:
+                event_dict.update(enrichment[event_id]._asdict())
+            yield event_dict
+
+    def _common_ids(self, name):
+        """ids (in resource order) that every enrichment has ... the others are dropped (& persisted if persist_dropped)"""
         if self.keep_resources_on_disk:
             resources = self.load_resource(name)
         else:
             resources = self.resources[name]
         enrichments = self.enrichments[name]
-        common_ids = set(resources).intersection(*enrichments)
-        non_common_ids = set(resources).difference(common_ids)
+        common = set(resources).intersection(*enrichments)
+        non_common_ids = set(resources).difference(common)
 
         dropped_events = []
         for id in non_common_ids:
@@ -368,68 +710,117 @@ class Enrichment:
         if self.persist_dropped:
             self.persist_dropped_events(dropped_events)
 
-        num_missing_events = len(resources) - len(common_ids)
+        num_missing_events = len(resources) - len(common)
         if num_missing_events != 0:
             warn(
                 f"dropping {num_missing_events} events because they are missing enrichments"
             )
 
-        for event_id in common_ids:
-            event_dict = resources[event_id]._asdict()
-            for enrichment in enrichments:
-                event_dict.update(enrichment[event_id]._asdict())
-            yield event_dict
+        common_ids = [event_id for event_id in resources if event_id in common]
+        return resources, enrichments, common_ids
 
     def _persist_on_failure(self, processor):
         name = f"failed_run_{processor.__name__}_{datetime.date.today()}"
         self._persist_required_resources(name)
 
     def _persist_required_resources(self, test_name):
-        persist_resources = {}
+        directory = Enrichment._persist_path(test_name)
+        os.makedirs(directory, exist_ok=True)
         for key, value in self.resources.items():
             try:
-                with open("tmp", "wb") as file:
-                    pickle.dump(value, file)
-                persist_resources[key] = value
-            except AttributeError:
-                continue
-        with open(Enrichment._persist_path(test_name), "wb") as file:
-            pickle.dump(persist_resources, file)
+                resource_spill.save_resource(value, os.path.join(directory, key))
+            except (AttributeError, TypeError, pickle.PicklingError):
+                for path in resource_spill.spill_paths(os.path.join(directory, key)):
+                    if os.path.exists(path):
+                        os.remove(path)
 
     @staticmethod
     def _load_persited_resources(test_name):
-        if os.path.isfile(Enrichment._persist_path(test_name)):
+        directory = Enrichment._persist_path(test_name)
+        if os.path.isdir(directory):
+            logger.debug("Retrieving saved provides from file")
+            names = {os.path.splitext(file_name)[0] for file_name in os.listdir(directory)}
+            return {name: resource_spill.load_resource(os.path.join(directory, name)) for name in names}
+        elif os.path.isfile(directory + ".pckl"):
+            # persisted before the columnar spill format
             logger.debug("Retrieving saved provides from file")
-            with open(Enrichment._persist_path(test_name), "rb") as file:
-                provides = pickle.load(file)
-            return provides
+            with open(directory + ".pckl", "rb") as file:
+                return load_legacy_pickle(file)
         else:
             logger.debug(f"No file {test_name}. Running all processors")
             return {}
 
     @staticmethod
     def _persist_path(test_name):
-        return f"{test_name}_persisted_provides.pckl"
+        return f"{test_name}_persisted_provides"
 
     def persist_dropped_events(self, events):
         with open(f"dropped_events_{datetime.date.today()}", "wb") as file:
             pickle.dump({"events": events, "enrichments": self.enrichments}, file)
 
     def load_resource(self, resource_name):
-        if os.path.exists(self.on_disk_location + resource_name):
-            logger.debug(f"Loading {resource_name} from file")
-            with open(self.on_disk_location + resource_name, "rb") as file:
-                resource = pickle.load(file)
-        else:
-            raise KeyError
-        return resource
+        if self._spill_directory is None or not resource_spill.resource_exists(
+            os.path.join(self._spill_directory, resource_name)
+        ):
+            raise KeyError(resource_name)
+        logger.debug(f"Loading {resource_name} from file")
+        return resource_spill.load_resource(os.path.join(self._spill_directory, resource_name))
 
     def save_resource_to_disk(self, resource, resource_name):
-        if not os.path.isdir(self.on_disk_location):
+        if self._spill_directory is None:
+            # one directory per run under on_disk_location, removed with the Enrichment
             os.makedirs(self.on_disk_location, exist_ok=True)
+            self._spill_directory = tempfile.mkdtemp(prefix="run_", dir=self.on_disk_location)
+            weakref.finalize(self, shutil.rmtree, self._spill_directory, ignore_errors=True)
         logger.debug(f"Saving {resource_name} to file")
-        with open(self.on_disk_location + resource_name, "wb") as file:
-            pickle.dump(resource, file)
+        resource_spill.save_resource(resource, os.path.join(self._spill_directory, resource_name))
+
+
+def _required_names(processor):
+    return [
+        parameter.name
+        for parameter in processor._requires.values()
+        if parameter.kind not in (Parameter.VAR_POSITIONAL, Parameter.VAR_KEYWORD)
+    ]
+
+
+def _processor_dependencies(processors, configuration):
+    """for each processor the indices of the earlier processors providing what it requires (configuration wins)"""
+    providers = {}
+    dependencies = []
+    for index, processor in enumerate(processors):
+        dependencies.append(
+            {
+                providers[name]
+                for name in _required_names(processor)
+                if name in providers and name not in configuration
+            }
+        )
+        for name in processor._provides:
+            providers[name] = index
+    return dependencies
+
+
+def _encoded_call(processor, kwargs, capture, directory, alone):
+    """profiling.profiled_call in a worker process ... inputs & output are sent through encode_records"""
+    kwargs = {name: decode_records(value) for name, value in kwargs.items()}
+    output, stats = profiling.profiled_call(processor, kwargs, capture, directory, alone)
+    return encode_records(output), stats
+
+
+def _column_output(processor, kwargs, output):
+    """the output of an @enriches_columns processor as a ColumnDict keyed by the ids of the enriched frame"""
+    if not getattr(processor, "_columnar", False) or isinstance(output, ColumnDict):
+        return output
+    if isinstance(output, pd.DataFrame):
+        frame = output
+    elif isinstance(output, Mapping):
+        frame = pd.DataFrame(dict(output), index=kwargs[processor._enriches].index)
+    else:
+        raise TypeError(
+            f"{processor.__name__} enriches columns, so it must return a DataFrame or a dict of columns, got {type(output)}"
+        )
+    return ColumnDict(frame, typename=_camel_case(processor.__name__))
 
 
 def _check_enricher_parameters(processor, kwargs):
@@ -439,6 +830,36 @@ def _check_enricher_parameters(processor, kwargs):
         )
 
 
+def _aligned_frame(source, common_ids):
+    """
+    DataFrame (RangeIndex) of the records of source at common_ids ... straight from the values when the keys already
+    are common_ids (the usual case), otherwise its rows are taken by position through an index of the keys
+    """
+    if isinstance(source, ColumnDict):
+        frame, keys = source.frame, source.frame.index
+    else:
+        frame, keys = _records_frame(list(source.values())), pd.Index(list(source.keys()))
+    if len(keys) == len(common_ids) and keys.equals(pd.Index(common_ids)):
+        return frame.reset_index(drop=True)
+    return frame.take(keys.get_indexer(common_ids)).reset_index(drop=True)
+
+
+def _records_frame(records):
+    """
+    DataFrame of equally long records ... one from_records over the tuples when they all share the same fields,
+    otherwise via their dicts (NaN where a record doesn't have the field, as for the list of dicts before)
+    """
+    if not records:
+        return pd.DataFrame()
+    fields = records[0]._fields
+    if not all(record._fields == fields for record in records):
+        return pd.DataFrame([record._asdict() for record in records])
+    if not isinstance(records[0], tuple):
+        getter = attrgetter(*fields)
+        records = [getter(record) for record in records] if len(fields) > 1 else [(getter(record),) for record in records]
+    return pd.DataFrame.from_records(records, columns=fields)
+
+
 def _camel_case(snake_case):
     return "".join(_camel_case_characters(snake_case))
 
@@ -479,6 +900,17 @@ def enriches(name):
     return wrapper
 
 
+def enriches_columns(name):
+    """Mark a callable as enriching a resource with the given name, column by column ... see (c) Columnar enrichers"""
+
+    def wrapper(function):
+        function._enriches = name
+        function._columnar = True
+        return function
+
+    return wrapper
+
+
 def configure(processor, **kwargs):
     """Configure the processor with the given keyword arguments."""
     configured_function = partial(processor, **kwargs)
@@ -490,6 +922,8 @@ def configure(processor, **kwargs):
 
     if hasattr(processor, "_enriches"):
         configured_function._enriches = processor._enriches
+    if hasattr(processor, "_columnar"):
+        configured_function._columnar = processor._columnar
 
     return configured_function
 
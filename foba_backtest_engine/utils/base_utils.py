@@ -1,8 +1,18 @@
+import io
 import logging
-from collections import defaultdict
-from collections.abc import Mapping
+import pickle
+from collections import defaultdict, namedtuple
+from collections.abc import ItemsView, Mapping, ValuesView
 from functools import total_ordering
 from heapq import heappop, heappush
+from operator import itemgetter
+
+try:
+    from _collections import _tuplegetter
+except ImportError:
+    # as in collections.namedtuple
+    def _tuplegetter(index, doc):
+        return property(itemgetter(index), doc=doc)
 
 
 class ReprMixin:
@@ -75,6 +85,85 @@ class ImmutableDict(Mapping):
     def __len__(self):
         return len(self._dict)
 
+    # straight to the dict (instead of Mapping's per key __getitem__) ... read only views
+    def __contains__(self, item):
+        return item in self._dict
+
+    def get(self, key, default=None):
+        return self._dict.get(key, default)
+
+    def keys(self):
+        return self._dict.keys()
+
+    def values(self):
+        return self._dict.values()
+
+    def items(self):
+        return self._dict.items()
+
+
+class ColumnDict(Mapping):
+    """
+    ImmutableDict of records backed by the columns of a DataFrame ... the frame's index are the keys & its columns the
+    fields of the records (a namedtuple type called typename), which are only built when accessed.
+
+    This is what @enriches_columns processors provide, so their output can still be used record by record.
+    """
+
+    def __init__(self, frame, typename="Record"):
+        self.frame = frame
+        self.typename = typename
+        self.record_type = namedtuple(typename, list(frame.columns))
+        self._positions = None
+        self._columns = None
+
+    def __reduce__(self):
+        # the record type is created here, so it can't pickle
+        return ColumnDict, (self.frame, self.typename)
+
+    def __getitem__(self, item):
+        position = self._key_positions()[item]
+        return self.record_type._make(column[position] for column in self._column_lists())
+
+    def __contains__(self, item):
+        return item in self._key_positions()
+
+    def __iter__(self):
+        return iter(self.frame.index)
+
+    def __len__(self):
+        return len(self.frame)
+
+    def values(self):
+        return _ColumnDictValues(self)
+
+    def items(self):
+        return _ColumnDictItems(self)
+
+    def _records(self):
+        return map(self.record_type._make, zip(*self._column_lists()))
+
+    def _key_positions(self):
+        if self._positions is None:
+            self._positions = {key: position for position, key in enumerate(self.frame.index)}
+        return self._positions
+
+    def _column_lists(self):
+        # python values, as the records of an ImmutableDict would have
+        if self._columns is None:
+            self._columns = [self.frame[column].tolist() for column in self.frame.columns]
+        return self._columns
+
+
+class _ColumnDictValues(ValuesView):
+    def __iter__(self):
+        return self._mapping._records()
+
+
+class _ColumnDictItems(ItemsView):
+    def __iter__(self):
+        return zip(self._mapping.frame.index, self._mapping._records())
+
 
 def get_logger(module_name, level=logging.DEBUG):
     """
@@ -101,36 +190,180 @@ def get_logger(module_name, level=logging.DEBUG):
     return logger
 
 
-class ImmutableRecord(Record):
+class ImmutableRecord(tuple):
     """Immutable record type.
 
     This has a similar interface to namedtuple except:
 
     - can't construct with positional arguments
-    - can't index
     - can add new fields in _replace
     - instances can always pickle (dynamically created namedtuple types can't pickle)
+
+    Records are tuples of their values ... every set of fields (in order) gets one interned subclass (see
+    immutable_record_class) w/ an attribute per field, so a record costs a tuple (no per-record __dict__ or _fields) &
+    attribute access is as fast as on a namedtuple. isinstance(record, ImmutableRecord) holds for all of them.
+    Records pickled before they were tuples (fields in the instance __dict__) load through load_legacy_pickle ...
+    plain pickle.load raises on them (object.__new__ isn't allowed on a tuple subclass), so every loader of persisted
+    data (resource cache, spilled & persisted resources, S3 pickles) goes through it.
+
+    As tuples, records are iterable, indexable (in field order) & have a len(). They are always truthy though (as the
+    old records were), even w/o fields.
     """
 
-    def __init__(self, **kwargs):
-        for field in kwargs:
-            if field[0] == "_":
-                raise ValueError(
-                    f"Field names cannot start with an underscore: {field!r}"
-                )
+    __slots__ = ()
+    _fields = ()
+
+    def __new__(cls, **kwargs):
+        fields = tuple(kwargs)
+        return tuple.__new__(immutable_record_class(fields), kwargs.values())
 
-        super().__init__(**kwargs)
-        self.__dict__["_fields"] = tuple(self.__dict__)
+    @classmethod
+    def _make(cls, values):
+        """records of this subclass' fields from the values (in field order)"""
+        return tuple.__new__(cls, values)
 
     def _asdict(self):
-        data = super()._asdict()
-        del data["_fields"]
-        return data
+        """Return the object as a dict.
+
+        This functions the same as the namedtuple _asdict method.
+        """
+        return dict(zip(self._fields, self))
+
+    def _replace(self, **kwargs):
+        """Return a new record with new or updated fields as given in kwargs.
+
+        This is similar to the namedtuple _replace method, except new fields can be added.
+        """
+        data = self._asdict()
+        data.update(kwargs)
+        return ImmutableRecord(**data)
+
+    def _set_missing(self, **kwargs):
+        """Return a new record with missing fields filled as given in kwargs.
+
+        A field counts as missing if it is absent or is None.
+        """
+        data = self._asdict()
+        for key, value in kwargs.items():
+            if data.get(key) is None:
+                data[key] = value
+        return ImmutableRecord(**data)
+
+    def __eq__(self, other):
+        return self._asdict() == other._asdict()
+
+    def __ne__(self, other):
+        return not self == other
+
+    # equal records can have different field orders
+    __hash__ = None
+
+    def __bool__(self):
+        return True
+
+    def __reduce__(self):
+        return _immutable_record, (self._fields, tuple(self))
+
+    def __repr__(self):
+        return _repr(self, self._fields)
 
     def __setattr__(self, key, value):
         raise TypeError("Attribute assignment is not supported")
 
 
+_RECORD_CLASSES = {}
+
+
+def immutable_record_class(fields):
+    """the (interned) ImmutableRecord subclass of the given fields ... its _make builds records from values"""
+    record_class = _RECORD_CLASSES.get(fields)
+    if record_class is not None:
+        return record_class
+    for field in fields:
+        if field[0] == "_":
+            raise ValueError(f"Field names cannot start with an underscore: {field!r}")
+    namespace = {"__slots__": (), "_fields": fields}
+    for index, field in enumerate(fields):
+        namespace[field] = _tuplegetter(index, f"Alias for field number {index}")
+    record_class = type(ImmutableRecord.__name__, (ImmutableRecord,), namespace)
+    record_class.__module__ = ImmutableRecord.__module__
+    _RECORD_CLASSES[fields] = record_class
+    return record_class
+
+
+def _immutable_record(fields, values):
+    return tuple.__new__(immutable_record_class(fields), values)
+
+
+class LegacyUnpickler(pickle.Unpickler):
+    """
+    Unpickler that also reads ImmutableRecords pickled before records were tuples (their fields were the instance
+    __dict__, e.g. resources persisted to .pckl files) ... see load_legacy_pickle
+    """
+
+    def __init__(self, file):
+        super().__init__(file)
+        self.legacy_records = False
+
+    def find_class(self, module, name):
+        # records pickled as tuples refer to _immutable_record, only the old ones to the class itself
+        if module == ImmutableRecord.__module__ and name == ImmutableRecord.__name__:
+            self.legacy_records = True
+            return _LegacyImmutableRecord
+        return super().find_class(module, name)
+
+
+def load_legacy_pickle(file):
+    """pickle.load that turns ImmutableRecords pickled w/ their fields in __dict__ into the current (tuple) records"""
+    unpickler = LegacyUnpickler(file)
+    value = unpickler.load()
+    return _upgraded_records(value, {}) if unpickler.legacy_records else value
+
+
+def loads_legacy_pickle(data):
+    """pickle.loads counterpart of load_legacy_pickle"""
+    return load_legacy_pickle(io.BytesIO(data))
+
+
+class _LegacyImmutableRecord:
+    """an ImmutableRecord as it was pickled before records were tuples ... pickle restores its __dict__"""
+
+
+def _upgraded_records(value, upgraded):
+    """value w/ every _LegacyImmutableRecord in it (containers & records included) as an ImmutableRecord"""
+    if isinstance(value, (str, bytes, int, float)) or value is None:
+        return value
+    key = id(value)
+    if key in upgraded:
+        return upgraded[key]
+    if value is _LegacyImmutableRecord:
+        return ImmutableRecord
+    if isinstance(value, _LegacyImmutableRecord):
+        state = dict(value.__dict__)
+        fields = state.pop("_fields", tuple(state))
+        upgraded[key] = ImmutableRecord(**{field: _upgraded_records(state[field], upgraded) for field in fields})
+    elif isinstance(value, ImmutableDict):
+        upgraded[key] = value
+        for item_key, item in value._dict.items():
+            value._dict[item_key] = _upgraded_records(item, upgraded)
+    elif isinstance(value, dict):
+        upgraded[key] = value
+        for item_key, item in value.items():
+            value[item_key] = _upgraded_records(item, upgraded)
+    elif isinstance(value, list):
+        upgraded[key] = value
+        value[:] = [_upgraded_records(item, upgraded) for item in value]
+    elif isinstance(value, tuple):
+        # namedtuples & records of the same type, plain tuples as tuples
+        items = [_upgraded_records(item, upgraded) for item in value]
+        upgraded[key] = type(value)._make(items) if hasattr(type(value), "_make") else tuple(items)
+    elif isinstance(value, (set, frozenset)):
+        upgraded[key] = type(value)(_upgraded_records(item, upgraded) for item in value)
+    else:
+        upgraded[key] = value
+    return upgraded[key]
+
+
 def multi_dict(values, key):
     """Create a dict that groups values together which have the same key.
 
@@ -1,3 +1,4 @@
+import gc
 import pickle
 from concurrent import futures
 from functools import wraps
@@ -7,6 +8,7 @@ A suite of executors/functions for asynchronous OR synchronous function executio
 
 1) make_executor() - use this to decide if we execute functions in a synchronous | asynchronous manner
 2) check_pickles() 
+    ... PicklingFunction / unpickle_result - return a large result pickled & load it with the cyclic GC paused
 3) check_on_shutdown() - tracks all submitted futures & when executor.shutdown() is called - it checks if any execptions were raised and raises these ... for debugging
 
 """
@@ -90,6 +92,28 @@ class UnpicklingFunction:
         return self._function(*args, **kwargs)
 
 
+class PicklingFunction:
+    def __init__(self, function):
+        self._function = function
+
+    def __call__(self, *args, **kwargs):
+        return pickle.dumps(self._function(*args, **kwargs), protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def unpickle_result(pickled_result):
+    """
+    Load the result of a PicklingFunction with the cyclic GC paused ... rebuilding many small objects (e.g. a book's
+    trades & order queue snapshots) otherwise triggers full collections over the caller's (large) heap
+    """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return pickle.loads(pickled_result)
+    finally:
+        if enabled:
+            gc.enable()
+
+
 class SynchronousExecutor(futures.Executor):
     """Futures executor that runs submitted functions synchronously.
 
@@ -0,0 +1,276 @@
+import cProfile
+import json
+import os
+import sys
+import threading
+import time
+from collections import namedtuple
+from collections.abc import Mapping, Sized
+from itertools import islice
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from foba_backtest_engine.utils.base_utils import get_logger
+
+logger = get_logger(__name__)
+
+"""
+PROFILING
+
+Per-processor profile of an Enrichment run (Enrichment.profile / Engine.profile) ... one ProcessorProfile per processor
+
+    wall_time       seconds from call to return
+    cpu_time        CPU seconds of the thread running the processor (child processes, e.g. book_build_parallel, aren't counted)
+    peak_rss_delta  bytes the process' RSS rose above its RSS at the call ... see (b)
+    rows_in         len() of every resource the processor requires (configuration isn't counted)
+    rows_out        len() of its output
+    bytes_created   estimated size of its output
+    bytes_freed     estimated size of the resources auto cleanup dropped once it had run
+    cache_hit       output loaded from the resource cache (times are then ~0)
+
+a) Byte estimates ... size of the container + len * average size of the first SAMPLE_SIZE values (a record & its fields,
+   one level deep). Objects behind a value (e.g. a book builder's feed states) aren't followed
+b) The peak of a call is the highest RSS a background thread sees polling every RSS_INTERVAL seconds (a shorter spike
+   can be missed), or the process' high water mark when it rose during a call that ran alone. The high water mark is
+   never reset per call ... it stays the peak of the whole run (batch.py resets it once per shard)
+   With scheduler="dag" processors overlap ... wall time & peak RSS include whatever ran alongside
+c) capture="cprofile" | "pyinstrument" (+ capture_directory) writes <processor>.prof | <processor>.html per processor.
+   pyinstrument isn't a dependency of the engine ... install it to use that capture
+
+Export: ProfileReport.frame() | to_json(path) | to_parquet(path) ... metadata (e.g. engine config) goes with the report
+
+"""
+
+CAPTURES = ("cprofile", "pyinstrument")
+SAMPLE_SIZE = 100
+RSS_INTERVAL = 0.01
+
+ProcessorProfile = namedtuple(
+    "ProcessorProfile",
+    "processor wall_time cpu_time peak_rss_delta rows_in rows_out bytes_created bytes_freed cache_hit",
+)
+
+CallStats = namedtuple("CallStats", "wall_time cpu_time peak_rss_delta")
+
+NO_CALL = CallStats(0.0, 0.0, 0)
+
+
+class ProfileReport:
+    def __init__(self, profiles=(), metadata=None):
+        self.profiles = list(profiles)
+        self.metadata = dict(metadata or {})
+
+    def add(self, profile):
+        self.profiles.append(profile)
+
+    def freed(self, processor_name, num_bytes):
+        """attribute resources dropped by auto cleanup to the processor after which they were dropped"""
+        for index in reversed(range(len(self.profiles))):
+            profile = self.profiles[index]
+            if profile.processor == processor_name:
+                self.profiles[index] = profile._replace(bytes_freed=profile.bytes_freed + num_bytes)
+                return
+
+    def frame(self):
+        return pd.DataFrame(self.profiles, columns=ProcessorProfile._fields)
+
+    def to_dict(self):
+        return {
+            "metadata": self.metadata,
+            "processors": [profile._asdict() for profile in self.profiles],
+        }
+
+    def to_json(self, path):
+        with open(path, "w") as file:
+            json.dump(self.to_dict(), file, indent=2, default=str)
+
+    def to_parquet(self, path):
+        """metadata is stored under the "profile" key of the parquet schema metadata"""
+        table = pa.Table.from_pandas(self.frame(), preserve_index=False)
+        metadata = {**(table.schema.metadata or {}), b"profile": json.dumps(self.metadata, default=str).encode()}
+        pq.write_table(table.replace_schema_metadata(metadata), path)
+
+    def __len__(self):
+        return len(self.profiles)
+
+    def __str__(self):
+        return self.frame().sort_values("wall_time", ascending=False).to_string(index=False)
+
+
+def profiled_call(processor, kwargs, capture=None, capture_directory=None, alone=True):
+    """
+    Call processor(**kwargs) & measure it ... used in the worker itself, so it also holds in a process pool
+    :param alone: nothing else runs in this process meanwhile, so a rise of the high water mark is this call's (see (b))
+    :return: (output, CallStats)
+    """
+    profiler = _start_capture(processor, capture)
+    rss = current_rss()
+    high_water = peak_rss()
+    cpu_start = time.thread_time()
+    start = time.perf_counter()
+    try:
+        with _RssSampler(rss) as sampler:
+            output = processor(**kwargs)
+    finally:
+        wall_time = time.perf_counter() - start
+        cpu_time = time.thread_time() - cpu_start
+        _stop_capture(processor, capture, capture_directory, profiler)
+    peak = peak_rss()
+    if rss is None:
+        peak_delta = peak - high_water
+    elif alone and peak > high_water:
+        peak_delta = max(peak, sampler.peak) - rss
+    else:
+        peak_delta = sampler.peak - rss
+    return output, CallStats(wall_time, cpu_time, max(peak_delta, 0))
+
+
+def rows(value):
+    return len(value) if isinstance(value, Sized) else None
+
+
+def approximate_bytes(value, sample_size=SAMPLE_SIZE):
+    """estimated size of a resource ... see (a)"""
+    size = sys.getsizeof(value)
+    if isinstance(value, Mapping):
+        size += sys.getsizeof(getattr(value, "_dict", None) or ())
+        values = value.values()
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        values = value
+    else:
+        return size
+    if not len(values):
+        return size
+    sample = list(islice(values, sample_size))
+    return int(size + len(values) * sum(map(_value_bytes, sample)) / len(sample))
+
+
+def reset_peak_rss():
+    """
+    reset the high water mark of the whole process (e.g. per batch shard) ... not per call, see (b)
+    :return: the current RSS in bytes (the peak from here on is peak_rss())
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as file:
+            file.write("5")
+    except OSError:
+        return peak_rss()
+    return _proc_status_bytes("VmRSS")
+
+
+def current_rss():
+    """:return: the RSS in bytes, None where /proc isn't available"""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * _PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def peak_rss():
+    peak = _proc_status_bytes("VmHWM")
+    if peak is not None:
+        return peak
+    import resource
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kB elsewhere
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+"""
+HELPERS
+"""
+
+
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+class _RssSampler:
+    """highest RSS seen by a background thread while the with block runs ... only the RSS of this process is read"""
+
+    def __init__(self, rss, interval=RSS_INTERVAL):
+        self.peak = rss
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="rss-sampler", daemon=True)
+
+    def __enter__(self):
+        if self.peak is not None:
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._thread.is_alive():
+            self._stop.set()
+            self._thread.join()
+            self._sample()
+        return False
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def _sample(self):
+        rss = current_rss()
+        if rss is not None and rss > self.peak:
+            self.peak = rss
+
+
+def _value_bytes(value):
+    size = sys.getsizeof(value)
+    if isinstance(value, tuple):
+        return size + sum(map(sys.getsizeof, value))
+    fields = getattr(value, "__dict__", None)
+    if fields is not None:
+        return size + sys.getsizeof(fields) + sum(map(sys.getsizeof, fields.values()))
+    return size
+
+
+def _start_capture(processor, capture):
+    if capture is None:
+        return None
+    if capture == "pyinstrument":
+        from pyinstrument import Profiler
+
+        profiler = Profiler()
+        profiler.start()
+        return profiler
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError as error:
+        # another profiler is already active on this thread/interpreter
+        logger.warning(f"Not capturing a profile of {processor.__name__} ({error})")
+        return None
+    return profiler
+
+
+def _stop_capture(processor, capture, capture_directory, profiler):
+    if profiler is None:
+        return
+    if capture == "pyinstrument":
+        profiler.stop()
+    else:
+        profiler.disable()
+    if capture_directory is None:
+        return
+    os.makedirs(capture_directory, exist_ok=True)
+    if capture == "pyinstrument":
+        with open(os.path.join(capture_directory, f"{processor.__name__}.html"), "w") as file:
+            file.write(profiler.output_html())
+    else:
+        profiler.dump_stats(os.path.join(capture_directory, f"{processor.__name__}.prof"))
+
+
+def _proc_status_bytes(field):
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
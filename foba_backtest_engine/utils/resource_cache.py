@@ -0,0 +1,323 @@
+import argparse
+import hashlib
+import inspect
+import os
+import pickle
+import sys
+import tempfile
+import time
+from collections import namedtuple
+from collections.abc import Mapping
+from functools import lru_cache, partial
+from types import ModuleType
+
+from foba_backtest_engine.utils.base_utils import (
+    ColumnDict,
+    ImmutableDict,
+    ImmutableRecord,
+    get_logger,
+    load_legacy_pickle,
+)
+from foba_backtest_engine.utils.spill_list import list_pickler
+
+logger = get_logger(__name__)
+
+"""
+RESOURCE CACHE
+
+Persistent, content-addressed cache of processor outputs across runs (see Enrichment(resource_cache=...)). Re-running
+the pipeline with one tweaked parameter only recomputes the processors downstream of that parameter.
+
+a) Keys
+    - processor ... name + hash of the source of its module & of every package module it imports (transitively, as
+      found in the modules' globals) + the kwargs bound by configure()
+    - inputs ... for every parameter either
+        configuration value -> hash of its pickle + size & mtime of every path in it (strings that are existing paths,
+                               also inside records | mappings | sequences e.g. the filter's data paths). A feed
+                               store directory (data/feed_store.py) is its manifests ... any other directory (e.g. the
+                               spill_directory) is a scratch location & only its path counts
+        resource            -> the resource's token (below)
+    - a resource's token = key of the processor that produced it + hash of the resource's keys. The keys matter:
+      id_dict keys are object ids, so a recomputed resource has different keys than a cached one & anything keyed
+      on it has to be recomputed as well
+
+b) Entries
+    - one pickle per entry, <processor>-<key>.pkl ... written to a temp file & renamed, so a crash never leaves a
+      half written entry
+    - SpillLists are stored as plain lists (their spill file belongs to the run that wrote them)
+    - mappings of records whose namedtuple type was created inside the processor (FeedStateSlippages etc. can't
+      pickle) are stored as rows + fields & get an equivalent type back on load
+    - outputs that still can't be pickled are simply not cached
+
+c) Eviction
+    - least recently used first (a hit touches the entry) once the directory holds more than max_bytes
+
+CLI
+
+    python -m foba_backtest_engine.utils.resource_cache --directory <dir> info
+    python -m foba_backtest_engine.utils.resource_cache --directory <dir> clear [--processor pybuilders]
+
+"""
+
+DEFAULT_MAX_BYTES = 50 * 1024**3
+ENTRY_SUFFIX = ".pkl"
+
+STORE_MANIFEST_NAME = "_manifest.json"  # data/feed_store.py
+
+CacheEntry = namedtuple("CacheEntry", "processor key path size last_used")
+
+_RecordRows = namedtuple("_RecordRows", "typename fields keys rows")
+
+
+class NotCacheable(Exception):
+    """an input has no stable token ... the processor simply isn't cached"""
+
+
+class ResourceCache:
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, processor, input_tokens):
+        """
+        :param input_tokens: parameter name -> token (see Enrichment._input_tokens)
+        """
+        digest = hashlib.sha256(processor_token(processor).encode())
+        for name in sorted(input_tokens):
+            digest.update(f"{name}={input_tokens[name]};".encode())
+        return digest.hexdigest()[:32]
+
+    def load(self, name, key):
+        """:return: (hit, value)"""
+        path = self._path(name, key)
+        if not os.path.exists(path):
+            return False, None
+        try:
+            with open(path, "rb") as entry_file:
+                value = decode_records(load_legacy_pickle(entry_file))
+        except Exception as error:
+            logger.warning(f"Dropping unreadable cache entry {path} ({error})")
+            _remove(path)
+            return False, None
+        os.utime(path)
+        logger.debug(f"Loaded {name} from the resource cache")
+        return True, value
+
+    def store(self, name, key, value):
+        descriptor, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(descriptor, "wb") as entry_file:
+                list_pickler(entry_file).dump(encode_records(value))
+                size = entry_file.tell()
+        except Exception as error:
+            _remove(temp_path)
+            logger.warning(f"Not caching {name} ... output can't be pickled ({error})")
+            return False
+        if size > self.max_bytes:
+            _remove(temp_path)
+            logger.warning(f"Not caching {name} ... {size} bytes is above max_bytes")
+            return False
+        os.replace(temp_path, self._path(name, key))
+        self.evict()
+        return True
+
+    def entries(self):
+        """cache entries, least recently used first"""
+        entries = []
+        for file_name in os.listdir(self.directory):
+            if not file_name.endswith(ENTRY_SUFFIX):
+                continue
+            path = os.path.join(self.directory, file_name)
+            processor, _, key = file_name[: -len(ENTRY_SUFFIX)].rpartition("-")
+            stat = os.stat(path)
+            entries.append(CacheEntry(processor, key, path, stat.st_size, stat.st_mtime))
+        return sorted(entries, key=lambda entry: entry.last_used)
+
+    def evict(self):
+        entries = self.entries()
+        total = sum(entry.size for entry in entries)
+        for entry in entries:
+            if total <= self.max_bytes:
+                break
+            logger.debug(f"Evicting {entry.processor} ({entry.size} bytes) from the resource cache")
+            _remove(entry.path)
+            total -= entry.size
+
+    def clear(self, processor=None):
+        removed = 0
+        for entry in self.entries():
+            if processor is None or entry.processor == processor:
+                _remove(entry.path)
+                removed += 1
+        return removed
+
+    def _path(self, name, key):
+        return os.path.join(self.directory, f"{name}-{key}{ENTRY_SUFFIX}")
+
+
+def processor_token(processor):
+    bound = {}
+    function = processor
+    while isinstance(function, partial):
+        bound.update(function.keywords)
+        function = function.func
+    digest = hashlib.sha256()
+    module = inspect.getmodule(function)
+    try:
+        digest.update(inspect.getsource(module).encode())
+    except (OSError, TypeError):
+        # e.g. defined in a notebook cell
+        digest.update(function.__code__.co_code.hex().encode())
+    if module is not None:
+        for name in sorted(_package_imports(module)):
+            digest.update(f"{name}:{_module_token(name)};".encode())
+    for name in sorted(bound):
+        digest.update(f"{name}={value_token(bound[name])};".encode())
+    return f"{processor.__name__}:{digest.hexdigest()}"
+
+
+def value_token(value):
+    """
+    hash of a configuration value ... every path in it (see (a)) also hashes its size & mtime
+    :raises NotCacheable: the value can't be pickled (its repr may hold memory addresses, so it isn't a stable key)
+    """
+    if isinstance(value, (set, frozenset)):
+        value = sorted(value, key=repr)
+    try:
+        digest = hashlib.sha256(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+    except Exception as error:
+        raise NotCacheable(f"{type(value).__name__} can't be pickled ({error})") from error
+    for path in _paths(value):
+        for file_path in _path_files(path):
+            stat = os.stat(file_path)
+            digest.update(f"{file_path}:{stat.st_size}:{stat.st_mtime_ns};".encode())
+    return digest.hexdigest()
+
+
+def resource_token(key, value):
+    """token of a resource produced under key ... see (a)"""
+    if not isinstance(value, Mapping):
+        return key
+    try:
+        keys = pickle.dumps(list(value.keys()), protocol=pickle.HIGHEST_PROTOCOL)
+    except Exception as error:
+        raise NotCacheable(f"the keys of the resource can't be pickled ({error})") from error
+    return f"{key}:{hashlib.sha256(keys).hexdigest()}"
+
+
+def encode_records(value):
+    """a mapping of records whose namedtuple type was created inside a processor as rows + fields (see (b))"""
+    if not isinstance(value, Mapping) or isinstance(value, ColumnDict) or not value:
+        return value
+    record_type = type(next(iter(value.values())))
+    if not hasattr(record_type, "_make") or issubclass(record_type, ImmutableRecord) or _importable(record_type):
+        return value
+    if not all(type(record) is record_type for record in value.values()):
+        return value
+    return _RecordRows(
+        record_type.__name__,
+        record_type._fields,
+        list(value.keys()),
+        [tuple(record) for record in value.values()],
+    )
+
+
+def decode_records(value):
+    """the mapping encode_records encoded (records of an equivalent namedtuple type) ... anything else as is"""
+    if not isinstance(value, _RecordRows):
+        return value
+    record_type = namedtuple(value.typename, value.fields)
+    return ImmutableDict(zip(value.keys, map(record_type._make, value.rows)))
+
+
+"""
+HELPERS
+"""
+
+
+_PACKAGE = __name__.split(".")[0]
+
+
+def _package_imports(module):
+    """names of the package modules module imports, directly or through other package modules"""
+    found = set()
+    pending = [module]
+    while pending:
+        for value in list(vars(pending.pop()).values()):
+            name = value.__name__ if isinstance(value, ModuleType) else getattr(value, "__module__", None)
+            if not isinstance(name, str) or name in found or name.split(".")[0] != _PACKAGE:
+                continue
+            imported = sys.modules.get(name)
+            if imported is not None:
+                found.add(name)
+                pending.append(imported)
+    found.discard(module.__name__)
+    return found
+
+
+@lru_cache(maxsize=None)
+def _module_token(name):
+    """hash of a package module's source (read once per process)"""
+    try:
+        source = inspect.getsource(sys.modules[name])
+    except (OSError, TypeError):
+        source = ""
+    return hashlib.sha256(source.encode()).hexdigest()
+
+
+def _paths(value):
+    """every string in value (records, mappings & sequences included) that is an existing path"""
+    if isinstance(value, str):
+        if os.path.exists(value):
+            yield value
+    elif isinstance(value, Mapping):
+        for item in value.values():
+            yield from _paths(item)
+    elif isinstance(value, (tuple, list, set, frozenset)):
+        # ImmutableRecords & namedtuples are tuples of their values
+        for item in value:
+            yield from _paths(item)
+
+
+def _path_files(path):
+    """the files whose size & mtime stand for path ... a feed store is its table manifests (rewritten on every ingest)"""
+    if not os.path.isdir(path):
+        return [path]
+    return sorted(
+        os.path.join(entry.path, STORE_MANIFEST_NAME)
+        for entry in os.scandir(path)
+        if entry.is_dir() and os.path.isfile(os.path.join(entry.path, STORE_MANIFEST_NAME))
+    )
+
+
+def _importable(record_type):
+    module = sys.modules.get(record_type.__module__)
+    return getattr(module, record_type.__qualname__, None) is record_type
+
+
+def _remove(path):
+    if os.path.exists(path):
+        os.remove(path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect or clear the enrichment resource cache")
+    parser.add_argument("--directory", required=True, help="resource cache directory")
+    parser.add_argument("command", choices=["info", "clear"])
+    parser.add_argument("--processor", default=None, help="only entries of this processor")
+    arguments = parser.parse_args()
+
+    cache = ResourceCache(arguments.directory)
+    if arguments.command == "clear":
+        print(f"removed {cache.clear(arguments.processor)} entries")
+    else:
+        entries = [
+            entry
+            for entry in cache.entries()
+            if arguments.processor is None or entry.processor == arguments.processor
+        ]
+        for entry in entries:
+            last_used = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(entry.last_used))
+            print(f"{entry.processor:<40} {entry.key}  {entry.size / 1024**2:>10.1f} MB  {last_used}")
+        print(f"{len(entries)} entries, {sum(entry.size for entry in entries) / 1024**2:.1f} MB")
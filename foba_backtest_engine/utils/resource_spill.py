@@ -0,0 +1,261 @@
+import importlib
+import json
+import os
+import pickle
+from collections import namedtuple
+from collections.abc import ItemsView, Mapping, ValuesView
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from foba_backtest_engine.utils.base_utils import (
+    ImmutableRecord,
+    immutable_record_class,
+    load_legacy_pickle,
+    loads_legacy_pickle,
+)
+from foba_backtest_engine.utils.spill_list import list_pickler
+
+"""
+RESOURCE SPILL
+
+On-disk format for Enrichment resources (keep_resources_on_disk, test mode persistence).
+
+a) Tabular resources ... a Mapping whose values are all records of one type (namedtuple, incl. the ones created
+   inside a processor like FullFeedStateAtEvent, or ImmutableRecords with the same fields)
+    - written as an Arrow IPC file (<stem>.arrow): one column per field + the mapping keys in __key__
+    - columns of one python type (bool | int | float | str | bytes, None allowed) or one numpy scalar type are
+      stored natively, anything else (enums, timestamps, mixed types) as a pickle per value
+    - loaded w/ a memory map into a RecordTable ... a read-only Mapping that rebuilds the records on access & gives
+      the whole table via frame()
+        - keys are looked up through a pandas Index over the key column (numbers: a view of the arrow buffer)
+        - a lookup only decodes its own row, iterating decodes each column once
+        - numeric columns w/o nulls stay views of the memory mapped buffers (zero copy)
+
+b) Anything else (e.g. pybuilders) ... pickled to <stem>.pkl as before (SpillLists as plain lists, see list_pickler)
+
+"""
+
+ARROW_SUFFIX = ".arrow"
+PICKLE_SUFFIX = ".pkl"
+KEY_COLUMN = "__key__"
+
+NATIVE_TYPES = (bool, int, float, str, bytes)
+NUMPY_TYPES = (np.bool_, np.int64, np.int32, np.float64, np.float32)
+
+
+def save_resource(resource, path_stem):
+    """:return: the path written"""
+    table = _record_table(resource)
+    if table is None:
+        path = path_stem + PICKLE_SUFFIX
+        with open(path, "wb") as file:
+            list_pickler(file).dump(resource)
+        return path
+
+    path = path_stem + ARROW_SUFFIX
+    with pa.OSFile(path, "wb") as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    return path
+
+
+def load_resource(path_stem):
+    if os.path.exists(path_stem + ARROW_SUFFIX):
+        with pa.memory_map(path_stem + ARROW_SUFFIX, "r") as source:
+            return RecordTable(pa.ipc.open_file(source).read_all())
+    with open(path_stem + PICKLE_SUFFIX, "rb") as file:
+        return load_legacy_pickle(file)
+
+
+def resource_exists(path_stem):
+    return any(os.path.exists(path) for path in spill_paths(path_stem))
+
+
+def spill_paths(path_stem):
+    return path_stem + ARROW_SUFFIX, path_stem + PICKLE_SUFFIX
+
+
+class RecordTable(Mapping):
+    def __init__(self, table):
+        self.table = table
+        metadata = json.loads(table.schema.metadata[b"resource"])
+        self.fields = tuple(metadata["fields"])
+        self._column_kinds = metadata["kinds"]
+        self.record_type = _record_type(metadata)
+        self._arrays = {}
+        self._columns = {}
+        self._keys = None
+
+    def __len__(self):
+        return self.table.num_rows
+
+    def __iter__(self):
+        return iter(self._key_index())
+
+    def __contains__(self, key):
+        try:
+            return key in self._key_index()
+        except TypeError:
+            return False
+
+    def __getitem__(self, key):
+        row = self._key_index().get_loc(key)
+        return self._make([self._value(field, row) for field in self.fields])
+
+    def items(self):
+        return _RecordItems(self)
+
+    def values(self):
+        return _RecordValues(self)
+
+    def _records(self):
+        return map(self._make, zip(*(self._column(field) for field in self.fields)))
+
+    def _make(self, values):
+        return self.record_type._make(values)
+
+    def _key_index(self):
+        """the keys as a pandas Index over the key column (hashed on the first lookup, not a dict of python keys)"""
+        if self._keys is None:
+            keys = self._column(KEY_COLUMN) if self._column_kinds[KEY_COLUMN] == "pickle" else self._array(KEY_COLUMN)
+            self._keys = pd.Index(keys, name=KEY_COLUMN, copy=False, tupleize_cols=False)
+        return self._keys
+
+    def _value(self, name, row):
+        """one value of a column ... only that row is decoded unless the whole column already is"""
+        if name in self._columns:
+            return self._columns[name][row]
+        kind = self._column_kinds[name]
+        if kind == "pickle":
+            return loads_legacy_pickle(self.table.column(name)[row].as_py())
+        if kind == "native":
+            return self.table.column(name)[row].as_py()
+        return self._array(name)[row]
+
+    def _array(self, name):
+        """
+        the column as a numpy array ... a read-only view of the (memory mapped) arrow buffer for numbers w/o nulls,
+        a converted copy otherwise (e.g. strings, bools, nulls)
+        """
+        if name not in self._arrays:
+            array = self.table.column(name)
+            try:
+                values = array.combine_chunks().to_numpy(zero_copy_only=True)
+            except (pa.ArrowInvalid, NotImplementedError):
+                values = array.to_numpy()
+            kind = self._column_kinds[name]
+            if kind not in ("native", "pickle"):
+                # numpy scalars stay numpy scalars
+                values = values.astype(kind, copy=False)
+            self._arrays[name] = values
+        return self._arrays[name]
+
+    def _column(self, name):
+        """the whole column as the records hold it ... decoded once, for iteration over every record"""
+        if name not in self._columns:
+            kind = self._column_kinds[name]
+            if kind == "pickle":
+                values = [loads_legacy_pickle(value) for value in self.table.column(name).to_pylist()]
+            elif kind == "native":
+                values = self.table.column(name).to_pylist()
+            else:
+                values = self._array(name)
+            self._columns[name] = values
+        return self._columns[name]
+
+    def frame(self):
+        """
+        the table as a DataFrame indexed by the mapping keys ... the numeric columns are views of the arrow buffers
+        (read-only), pickled columns are decoded
+        """
+        data = {
+            name: self._column(name) if self._column_kinds[name] == "pickle" else self._array(name)
+            for name in self.fields
+        }
+        return pd.DataFrame(data, index=self._key_index(), columns=list(self.fields), copy=False)
+
+
+class _RecordItems(ItemsView):
+    def __iter__(self):
+        return zip(self._mapping._key_index(), self._mapping._records())
+
+
+class _RecordValues(ValuesView):
+    def __iter__(self):
+        return self._mapping._records()
+
+
+"""
+HELPERS
+"""
+
+
+def _record_table(resource):
+    if not isinstance(resource, Mapping) or not resource:
+        return None
+    records = list(resource.values())
+    record_type = type(records[0])
+    # ImmutableRecords are tuples too ... one type per set of fields
+    if not isinstance(records[0], tuple) or not hasattr(record_type, "_fields"):
+        return None
+    fields = record_type._fields
+    if not all(type(record) is record_type for record in records):
+        return None
+    rows = records
+
+    names = (KEY_COLUMN, *fields)
+    columns = (list(resource.keys()), *(list(column) for column in zip(*rows)))
+    arrays, kinds = [], {}
+    for name, column in zip(names, columns):
+        kinds[name], array = _arrow_column(column)
+        arrays.append(array)
+
+    metadata = {
+        "fields": list(fields),
+        "kinds": kinds,
+        "record": "ImmutableRecord" if issubclass(record_type, ImmutableRecord) else "namedtuple",
+        "typename": record_type.__name__,
+        "module": record_type.__module__,
+        "qualname": record_type.__qualname__,
+    }
+    schema = pa.schema(
+        [pa.field(name, array.type) for name, array in zip(names, arrays)],
+        metadata={"resource": json.dumps(metadata)},
+    )
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+
+def _arrow_column(column):
+    """:return: (kind, array) ... kind is "native" | a numpy dtype name | "pickle" """
+    types = set(map(type, column))
+    has_none = type(None) in types
+    types.discard(type(None))
+    if len(types) <= 1:
+        value_type = types.pop() if types else type(None)
+        try:
+            if value_type in NATIVE_TYPES or value_type is type(None):
+                return "native", pa.array(column)
+            if value_type in NUMPY_TYPES and not has_none:
+                return np.dtype(value_type).name, pa.array(np.array(column, dtype=value_type))
+        except (pa.ArrowInvalid, pa.ArrowTypeError, OverflowError):
+            pass
+    return "pickle", pa.array(
+        [pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL) for value in column], pa.binary()
+    )
+
+
+def _record_type(metadata):
+    if metadata["record"] == "ImmutableRecord":
+        return immutable_record_class(tuple(metadata["fields"]))
+    try:
+        record_type = importlib.import_module(metadata["module"])
+        for name in metadata["qualname"].split("."):
+            record_type = getattr(record_type, name)
+        if tuple(record_type._fields) == tuple(metadata["fields"]):
+            return record_type
+    except (ImportError, AttributeError):
+        pass
+    # created inside a processor ... an equivalent type
+    return namedtuple(metadata["typename"], metadata["fields"])
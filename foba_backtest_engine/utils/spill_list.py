@@ -0,0 +1,118 @@
+import copyreg
+import os
+import pickle
+import weakref
+from collections.abc import Sequence
+
+"""
+SPILL LIST
+
+Append-only list that keeps at most chunk_size items in memory ... full chunks are pickled to a file & read
+back on access. Used by the streaming book build to keep the per-message outputs (feed states, order count
+states, order queue snapshots) off the heap while a book is being built.
+
+    - append / len / iteration / indexing (incl. negative indices & slices) behave like a list
+    - the LAST appended item always stays in memory (OrderQueue mutates its latest snapshot in place, and
+      [-1] is read on every message)
+    - reads go through a small chunk cache so sequential access (e.g. the CompetitorMatcher walking a
+      queue) only loads each chunk once
+    - items read back from disk are copies ... don't rely on object identity across two reads of a flushed item
+
+The spill file is removed when the owning SpillList is garbage collected. Copies made by pickling read the same
+file but don't own it (e.g. an argument of a process pool task or a persisted resource) ... only after hand_over()
+does the next pickled copy take the file over (e.g. a builder returned from a streaming worker, whose own copy is
+collected when the worker is done). list_pickler stores SpillLists as plain lists instead (caches, spilled resources)
+"""
+
+
+class SpillList(Sequence):
+    def __init__(self, path, chunk_size=50_000, cached_chunks=2):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.cached_chunks = cached_chunks
+        self._offsets = []
+        self._flushed = 0
+        self._buffer = []
+        self._cache = {}
+        self._finalizer = weakref.finalize(self, _remove_file, path)
+        self._hands_over = False
+
+    def append(self, item):
+        self._buffer.append(item)
+        if len(self._buffer) > self.chunk_size:
+            self._flush(self._buffer[:-1])
+            self._buffer = self._buffer[-1:]
+
+    def _flush(self, items):
+        with open(self.path, "ab") as spill_file:
+            spill_file.seek(0, os.SEEK_END)
+            self._offsets.append(spill_file.tell())
+            pickle.dump(items, spill_file, protocol=pickle.HIGHEST_PROTOCOL)
+        self._flushed += len(items)
+
+    def _chunk(self, chunk_index):
+        if chunk_index in self._cache:
+            return self._cache[chunk_index]
+        with open(self.path, "rb") as spill_file:
+            spill_file.seek(self._offsets[chunk_index])
+            chunk = pickle.load(spill_file)
+        if len(self._cache) >= self.cached_chunks:
+            self._cache.pop(next(iter(self._cache)))
+        self._cache[chunk_index] = chunk
+        return chunk
+
+    def __len__(self):
+        return self._flushed + len(self._buffer)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("SpillList index out of range")
+        if index >= self._flushed:
+            return self._buffer[index - self._flushed]
+        # every flushed chunk holds chunk_size items
+        chunk_index, position = divmod(index, self.chunk_size)
+        return self._chunk(chunk_index)[position]
+
+    def __iter__(self):
+        for chunk_index in range(len(self._offsets)):
+            yield from self._chunk(chunk_index)
+        yield from self._buffer
+
+    def hand_over(self):
+        """the next copy made by pickling owns the spill file ... this one no longer removes it once that copy exists"""
+        self._hands_over = True
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_finalizer"]
+        state["_cache"] = {}
+        state["_hands_over"] = False
+        state["_owns_file"] = self._hands_over
+        if self._hands_over:
+            self._hands_over = False
+            if self._finalizer is not None:
+                self._finalizer.detach()
+            self._finalizer = None
+        return state
+
+    def __setstate__(self, state):
+        owns_file = state.pop("_owns_file")
+        self.__dict__.update(state)
+        self._finalizer = weakref.finalize(self, _remove_file, self.path) if owns_file else None
+
+
+def list_pickler(file):
+    """pickle.Pickler that stores SpillLists as plain lists (the copy doesn't depend on the spill file)"""
+    pickler = pickle.Pickler(file, protocol=pickle.HIGHEST_PROTOCOL)
+    pickler.dispatch_table = copyreg.dispatch_table.copy()
+    pickler.dispatch_table[SpillList] = lambda spill_list: (list, (list(spill_list),))
+    return pickler
+
+
+def _remove_file(path):
+    if os.path.exists(path):
+        os.remove(path)